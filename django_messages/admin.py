@@ -1,18 +1,125 @@
 from django import forms
-from django.conf import settings
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.core.urlresolvers import reverse
+from django.db.models import signals
+from django.http import HttpResponseRedirect
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from django.contrib import admin
+from django.contrib.admin.views.main import ChangeList
 from django.contrib.auth.models import Group
 
-from django_messages.utils import get_user_model
+from django_messages.utils import (get_user_model, get_notification,
+    estimated_count, approximate_counts_enabled)
 User = get_user_model()
 
-if "notification" in settings.INSTALLED_APPS and getattr(settings, 'DJANGO_MESSAGES_NOTIFY', True):
-    from notification import models as notification
-else:
-    notification = None
-    
-from django_messages.models import Message
+from django_messages import idempotency
+from django_messages.changes import record_change, record_changes
+from django_messages.forms import save_sender_copy
+from django_messages.models import Message, MessageChange
+from django_messages.sharding import shard_for_user
+
+GROUP_CHOICES_CACHE_KEY = 'django_messages:admin:group_choices'
+
+def clear_group_choices(sender, **kwargs):
+    cache.delete(GROUP_CHOICES_CACHE_KEY)
+
+signals.post_save.connect(clear_group_choices, sender=Group,
+    dispatch_uid='django_messages.admin.clear_group_choices')
+signals.post_delete.connect(clear_group_choices, sender=Group,
+    dispatch_uid='django_messages.admin.clear_group_choices')
+
+
+class UserIdListFilter(admin.ListFilter):
+    """
+    Filters by the id of a related user, entered in a text input instead of
+    listing every user as a choice.
+    """
+    template = 'admin/django_messages/user_id_filter.html'
+    field_name = None
+
+    def __init__(self, request, params, model, model_admin):
+        super(UserIdListFilter, self).__init__(request, params, model, model_admin)
+        self.parameter_name = '%s__id__exact' % self.field_name
+        self.value = None
+        if self.parameter_name in params:
+            value = params.pop(self.parameter_name)
+            if value.isdigit():
+                self.value = value
+                self.used_parameters[self.parameter_name] = value
+
+    def has_output(self):
+        return True
+
+    def expected_parameters(self):
+        return [self.parameter_name]
+
+    def queryset(self, request, queryset):
+        if self.value is not None:
+            return queryset.filter(**{'%s_id' % self.field_name: self.value})
+        return queryset
+
+    def choices(self, cl):
+        yield {
+            'value': self.value,
+            'parameter_name': self.parameter_name,
+            'hidden_params': [(k, v) for k, v in cl.params.items()
+                              if k != self.parameter_name],
+            'clear_url': cl.get_query_string(remove=[self.parameter_name]),
+        }
+
+
+class SenderListFilter(UserIdListFilter):
+    title = _('sender')
+    field_name = 'sender'
+
+
+class RecipientListFilter(UserIdListFilter):
+    title = _('recipient')
+    field_name = 'recipient'
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Uses the database's estimate of the table size instead of a full
+    ``COUNT(*)`` for unfiltered changelists, and the query planner's estimate
+    for filtered ones with ``DJANGO_MESSAGES_APPROXIMATE_COUNTS``.
+    """
+    @property
+    def count(self):
+        if getattr(self, '_estimated_count', None) is None:
+            self._estimated_count = estimated_count(self.object_list,
+                approximate=approximate_counts_enabled())
+        return self._estimated_count
+
+
+class _EstimatedCountQuerySet(object):
+    """
+    Stands in for the unfiltered queryset of a changelist, whose ``count()``
+    is only used for the total number of messages.
+    """
+    def __init__(self, queryset):
+        self.queryset = queryset
+
+    def count(self):
+        return estimated_count(self.queryset)
+
+
+class EstimatedCountChangeList(ChangeList):
+    """
+    Estimates the total number of messages shown next to the number of
+    results of a filtered changelist, which Django counts exactly. Django
+    1.8 skips that count with ``show_full_result_count = False``.
+    """
+    def get_results(self, request):
+        root_queryset = self.root_queryset
+        self.root_queryset = _EstimatedCountQuerySet(root_queryset)
+        try:
+            super(EstimatedCountChangeList, self).get_results(request)
+        finally:
+            self.root_queryset = root_queryset
+
 
 class MessageAdminForm(forms.ModelForm):
     """
@@ -20,21 +127,33 @@ class MessageAdminForm(forms.ModelForm):
     """
     group = forms.ChoiceField(label=_('group'), required=False,
         help_text=_('Creates the message optionally for all users or a group of users.'))
+    idempotency_key = forms.CharField(required=False,
+        max_length=idempotency.MAX_LENGTH, widget=forms.HiddenInput)
 
     def __init__(self, *args, **kwargs):
         super(MessageAdminForm, self).__init__(*args, **kwargs)
         self.fields['group'].choices = self._get_group_choices()
         self.fields['recipient'].required = True
+        if not self.instance.expires():
+            # saved as ``never()``, see ``Message.save``
+            self.initial['expires_at'] = None
+        if idempotency.is_enabled():
+            self.fields['idempotency_key'].initial = idempotency.new_key()
+        else:
+            del self.fields['idempotency_key']
 
     def _get_group_choices(self):
-        return [('', u'---------'), ('all', _('All users'))] + \
-            [(group.pk, group.name) for group in Group.objects.all()]
+        groups = cache.get(GROUP_CHOICES_CACHE_KEY)
+        if groups is None:
+            groups = list(Group.objects.values_list('pk', 'name'))
+            cache.set(GROUP_CHOICES_CACHE_KEY, groups)
+        return [('', u'---------'), ('all', _('All users'))] + groups
 
     class Meta:
         model = Message
         fields = ('sender', 'recipient', 'group', 'parent_msg', 'subject',
                 'body', 'sent_at', 'read_at', 'replied_at', 'sender_deleted_at',
-                'recipient_deleted_at')
+                'recipient_deleted_at', 'expires_at')
 
 class MessageAdmin(admin.ModelAdmin):
     form = MessageAdminForm
@@ -55,17 +174,64 @@ class MessageAdmin(admin.ModelAdmin):
         (_('Date/time'), {
             'fields': (
                 'sent_at', 'read_at', 'replied_at',
-                'sender_deleted_at', 'recipient_deleted_at',
+                'sender_deleted_at', 'recipient_deleted_at', 'expires_at',
             ),
             'classes': ('collapse', 'wide'),
         }),
     )
     list_display = ('subject', 'sender', 'recipient', 'sent_at', 'read_at')
-    list_filter = ('sent_at', 'sender', 'recipient')
+    list_filter = (SenderListFilter, RecipientListFilter)
+    list_select_related = ('sender', 'recipient')
+    date_hierarchy = 'sent_at'
     search_fields = ('subject', 'body')
     raw_id_fields = ('sender', 'recipient', 'parent_msg')
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def get_changelist(self, request, **kwargs):
+        return EstimatedCountChangeList
+
+    def get_fieldsets(self, request, obj=None):
+        fieldsets = super(MessageAdmin, self).get_fieldsets(request, obj)
+        if obj is None and idempotency.is_enabled():
+            fieldsets = tuple(fieldsets) + (
+                (None, {'fields': ('idempotency_key',)}),
+            )
+        return fieldsets
 
     def save_model(self, request, obj, form, change):
+        """
+        Sends the message. A new message whose form was submitted before,
+        according to its idempotency key, isn't sent again; ``obj`` then
+        gets the id of the first message sent, or stays unsaved while the
+        first submission is still being sent.
+        """
+        key = form.cleaned_data.get(idempotency.FIELD_NAME)
+        if change or not key:
+            self.send_message(obj, form, change)
+            return
+        message_ids, created = idempotency.send_once(request.user, key,
+            lambda: self.send_message(obj, form, change))
+        if not created:
+            obj.resubmitted = True
+            if message_ids:
+                obj.pk = message_ids[0][1]
+
+    def log_addition(self, request, object, *args, **kwargs):
+        if getattr(object, 'resubmitted', False):
+            # the first submission logged the addition
+            return
+        return super(MessageAdmin, self).log_addition(request, object, *args, **kwargs)
+
+    def response_add(self, request, obj, *args, **kwargs):
+        if obj.pk is None:
+            self.message_user(request, _("The message is still being sent. "
+                                         "Please check the list of messages in a moment."))
+            return HttpResponseRedirect(reverse('admin:django_messages_message_changelist',
+                                                current_app=self.admin_site.name))
+        return super(MessageAdmin, self).response_add(request, obj, *args, **kwargs)
+
+    def send_message(self, obj, form, change):
         """
         Saves the message for the recipient and looks in the form instance
         for other possible recipients. Prevents duplication by excludin the
@@ -73,12 +239,28 @@ class MessageAdmin(admin.ModelAdmin):
 
         When changing an existing message and choosing optional recipients,
         the message is effectively resent to those users.
+
+        With sharding new messages are saved on the shard of their recipient,
+        like ``ComposeForm`` does; see ``save_new_message``.
+
+        Returns the ``(database, id)`` pairs of the saved messages.
         """
-        obj.save()
-        
+        parent_msg = obj.parent_msg
+        sender_deleted_at = obj.sender_deleted_at
+        if change:
+            # the shard router keeps the message on its database
+            obj.save()
+            sent = [(obj._state.db, obj.pk)]
+            self.record_edit_changes(obj, form)
+        else:
+            sent = []
+            record_changes(self.save_new_message(obj, parent_msg,
+                                                 sender_deleted_at, sent))
+        notification = get_notification()
+
         if notification:
             # Getting the appropriate notice labels for the sender and recipients.
-            if obj.parent_msg is None:
+            if parent_msg is None:
                 sender_label = 'messages_sent'
                 recipients_label = 'messages_received'
             else:
@@ -100,13 +282,58 @@ class MessageAdmin(admin.ModelAdmin):
                 recipients.extend(
                     list(group.user_set.exclude(pk=obj.recipient.pk)))
         # create messages for all found recipients
+        changes = []
         for user in recipients:
             obj.pk = None
             obj.recipient = user
-            obj.save()
+            changes.extend(self.save_new_message(obj, parent_msg,
+                                                 sender_deleted_at, sent))
 
             if notification:
                 # Notification for the recipient.
                 notification.send([user], recipients_label, {'message' : obj,})
+        record_changes(changes)
+        return sent
+
+    def save_new_message(self, obj, parent_msg, sender_deleted_at, sent):
+        """
+        Saves ``obj`` as a new message on the shard of its recipient, adds
+        its ``(database, id)`` pair to ``sent`` and returns the changes to
+        record. A recipient on another shard than the sender gets a copy
+        marked as deleted by the sender, and the sender a copy of their own.
+        As in ``ComposeForm``, ``parent_msg`` is only linked on its own shard.
+        """
+        using = shard_for_user(obj.recipient_id)
+        sender_shard = shard_for_user(obj.sender_id)
+        obj.sender_deleted_at = sender_deleted_at
+        if using != sender_shard and obj.sender_deleted_at is None:
+            obj.sender_deleted_at = timezone.now()
+        obj.parent_msg = None
+        if parent_msg is not None and (using is None or parent_msg._state.db == using):
+            obj.parent_msg = parent_msg
+        obj.save(using=using)
+        sent.append((obj._state.db, obj.pk))
+        if using == sender_shard:
+            return [(user_id, obj.pk, MessageChange.CREATED)
+                    for user_id in set([obj.sender_id, obj.recipient_id])]
+        copy = save_sender_copy(obj, sender_shard, parent_msg)
+        return [(obj.recipient_id, obj.pk, MessageChange.CREATED),
+                (obj.sender_id, copy.pk, MessageChange.CREATED)]
+
+    def record_edit_changes(self, obj, form):
+        """
+        Records the state changes of an edited message in the change log.
+        """
+        if 'read_at' in form.changed_data and obj.read_at is not None:
+            record_change(obj, MessageChange.READ)
+        if 'replied_at' in form.changed_data and obj.replied_at is not None:
+            record_change(obj, MessageChange.REPLIED)
+        for field, user_id in (('sender_deleted_at', obj.sender_id),
+                               ('recipient_deleted_at', obj.recipient_id)):
+            if field in form.changed_data:
+                event = MessageChange.UNDELETED
+                if getattr(obj, field) is not None:
+                    event = MessageChange.DELETED
+                record_change(obj, event, [user_id])
             
 admin.site.register(Message, MessageAdmin)
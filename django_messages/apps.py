@@ -4,3 +4,11 @@ from django.utils.translation import ugettext_lazy as _
 class DjangoMessagesConfig(AppConfig):
     name = 'django_messages'
     verbose_name = _('Messages')
+
+    def ready(self):
+        from django.db.models import signals
+        from django_messages.utils import connect_signals, create_notice_types, get_notification
+        connect_signals()
+        if get_notification() is not None:
+            signals.post_migrate.connect(create_notice_types, sender=self,
+                dispatch_uid='django_messages.create_notice_types')
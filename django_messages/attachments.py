@@ -0,0 +1,187 @@
+"""
+File attachments.
+
+Attachments are disabled unless ``DJANGO_MESSAGES_ATTACHMENTS = True``. The
+content of an attached file is stored once per database in an
+``AttachmentBlob``, identified by its SHA-256, so a file sent to many
+recipients or attached again later takes up space only once. Files are
+stored in ``DJANGO_MESSAGES_ATTACHMENT_STORAGE`` and served by the
+``messages_attachment`` view to the sender and recipient of the message.
+"""
+import hashlib
+import mimetypes
+import re
+
+from django.conf import settings
+from django.db import IntegrityError, router, transaction
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.http import urlquote
+
+from django_messages.models import Attachment, AttachmentBlob
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def is_enabled():
+    return getattr(settings, 'DJANGO_MESSAGES_ATTACHMENTS', False)
+
+
+def get_max_size():
+    return getattr(settings, 'DJANGO_MESSAGES_ATTACHMENT_MAX_SIZE', 10 * 1024 * 1024)
+
+
+def get_sendfile_mode():
+    return getattr(settings, 'DJANGO_MESSAGES_ATTACHMENT_SENDFILE', None)
+
+
+def file_hash(uploaded_file):
+    sha256 = hashlib.sha256()
+    for chunk in uploaded_file.chunks():
+        sha256.update(chunk)
+    uploaded_file.seek(0)
+    return sha256.hexdigest()
+
+
+def store_blob(uploaded_file, using=None):
+    """
+    Returns the blob holding the content of the file, storing the content
+    only if no blob with the same hash exists on the database.
+    """
+    if using is None:
+        using = router.db_for_write(AttachmentBlob)
+    blobs = AttachmentBlob.objects.using(using)
+    sha256 = file_hash(uploaded_file)
+    try:
+        return blobs.get(sha256=sha256)
+    except AttachmentBlob.DoesNotExist:
+        pass
+    blob = AttachmentBlob(sha256=sha256, size=uploaded_file.size)
+    blob.file.save(sha256, uploaded_file, save=False)
+    try:
+        with transaction.atomic(using=using):
+            blob.save(using=using)
+    except IntegrityError:
+        # stored concurrently
+        blob.file.delete(save=False)
+        blob = blobs.get(sha256=sha256)
+    return blob
+
+
+def attach(messages, uploaded_file, blobs=None):
+    """
+    Attaches the file to all given messages. ``blobs`` maps databases to the
+    blobs already stored there, missing blobs are stored. Returns the
+    attachments.
+    """
+    content_type = (getattr(uploaded_file, 'content_type', None) or
+                    mimetypes.guess_type(uploaded_file.name)[0] or
+                    'application/octet-stream')
+    blobs = {} if blobs is None else blobs
+    attachments = []
+    for message in messages:
+        using = message._state.db
+        if using not in blobs:
+            blobs[using] = store_blob(uploaded_file, using)
+        attachments.append(Attachment(message=message, blob=blobs[using],
+            filename=uploaded_file.name, content_type=content_type))
+    for using in blobs:
+        Attachment.objects.using(using).bulk_create(
+            [a for a in attachments if a.message._state.db == using])
+    return attachments
+
+
+def content_disposition(filename):
+    if re.match(r'^[\x20-\x7e]*$', filename):
+        return 'attachment; filename="%s"' % filename.replace('\\', '\\\\').replace('"', '\\"')
+    return "attachment; filename*=UTF-8''%s" % urlquote(filename)
+
+
+def parse_range(header, size):
+    """
+    Returns the ``(start, end)`` byte positions (inclusive) requested by a
+    single range ``Range`` header, ``None`` if the whole file should be
+    sent, or ``False`` if the range can't be satisfied.
+    """
+    match = RANGE_RE.match(header.strip())
+    if match is None:
+        # malformed or multiple ranges
+        return None
+    start, end = match.groups()
+    if not start and not end:
+        return None
+    if not start:
+        # the last ``end`` bytes
+        length = int(end)
+        if length == 0:
+            return False
+        return max(size - length, 0), size - 1
+    start = int(start)
+    end = int(end) if end else size - 1
+    if start > end or start >= size:
+        return False
+    return start, min(end, size - 1)
+
+
+def iter_file(f, start, length, chunk_size=64 * 1024):
+    try:
+        f.seek(start)
+        while length > 0:
+            data = f.read(min(chunk_size, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+    finally:
+        f.close()
+
+
+def local_path(blob):
+    """returns the path of the blob's file, or ``None`` if it isn't local"""
+    try:
+        return blob.file.path
+    except NotImplementedError:
+        return None
+
+
+def serve(request, attachment):
+    """
+    Returns a response sending the attachment, honouring ``Range`` and
+    ``If-None-Match`` headers, or handing the file off to the web server
+    with ``DJANGO_MESSAGES_ATTACHMENT_SENDFILE``. ``X-Sendfile`` needs a
+    storage with local paths; files of other storages are streamed.
+    """
+    blob = attachment.blob
+    etag = '"%s"' % blob.sha256
+    mode = get_sendfile_mode()
+    path = local_path(blob) if mode == 'x-sendfile' else None
+    if request.META.get('HTTP_IF_NONE_MATCH') == etag:
+        response = HttpResponse(status=304)
+    elif path is not None:
+        response = HttpResponse(content_type=attachment.content_type)
+        response['X-Sendfile'] = path
+    elif mode == 'x-accel-redirect':
+        response = HttpResponse(content_type=attachment.content_type)
+        response['X-Accel-Redirect'] = getattr(settings,
+            'DJANGO_MESSAGES_ATTACHMENT_ACCEL_PREFIX', '/protected/') + blob.file.name
+    else:
+        size = blob.size
+        byte_range = None
+        if 'HTTP_RANGE' in request.META and request.META.get('HTTP_IF_RANGE', etag) == etag:
+            byte_range = parse_range(request.META['HTTP_RANGE'], size)
+        if byte_range is False:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = 'bytes */%d' % size
+            return response
+        start, end = byte_range or (0, size - 1)
+        length = end - start + 1 if size else 0
+        response = StreamingHttpResponse(
+            iter_file(blob.file.storage.open(blob.file.name, 'rb'), start, length),
+            content_type=attachment.content_type)
+        response['Content-Length'] = str(length)
+        if byte_range:
+            response.status_code = 206
+            response['Content-Range'] = 'bytes %d-%d/%d' % (start, end, size)
+        response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    response['Content-Disposition'] = content_disposition(attachment.filename)
+    return response
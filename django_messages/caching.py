@@ -0,0 +1,85 @@
+"""
+Cache helpers for rendered message fragments.
+
+Fragment caching is disabled unless ``DJANGO_MESSAGES_FRAGMENT_CACHE_TIMEOUT``
+is set to a number of seconds. Cache keys contain the state timestamps of the
+message, so a cached fragment is replaced as soon as the message is read,
+replied to or deleted.
+
+The mailbox cache holds data prepared for a user when they log in (see
+``django_messages.warming``). It is stored under a per-user version which is
+replaced whenever a message of the user changes.
+"""
+import hashlib
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import translation, timezone
+from django.utils.encoding import force_bytes
+
+
+def get_fragment_timeout():
+    return getattr(settings, 'DJANGO_MESSAGES_FRAGMENT_CACHE_TIMEOUT', None)
+
+
+def message_version(message):
+    """
+    returns a string which changes whenever the displayed state of the
+    message changes
+    """
+    state = [message.subject, message.snippet, message.sent_at,
+             message.read_at, message.replied_at,
+             message.sender_deleted_at, message.recipient_deleted_at]
+    if 'body' in message.__dict__:
+        # list views defer the body and only show the snippet
+        body = force_bytes(message.body)
+        state.extend([len(body), hashlib.md5(body).hexdigest()])
+    return hashlib.md5(force_bytes(repr(state))).hexdigest()
+
+
+def fragment_cache_key(fragment_name, message):
+    return 'django_messages:fragment:%s:%s:%s:%s:%s:%s' % (
+        fragment_name, message._state.db, message.pk, message_version(message),
+        translation.get_language(), timezone.get_current_timezone_name())
+
+
+def mailbox_cache_enabled():
+    return getattr(settings, 'DJANGO_MESSAGES_WARM_CACHE_ON_LOGIN', False)
+
+
+def get_mailbox_timeout():
+    return getattr(settings, 'DJANGO_MESSAGES_MAILBOX_CACHE_TIMEOUT', 300)
+
+
+def mailbox_version_key(user_id):
+    return 'django_messages:mailbox_version:%s' % user_id
+
+
+def mailbox_version(user_id):
+    """returns the current version of the user's mailbox"""
+    key = mailbox_version_key(user_id)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, uuid.uuid4().hex, get_mailbox_timeout())
+        version = cache.get(key)
+    return version
+
+
+def bump_mailbox_versions(*user_ids):
+    """invalidates the mailbox cache of the given users"""
+    if not mailbox_cache_enabled():
+        return
+    cache.set_many(dict(
+        (mailbox_version_key(user_id), uuid.uuid4().hex)
+        for user_id in set(user_ids) if user_id is not None
+    ), get_mailbox_timeout())
+
+
+def mailbox_cache_key(user_id, version):
+    return 'django_messages:mailbox:%s:%s' % (user_id, version)
+
+
+def invalidate_mailboxes(sender, instance, **kwargs):
+    """``post_save`` handler invalidating the mailbox cache of both users"""
+    bump_mailbox_versions(instance.sender_id, instance.recipient_id)
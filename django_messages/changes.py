@@ -0,0 +1,130 @@
+"""
+Change log of mailboxes for clients which sync incrementally.
+
+With ``DJANGO_MESSAGES_CHANGE_LOG = True`` every change of a message (created,
+read, replied to, deleted, recovered, purged and archived) is recorded as a
+``MessageChange`` for the users whose mailbox it affects. Clients fetch the
+entries after the last one they have seen from the ``messages_changes`` view,
+so they only download what changed. ``compact_message_changes`` removes old
+entries which were superseded by a newer entry for the same message.
+
+Ids are assigned on insert, but transactions commit in any order, so an entry
+with a lower id may become visible after one with a higher id. Entries
+younger than ``DJANGO_MESSAGES_CHANGE_LOG_DELAY`` seconds (and all entries
+after them) are therefore held back, so a client's cursor never passes an
+entry which isn't committed yet.
+"""
+import datetime
+
+from django.conf import settings
+from django.db import router
+from django.db.models import Max
+from django.utils import timezone
+
+from django_messages.models import MessageChange
+from django_messages.sharding import get_databases, is_enabled as sharding_enabled, shard_for_user
+
+
+def is_enabled():
+    return getattr(settings, 'DJANGO_MESSAGES_CHANGE_LOG', False)
+
+
+def get_delay():
+    return getattr(settings, 'DJANGO_MESSAGES_CHANGE_LOG_DELAY', 5)
+
+
+def record_changes(changes):
+    """
+    Records an iterable of ``(user_id, message_id, event)`` tuples, with one
+    query per database.
+    """
+    if not is_enabled():
+        return
+    by_database = {}
+    for user_id, message_id, event in changes:
+        if user_id is None:
+            continue
+        using = shard_for_user(user_id) or router.db_for_write(MessageChange)
+        by_database.setdefault(using, []).append(MessageChange(
+            user_id=user_id, message_id=message_id, event=event))
+    for using, entries in by_database.items():
+        MessageChange.objects.using(using).bulk_create(entries)
+
+
+def record_change(message, event, user_ids=None):
+    """
+    Records the event for the given users, by default the sender and the
+    recipient of the message.
+    """
+    if user_ids is None:
+        user_ids = set([message.sender_id, message.recipient_id])
+    record_changes((user_id, message.pk, event) for user_id in user_ids)
+
+
+def record_purged(rows, using, event=MessageChange.PURGED):
+    """
+    Records messages deleted from the database ``using``, given as ``(id,
+    sender_id, recipient_id)`` tuples, as purged, or with another ``event``
+    such as ``ARCHIVED``. With sharding only users whose messages live on
+    ``using`` are affected; the other user has a copy with another id on
+    their own shard.
+    """
+    sharded = sharding_enabled()
+    record_changes((user_id, pk, event)
+                   for pk, sender_id, recipient_id in rows
+                   for user_id in set([sender_id, recipient_id])
+                   if not sharded or shard_for_user(user_id) == using)
+
+
+def changes_since(user, cursor=0, limit=100):
+    """
+    Returns up to ``limit`` changes of the user's mailbox after ``cursor``
+    and whether there are more. Changes from the last
+    ``DJANGO_MESSAGES_CHANGE_LOG_DELAY`` seconds, and those after them, are
+    left for a later call.
+    """
+    changes = list(MessageChange.objects.for_user(user).filter(
+        user=user, pk__gt=cursor).order_by('pk')[:limit + 1])
+    horizon = timezone.now() - datetime.timedelta(seconds=get_delay())
+    settled = len(changes)
+    for i, change in enumerate(changes):
+        if change.created_at > horizon:
+            settled = i
+            break
+    return changes[:min(settled, limit)], settled > limit
+
+
+def compact(before, batch_size=1000):
+    """
+    Deletes the entries created before ``before`` for which a newer entry of
+    the same user and message exists. ``created`` entries are kept, so a
+    client syncing from an old cursor still learns about every message.
+    Returns the number of deleted entries.
+    """
+    deleted = 0
+    for using in get_databases(MessageChange):
+        changes = MessageChange.objects.using(using)
+        last_pk = 0
+        while True:
+            batch = list(changes.filter(created_at__lt=before, pk__gt=last_pk)
+                         .order_by('pk').values_list('pk', 'user', 'message_id', 'event')
+                         [:batch_size])
+            if not batch:
+                break
+            last_pk = batch[-1][0]
+            batch = [(pk, user_id, message_id) for pk, user_id, message_id, event in batch
+                     if event != MessageChange.CREATED]
+            if not batch:
+                continue
+            latest = dict(
+                ((row['user'], row['message_id']), row['latest'])
+                for row in changes.filter(
+                    user__in=set(user_id for pk, user_id, message_id in batch),
+                    message_id__in=set(message_id for pk, user_id, message_id in batch),
+                ).values('user', 'message_id').annotate(latest=Max('pk')).order_by())
+            superseded = [pk for pk, user_id, message_id in batch
+                          if latest[(user_id, message_id)] != pk]
+            if superseded:
+                changes.filter(pk__in=superseded).delete()
+                deleted += len(superseded)
+    return deleted
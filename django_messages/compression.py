@@ -0,0 +1,159 @@
+"""
+Transparent compression of large message bodies.
+
+Compression is disabled by default. With ``DJANGO_MESSAGES_COMPRESS_BODY``
+set to ``True`` bodies longer than ``DJANGO_MESSAGES_COMPRESS_THRESHOLD``
+characters are stored compressed with zlib, or with zstd if
+``DJANGO_MESSAGES_COMPRESS_ALGORITHM`` is ``'zstd'``. Compressed values are
+kept in the same text column, marked with a prefix, and are only decompressed
+when the body is accessed. Text which happens to start with the marker of
+the prefixes is escaped when it is saved, so it is never mistaken for a
+compressed value.
+"""
+import base64
+import binascii
+import logging
+import zlib
+
+from django.conf import settings
+from django.db import models
+from django.utils import six
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MARKER = u'\x01'
+ZLIB_PREFIX = u'\x01zlib:'
+ZSTD_PREFIX = u'\x01zstd:'
+PLAIN_PREFIX = u'\x01plain:'
+
+DECODE_ERRORS = (ValueError, TypeError, binascii.Error, zlib.error, UnicodeError)
+if zstandard is not None:
+    DECODE_ERRORS += (zstandard.ZstdError,)
+
+logger = logging.getLogger('django_messages.compression')
+
+
+class EncodedText(six.text_type):
+    """
+    A value in the form it is stored in, which ``CompressedTextField``
+    saves as it is.
+    """
+
+
+def is_enabled():
+    return getattr(settings, 'DJANGO_MESSAGES_COMPRESS_BODY', False)
+
+
+def get_threshold():
+    return getattr(settings, 'DJANGO_MESSAGES_COMPRESS_THRESHOLD', 1024)
+
+
+def get_algorithm():
+    return getattr(settings, 'DJANGO_MESSAGES_COMPRESS_ALGORITHM', 'zlib')
+
+
+def is_compressed(value):
+    return isinstance(value, six.string_types) and (
+        value.startswith(ZLIB_PREFIX) or value.startswith(ZSTD_PREFIX))
+
+
+def escape(text):
+    """returns the stored form of uncompressed text"""
+    if isinstance(text, EncodedText) or not text or not text.startswith(MARKER):
+        return text
+    return EncodedText(PLAIN_PREFIX + text)
+
+
+def compress(text, threshold=None):
+    """
+    Returns the stored form of ``text``: compressed if it is at least
+    ``threshold`` characters long and compressing it saves space, otherwise
+    the (escaped) text itself.
+    """
+    if threshold is None:
+        threshold = get_threshold()
+    if not text or isinstance(text, EncodedText) or len(text) < threshold:
+        return escape(text)
+    data = text.encode('utf-8')
+    if get_algorithm() == 'zstd' and zstandard is not None:
+        prefix = ZSTD_PREFIX
+        data = zstandard.ZstdCompressor().compress(data)
+    else:
+        prefix = ZLIB_PREFIX
+        data = zlib.compress(data)
+    compressed = prefix + base64.b64encode(data).decode('ascii')
+    if len(compressed) >= len(text):
+        return escape(text)
+    return EncodedText(compressed)
+
+
+def decompress(value):
+    """
+    Returns the original text of a value returned by ``compress``. Plain
+    text is returned unchanged, and so are values which can't be decoded.
+    """
+    if not isinstance(value, six.string_types) or not value.startswith(MARKER):
+        return value
+    if value.startswith(PLAIN_PREFIX):
+        return value[len(PLAIN_PREFIX):]
+    if not is_compressed(value):
+        return value
+    if value.startswith(ZSTD_PREFIX) and zstandard is None:
+        logger.error('Cannot decompress a zstd compressed body, '
+                     'the zstandard package is not installed')
+        return value
+    try:
+        data = base64.b64decode(value[len(ZLIB_PREFIX):].encode('ascii'))
+        if value.startswith(ZSTD_PREFIX):
+            data = zstandard.ZstdDecompressor().decompress(data)
+        else:
+            data = zlib.decompress(data)
+        return data.decode('utf-8')
+    except DECODE_ERRORS:
+        logger.warning('Cannot decompress a body, returning it unchanged', exc_info=True)
+        return value
+
+
+class CompressedTextDescriptor(object):
+    """
+    Keeps the value as loaded from the database and decompresses it on
+    first access.
+    """
+    def __init__(self, field):
+        self.field = field
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        attname = self.field.attname
+        if attname not in instance.__dict__:
+            instance.refresh_from_db(fields=[attname])
+        value = instance.__dict__[attname]
+        if isinstance(value, six.string_types) and value.startswith(MARKER):
+            value = instance.__dict__[attname] = decompress(value)
+        return value
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.field.attname] = value
+
+
+class CompressedTextField(models.TextField):
+    """
+    A ``TextField`` which compresses large values on save, see the module
+    docstring. Note that ``values()`` and ``values_list()`` return the stored
+    form, use ``decompress`` on those.
+    """
+    def contribute_to_class(self, cls, name, *args, **kwargs):
+        super(CompressedTextField, self).contribute_to_class(cls, name, *args, **kwargs)
+        setattr(cls, self.attname, CompressedTextDescriptor(self))
+
+    def get_db_prep_save(self, value, connection):
+        value = super(CompressedTextField, self).get_db_prep_save(value, connection)
+        if value is None:
+            return value
+        if is_enabled():
+            return compress(value)
+        return escape(value)
@@ -1,7 +1,21 @@
-from django_messages.models import inbox_count_for
+from django.utils.functional import SimpleLazyObject
+
+from django_messages.models import Message, inbox_count_for
 
 def inbox(request):
     if request.user.is_authenticated():
         return {'messages_inbox_count': inbox_count_for(request.user)}
     else:
         return {}
+
+def folder_counts(request):
+    """
+    Adds ``messages_folder_counts`` (see ``MessageManager.folder_counts``),
+    which is only computed when a template uses it.
+    """
+    if request.user.is_authenticated():
+        user = request.user
+        return {'messages_folder_counts': SimpleLazyObject(
+            lambda: Message.objects.folder_counts(user))}
+    else:
+        return {}
@@ -0,0 +1,49 @@
+"""
+Expiring messages.
+
+A message with ``expires_at`` set disappears from the folders, counts and
+views of both users at that time (see ``models.unexpired``). The
+``delete_expired_messages`` command deletes expired messages for good, in
+small transactions, so they don't stay in the tables and indexes.
+"""
+from django.db import transaction
+from django.utils import timezone
+
+from django_messages.caching import bump_mailbox_versions
+from django_messages.changes import record_purged
+from django_messages.index import unindex
+from django_messages.models import Message
+from django_messages import quotas
+from django_messages.sharding import get_databases
+
+
+def delete_expired(batch_size=500, max_batches=None, now=None):
+    """
+    Deletes messages whose ``expires_at`` has passed, ``batch_size``
+    messages per transaction and at most ``max_batches`` batches per
+    database. Returns the number of deleted messages.
+    """
+    now = now or timezone.now()
+    deleted = 0
+    for using in get_databases(Message):
+        messages = Message.objects.using(using)
+        expired = messages.filter(expires_at__lte=now).order_by('expires_at')
+        batches = 0
+        while max_batches is None or batches < max_batches:
+            batch = list(expired.values_list('pk', 'sender', 'recipient')[:batch_size])
+            if not batch:
+                break
+            pks = [row[0] for row in batch]
+            recipients = set(row[2] for row in batch) - set([None])
+            with transaction.atomic(using=using):
+                # replies outlive the messages they answer
+                messages.filter(parent_msg__in=pks).update(parent_msg=None)
+                record_purged(batch, using)
+                messages.filter(pk__in=pks).delete()
+            unindex(batch, using)
+            bump_mailbox_versions(*[user_id for row in batch for user_id in row[1:]])
+            if quotas.is_enabled() and recipients:
+                quotas.recount(recipients)
+            deleted += len(batch)
+            batches += 1
+    return deleted
@@ -0,0 +1,129 @@
+"""
+Streaming export of a user's mailbox as JSON lines or mbox.
+
+Messages are read in primary key order in chunks of ``chunk_size`` rows, so
+memory use doesn't depend on the size of the mailbox. Archived messages are
+exported together with the others.
+"""
+import calendar
+import heapq
+import json
+import time
+from email.utils import formatdate
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+
+from django_messages.models import ArchivedMessage, Message, unexpired
+from django_messages.utils import get_username_field
+
+FORMATS = {
+    'jsonl': 'application/x-ndjson',
+    'mbox': 'application/mbox',
+}
+
+
+def _iter_table(model, user, chunk_size):
+    queryset = model.objects.for_user(user).filter(
+        Q(recipient=user) | Q(sender=user), unexpired(),
+    ).select_related('sender', 'recipient').order_by('pk')
+    last_pk = 0
+    while True:
+        chunk = list(queryset.filter(pk__gt=last_pk)[:chunk_size])
+        if not chunk:
+            break
+        for message in chunk:
+            yield message.pk, message
+        last_pk = chunk[-1].pk
+
+
+def iter_mailbox(user, chunk_size=500):
+    """
+    Yields all messages sent or received by the given user, including the
+    trash and the archive but not expired messages, ordered by primary key.
+    """
+    # archived messages keep their ids, so both tables merge into one order
+    for pk, message in heapq.merge(_iter_table(Message, user, chunk_size),
+                                   _iter_table(ArchivedMessage, user, chunk_size)):
+        yield message
+
+
+def get_folders(message, user):
+    """returns the folders of the user the message appears in"""
+    folders = []
+    if message.recipient_id == user.pk and message.recipient_deleted_at is None:
+        folders.append('inbox')
+    if message.sender_id == user.pk and message.sender_deleted_at is None:
+        folders.append('outbox')
+    if ((message.recipient_id == user.pk and message.recipient_deleted_at is not None) or
+            (message.sender_id == user.pk and message.sender_deleted_at is not None)):
+        folders.append('trash')
+    return folders
+
+
+def _username(user):
+    if user is None:
+        return None
+    return getattr(user, get_username_field())
+
+
+def export_jsonl(user, chunk_size=500):
+    """yields one JSON document per message"""
+    for message in iter_mailbox(user, chunk_size):
+        yield json.dumps({
+            'id': message.pk,
+            'parent_id': message.parent_msg_id,
+            'folders': get_folders(message, user),
+            'sender': _username(message.sender),
+            'recipient': _username(message.recipient),
+            'subject': message.subject,
+            'body': message.body,
+            'sent_at': message.sent_at,
+            'read_at': message.read_at,
+            'replied_at': message.replied_at,
+            'sender_deleted_at': message.sender_deleted_at,
+            'recipient_deleted_at': message.recipient_deleted_at,
+            'expires_at': message.expires_at if message.expires() else None,
+        }, cls=DjangoJSONEncoder) + '\n'
+
+
+def _message_id(pk):
+    return '<%s@django-messages>' % pk
+
+
+def _mbox_date(value):
+    if value is None:
+        return formatdate()
+    return formatdate(calendar.timegm(value.utctimetuple()))
+
+
+def export_mbox(user, chunk_size=500):
+    """yields one mbox entry per message"""
+    for message in iter_mailbox(user, chunk_size):
+        sender = _username(message.sender)
+        headers = [
+            'From %s %s' % (sender, time.asctime(
+                message.sent_at.utctimetuple() if message.sent_at else time.gmtime())),
+            'From: %s' % sender,
+            'To: %s' % (_username(message.recipient) or ''),
+            'Subject: %s' % message.subject,
+            'Date: %s' % _mbox_date(message.sent_at),
+            'Message-ID: %s' % _message_id(message.pk),
+            'X-Folders: %s' % ', '.join(get_folders(message, user)),
+        ]
+        if message.parent_msg_id is not None:
+            headers.append('In-Reply-To: %s' % _message_id(message.parent_msg_id))
+        # mboxrd quoting of lines which look like the start of a message
+        lines = []
+        for line in message.body.splitlines():
+            if line.lstrip('>').startswith('From '):
+                line = '>' + line
+            lines.append(line)
+        yield '\n'.join(headers) + '\n\n' + '\n'.join(lines) + '\n\n'
+
+
+def export_mailbox(user, format='jsonl', chunk_size=500):
+    """returns an iterator over the exported mailbox in the given format"""
+    if format == 'mbox':
+        return export_mbox(user, chunk_size)
+    return export_jsonl(user, chunk_size)
@@ -1,15 +1,21 @@
+import time
+
 from django import forms
-from django.conf import settings
+from django.db import router, transaction
 from django.utils.translation import ugettext_lazy as _
 from django.utils import timezone
 
-if "notification" in settings.INSTALLED_APPS and getattr(settings, 'DJANGO_MESSAGES_NOTIFY', True):
-    from notification import models as notification
-else:
-    notification = None
-
-from django_messages.models import Message
+from django_messages.attachments import (attach, get_max_size as get_max_attachment_size,
+    is_enabled as attachments_enabled, store_blob)
+from django_messages.caching import bump_mailbox_versions
+from django_messages.changes import record_change, record_changes
+from django_messages.models import Message, MessageChange
 from django_messages.fields import CommaSeparatedUserField
+from django_messages import idempotency
+from django_messages.instrumentation import instrumented
+from django_messages import ratelimit
+from django_messages.sharding import group_by_shard, shard_for_user
+from django_messages.utils import get_notification
 
 class ComposeForm(forms.Form):
     """
@@ -23,34 +29,172 @@ class ComposeForm(forms.Form):
         
     def __init__(self, *args, **kwargs):
         recipient_filter = kwargs.pop('recipient_filter', None)
+        self.sender = kwargs.pop('sender', None)
+        # the recipients and time counted against the flood control limits
+        self.rate_limit_consumed = None
         super(ComposeForm, self).__init__(*args, **kwargs)
         if recipient_filter is not None:
             self.fields['recipient']._recipient_filter = recipient_filter
-    
-                
-    def save(self, sender, parent_msg=None):
+        if attachments_enabled():
+            self.fields['attachment'] = forms.FileField(label=_(u"Attachment"), required=False)
+        if idempotency.is_enabled():
+            self.fields[idempotency.FIELD_NAME] = forms.CharField(required=False,
+                max_length=idempotency.MAX_LENGTH, initial=idempotency.new_key(),
+                widget=forms.HiddenInput)
+
+    def clean_attachment(self):
+        attachment = self.cleaned_data.get('attachment')
+        if attachment is not None and attachment.size > get_max_attachment_size():
+            raise forms.ValidationError(_(u"The attachment is too large."))
+        return attachment
+
+    def clean(self):
+        cleaned_data = super(ComposeForm, self).clean()
+        self.rate_limited = False
+        if self.sender is None or self._errors:
+            return cleaned_data
+        state = self.get_key_state()
+        if state == idempotency.PENDING:
+            raise forms.ValidationError(
+                _(u"This message is still being sent. Please try again in a moment."))
+        if state is None:
+            recipients = cleaned_data.get('recipient') or []
+            now = time.time()
+            if ratelimit.consume(self.sender, len(recipients), now):
+                # refunded by ``save`` if sending fails
+                self.rate_limit_consumed = (len(recipients), now)
+            else:
+                self.rate_limited = True
+                raise forms.ValidationError(
+                    _(u"You have sent too many messages. Please try again later."))
+        return cleaned_data
+
+    def get_key_state(self):
+        """returns the state of the idempotency key the form was submitted with"""
+        key = self.cleaned_data.get(idempotency.FIELD_NAME)
+        return idempotency.get_state(self.sender, key) if key else None
+
+    def refund_rate_limit(self):
+        """takes back what ``clean`` counted against the flood control limits"""
+        if self.rate_limit_consumed is not None:
+            recipients, now = self.rate_limit_consumed
+            self.rate_limit_consumed = None
+            ratelimit.refund(self.sender, recipients, now)
+
+    @instrumented('forms.compose.save', rows=len)
+    def save(self, sender, parent_msg=None, expires_at=None):
+        """
+        Sends the message to all recipients and returns the created messages.
+        If the key of the form was used before, nothing is sent and the
+        messages of the first submission are returned. Messages which
+        weren't sent don't count against the flood control limits.
+        """
+        key = self.cleaned_data.get(idempotency.FIELD_NAME)
+        sent = []
+        def send():
+            sent.extend(self.send(sender, parent_msg, expires_at))
+            return [(m._state.db, m.pk) for m in sent]
+        try:
+            if not key:
+                return self.send(sender, parent_msg, expires_at)
+            message_ids, created = idempotency.send_once(sender, key, send)
+        except Exception:
+            self.refund_rate_limit()
+            raise
+        if not created:
+            # a concurrent submission with the same key sent them
+            self.refund_rate_limit()
+            return idempotency.get_messages(message_ids)
+        return sent
+
+    def send(self, sender, parent_msg=None, expires_at=None):
         recipients = self.cleaned_data['recipient']
         subject = self.cleaned_data['subject']
         body = self.cleaned_data['body']
         message_list = []
-        for r in recipients:
-            msg = Message(
-                sender = sender,
-                recipient = r,
-                subject = subject,
-                body = body,
-            )
-            if parent_msg is not None:
-                msg.parent_msg = parent_msg
-                parent_msg.replied_at = timezone.now()
-                parent_msg.save()
-            msg.save()
-            message_list.append(msg)
-            if notification:
-                if parent_msg is not None:
-                    notification.send([sender], "messages_replied", {'message': msg,})
-                    notification.send([r], "messages_reply_received", {'message': msg,})
-                else:
-                    notification.send([sender], "messages_sent", {'message': msg,})
-                    notification.send([r], "messages_received", {'message': msg,})
+        notification = get_notification()
+        sender_shard = shard_for_user(sender)
+        groups = group_by_shard(recipients)
+        attachment = self.cleaned_data.get('attachment')
+        blobs = {}
+        if attachment is not None:
+            # the file is stored once per database, before the messages
+            # which refer to it
+            for using in set([using for using, shard_recipients in groups] + [sender_shard]):
+                using = using or router.db_for_write(Message)
+                blobs[using] = store_blob(attachment, using)
+        # with sharding every shard gets its messages in one transaction
+        for using, shard_recipients in groups:
+            with transaction.atomic(using=using):
+                sent, copies = [], []
+                for r in shard_recipients:
+                    msg = Message(
+                        sender = sender,
+                        recipient = r,
+                        subject = subject,
+                        body = body,
+                        expires_at = expires_at,
+                    )
+                    if using != sender_shard:
+                        # the sender's copy of the message is stored below
+                        msg.sender_deleted_at = timezone.now()
+                    if parent_msg is not None:
+                        if using is None or parent_msg._state.db == using:
+                            msg.parent_msg = parent_msg
+                    msg.save(using=using)
+                    sent.append(msg)
+                    if using != sender_shard:
+                        copy = self.save_sender_copy(msg, sender_shard, parent_msg)
+                        copies.append(copy)
+                        record_changes([(r.pk, msg.pk, MessageChange.CREATED),
+                                        (sender.pk, copy.pk, MessageChange.CREATED)])
+                    else:
+                        record_change(msg, MessageChange.CREATED)
+                if attachment is not None:
+                    attach(sent + copies, attachment, blobs)
+                message_list.extend(sent)
+                if notification:
+                    for msg in sent:
+                        if parent_msg is not None:
+                            notification.send([sender], "messages_replied", {'message': msg,})
+                            notification.send([msg.recipient], "messages_reply_received", {'message': msg,})
+                        else:
+                            notification.send([sender], "messages_sent", {'message': msg,})
+                            notification.send([msg.recipient], "messages_received", {'message': msg,})
+        if parent_msg is not None:
+            # only update the column, the parent may be changed concurrently
+            parent_msg.replied_at = timezone.now()
+            Message.objects.for_user(sender).filter(pk=parent_msg.pk).update(
+                replied_at=parent_msg.replied_at)
+            bump_mailbox_versions(parent_msg.sender_id, parent_msg.recipient_id)
+            record_change(parent_msg, MessageChange.REPLIED)
         return message_list
+
+    def save_sender_copy(self, msg, using, parent_msg=None):
+        """
+        Stores the sender's copy of a message whose recipient lives on
+        another shard.
+        """
+        return save_sender_copy(msg, using, parent_msg)
+
+
+def save_sender_copy(msg, using, parent_msg=None):
+    """
+    Stores the sender's copy of a message whose recipient lives on another
+    shard on the sender's shard ``using``. Used by ``ComposeForm`` and the
+    admin.
+    """
+    copy = Message(
+        sender = msg.sender,
+        recipient = msg.recipient,
+        subject = msg.subject,
+        body = msg.body,
+        recipient_deleted_at = msg.sent_at,
+        expires_at = msg.expires_at,
+    )
+    if parent_msg is not None and parent_msg._state.db == using:
+        copy.parent_msg = parent_msg
+    # tells post_save handlers not to notify the recipient again
+    copy.is_sender_copy = True
+    copy.save(using=using)
+    return copy
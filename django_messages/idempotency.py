@@ -0,0 +1,211 @@
+"""
+Idempotency keys for composing and broadcasting messages.
+
+With ``DJANGO_MESSAGES_IDEMPOTENCY_KEYS = True`` ``ComposeForm`` and the
+admin form embed a random key in a hidden field, and clients may send their
+own in an ``Idempotency-Key`` header. The first request with a key claims it
+and stores the ids of the messages it created; a retry with the same key
+creates nothing and gets those messages instead. Keys can be reused after
+``DJANGO_MESSAGES_IDEMPOTENCY_WINDOW`` seconds (default: one day) and are
+deleted by the ``delete_expired_idempotency_keys`` command.
+
+Without sharding a key is claimed in the transaction which creates the
+messages, so a request which dies half way leaves neither messages nor a
+claimed key behind. With sharding the messages are spread over several
+databases and the key is claimed up front; a claim which didn't get its
+messages within ``DJANGO_MESSAGES_IDEMPOTENCY_PENDING_TIMEOUT`` seconds
+(default: 60) is considered abandoned and the next retry sends again.
+"""
+import datetime
+import json
+import uuid
+
+from django.conf import settings
+from django.db import IntegrityError, router, transaction
+from django.utils import timezone
+
+from django_messages.models import IdempotencyKey, Message
+from django_messages.sharding import get_databases, is_enabled as sharding_enabled, shard_for_user
+
+FIELD_NAME = 'idempotency_key'
+HEADER = 'HTTP_IDEMPOTENCY_KEY'
+MAX_LENGTH = 64
+
+# states of a key, see ``get_state``
+PENDING = 'pending'
+DONE = 'done'
+
+
+def is_enabled():
+    return getattr(settings, 'DJANGO_MESSAGES_IDEMPOTENCY_KEYS', False)
+
+
+def get_window():
+    return getattr(settings, 'DJANGO_MESSAGES_IDEMPOTENCY_WINDOW', 60 * 60 * 24)
+
+
+def get_pending_timeout():
+    return getattr(settings, 'DJANGO_MESSAGES_IDEMPOTENCY_PENDING_TIMEOUT', 60)
+
+
+def new_key():
+    return uuid.uuid4().hex
+
+
+def _cutoff():
+    return timezone.now() - datetime.timedelta(seconds=get_window())
+
+
+def _keys(user):
+    """returns the keys on the primary database holding the user's messages"""
+    using = shard_for_user(user) or router.db_for_write(IdempotencyKey)
+    return IdempotencyKey.objects.using(using)
+
+
+def request_data(request):
+    """
+    returns the POST data of the request, with the key of an
+    ``Idempotency-Key`` header replacing the one of the form
+    """
+    key = request.META.get(HEADER)
+    if not key or not is_enabled():
+        return request.POST
+    data = request.POST.copy()
+    data[FIELD_NAME] = key[:MAX_LENGTH]
+    return data
+
+
+def is_abandoned(record):
+    """returns whether the request which claimed the key died before sending"""
+    pending_since = timezone.now() - datetime.timedelta(seconds=get_pending_timeout())
+    return not record.messages and record.created_at <= pending_since
+
+
+def get_state(user, key):
+    """
+    Returns ``DONE`` if a request of the user sent its messages with the
+    key, ``PENDING`` while such a request is running and ``None`` if the key
+    can be used.
+    """
+    try:
+        record = _keys(user).get(user=user, key=key, created_at__gt=_cutoff())
+    except IdempotencyKey.DoesNotExist:
+        return None
+    if record.messages:
+        return DONE
+    return None if is_abandoned(record) else PENDING
+
+
+def claim(user, key):
+    """
+    Claims the key for a request of the user. Returns the new record and
+    ``True``, or the record of the request which claimed the key first and
+    ``False``. That record is ``None`` if it couldn't be read. Expired and
+    abandoned claims are taken over.
+    """
+    keys = _keys(user)
+    for attempt in range(3):
+        try:
+            with transaction.atomic(using=keys.db):
+                return keys.create(user=user, key=key), True
+        except IntegrityError:
+            pass
+        try:
+            record = keys.get(user=user, key=key)
+        except IdempotencyKey.DoesNotExist:
+            # released or expired in the meantime
+            continue
+        if record.created_at <= _cutoff():
+            keys.filter(pk=record.pk, created_at__lte=_cutoff()).delete()
+        elif is_abandoned(record):
+            # only one of several retries takes over the claim
+            if keys.filter(pk=record.pk, messages='', created_at=record.created_at).update(
+                    created_at=timezone.now()):
+                return keys.get(pk=record.pk), True
+        else:
+            return record, False
+    return None, False
+
+
+def complete(record, message_ids):
+    """
+    Stores the messages created for the key, given as ``(database, id)``
+    pairs.
+    """
+    record.messages = json.dumps([list(pair) for pair in message_ids])
+    record.save(update_fields=['messages'])
+
+
+def release(record):
+    """frees the key of a request which failed, so it can be retried"""
+    record.delete()
+
+
+def send_once(user, key, send):
+    """
+    Calls ``send``, which returns the ``(database, id)`` pairs of the
+    messages it created, unless a request of the user already used the key.
+    Returns the pairs and ``True``, or the pairs of the first request and
+    ``False``; those are ``None`` while the first request is still running.
+    """
+    if sharding_enabled():
+        record, created = claim(user, key)
+        if not created:
+            return get_message_ids(record), False
+        try:
+            message_ids = send()
+        except Exception:
+            release(record)
+            raise
+        complete(record, message_ids)
+        return message_ids, True
+    # the claim is rolled back together with the messages
+    with transaction.atomic(using=_keys(user).db):
+        record, created = claim(user, key)
+        if not created:
+            return get_message_ids(record), False
+        message_ids = send()
+        complete(record, message_ids)
+    return message_ids, True
+
+
+def get_message_ids(record):
+    """
+    returns the ``(database, id)`` pairs of the messages of a claimed key,
+    or ``None`` if they weren't sent yet
+    """
+    if record is None or not record.messages:
+        return None
+    return [tuple(pair) for pair in json.loads(record.messages)]
+
+
+def get_messages(message_ids):
+    """returns the messages of a list of ``(database, id)`` pairs"""
+    pairs = message_ids or []
+    by_database = {}
+    for using, pk in pairs:
+        by_database.setdefault(using, []).append(pk)
+    messages = {}
+    for using, pks in by_database.items():
+        for pk, message in Message.objects.using(using).in_bulk(pks).items():
+            messages[using, pk] = message
+    return [messages[using, pk] for using, pk in pairs if (using, pk) in messages]
+
+
+def delete_expired(batch_size=1000):
+    """
+    Deletes keys older than the window, ``batch_size`` keys per query.
+    Returns the number of deleted keys.
+    """
+    cutoff = _cutoff()
+    deleted = 0
+    for using in get_databases(IdempotencyKey):
+        keys = IdempotencyKey.objects.using(using)
+        while True:
+            pks = list(keys.filter(created_at__lte=cutoff).order_by('created_at')
+                       .values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                break
+            keys.filter(pk__in=pks).delete()
+            deleted += len(pks)
+    return deleted
@@ -0,0 +1,288 @@
+"""
+Mailbox indexes.
+
+A mailbox index keeps the ids of every folder of a user as a sorted set,
+scored by ``sent_at``, so a page of a folder is read from the index and the
+messages are loaded by primary key instead of sorting the folder in the
+database. Set ``DJANGO_MESSAGES_INDEX_BACKEND`` to the dotted path of an
+index class, e.g. ``django_messages.index.RedisIndex``, and build the index
+with the ``rebuild_mailbox_index`` command; ``MessageManager.page_for`` then
+uses it for every user whose index is built. The index is updated when
+messages are saved, deleted, recovered and purged.
+"""
+import calendar
+import threading
+from importlib import import_module
+
+from django.conf import settings
+
+from django_messages.sharding import is_enabled as sharding_enabled, shard_for_user
+
+FOLDERS = ('inbox', 'outbox', 'trash')
+
+_index_cache = {}
+
+
+def get_index():
+    """
+    Returns the index configured in ``DJANGO_MESSAGES_INDEX_BACKEND``, or
+    ``None``.
+    """
+    path = getattr(settings, 'DJANGO_MESSAGES_INDEX_BACKEND', None)
+    if path is None:
+        return None
+    if path not in _index_cache:
+        module_name, class_name = path.rsplit('.', 1)
+        _index_cache[path] = getattr(import_module(module_name), class_name)()
+    return _index_cache[path]
+
+
+class MailboxIndex(object):
+    """
+    Interface of mailbox indexes. A user's index is only used once it was
+    built with ``rebuild``; until then ``page`` returns ``None``.
+    """
+    def add(self, user_id, folder, message_id, score):
+        raise NotImplementedError
+
+    def remove(self, user_id, folder, message_id):
+        raise NotImplementedError
+
+    def page(self, user_id, folder, offset, limit):
+        """
+        returns the ids of the messages ``offset`` to ``offset + limit`` of
+        the folder, newest first, or ``None`` if the index isn't built
+        """
+        raise NotImplementedError
+
+    def count(self, user_id, folder):
+        raise NotImplementedError
+
+    def is_built(self, user_id):
+        raise NotImplementedError
+
+    def set_built(self, user_id, built=True):
+        raise NotImplementedError
+
+    def clear(self, user_id):
+        raise NotImplementedError
+
+
+class MemoryIndex(MailboxIndex):
+    """
+    Keeps the index in the memory of the process. Useful for tests and
+    single process deployments.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sets = {}
+        self._built = set()
+
+    def add(self, user_id, folder, message_id, score):
+        with self._lock:
+            self._sets.setdefault((user_id, folder), {})[message_id] = score
+
+    def remove(self, user_id, folder, message_id):
+        with self._lock:
+            self._sets.get((user_id, folder), {}).pop(message_id, None)
+
+    def page(self, user_id, folder, offset, limit):
+        with self._lock:
+            if user_id not in self._built:
+                return None
+            members = list(self._sets.get((user_id, folder), {}).items())
+        members.sort(key=lambda member: (member[1], member[0]), reverse=True)
+        return [message_id for message_id, score in members[offset:offset + limit]]
+
+    def count(self, user_id, folder):
+        with self._lock:
+            return len(self._sets.get((user_id, folder), {}))
+
+    def is_built(self, user_id):
+        with self._lock:
+            return user_id in self._built
+
+    def set_built(self, user_id, built=True):
+        with self._lock:
+            if built:
+                self._built.add(user_id)
+            else:
+                self._built.discard(user_id)
+
+    def clear(self, user_id):
+        with self._lock:
+            for folder in FOLDERS:
+                self._sets.pop((user_id, folder), None)
+            self._built.discard(user_id)
+
+
+class RedisIndex(MailboxIndex):
+    """
+    Keeps the index in Redis sorted sets, one per user and folder. Uses a
+    client for ``DJANGO_MESSAGES_INDEX_REDIS_URL`` unless one is passed in;
+    any client with ``execute_command`` works.
+    """
+    prefix = 'django_messages:index'
+
+    def __init__(self, client=None):
+        if client is None:
+            import redis
+            client = redis.StrictRedis.from_url(getattr(settings,
+                'DJANGO_MESSAGES_INDEX_REDIS_URL', 'redis://localhost:6379/0'))
+        self.client = client
+
+    def key(self, user_id, folder):
+        return '%s:%s:%s' % (self.prefix, user_id, folder)
+
+    def add(self, user_id, folder, message_id, score):
+        self.client.execute_command('ZADD', self.key(user_id, folder), score, message_id)
+
+    def remove(self, user_id, folder, message_id):
+        self.client.execute_command('ZREM', self.key(user_id, folder), message_id)
+
+    def page(self, user_id, folder, offset, limit):
+        if not self.is_built(user_id):
+            return None
+        ids = self.client.execute_command('ZREVRANGE', self.key(user_id, folder),
+                                          offset, offset + limit - 1)
+        return [int(message_id) for message_id in ids]
+
+    def count(self, user_id, folder):
+        return int(self.client.execute_command('ZCARD', self.key(user_id, folder)))
+
+    def is_built(self, user_id):
+        return bool(self.client.execute_command('EXISTS', self.key(user_id, 'built')))
+
+    def set_built(self, user_id, built=True):
+        if built:
+            self.client.execute_command('SET', self.key(user_id, 'built'), 1)
+        else:
+            self.client.execute_command('DEL', self.key(user_id, 'built'))
+
+    def clear(self, user_id):
+        self.client.execute_command('DEL', self.key(user_id, 'built'),
+            *[self.key(user_id, folder) for folder in FOLDERS])
+
+
+def score(sent_at):
+    return calendar.timegm(sent_at.utctimetuple()) + sent_at.microsecond / 1e6
+
+
+def get_folders(row):
+    """
+    Returns the ``(user_id, folder)`` pairs the message is listed in. ``row``
+    is a message or a dictionary of its fields.
+    """
+    get = row.get if isinstance(row, dict) else lambda name: getattr(row, name)
+    folders = []
+    if get('recipient_id') is not None:
+        folders.append((get('recipient_id'),
+                        'inbox' if get('recipient_deleted_at') is None else 'trash'))
+    folders.append((get('sender_id'),
+                    'outbox' if get('sender_deleted_at') is None else 'trash'))
+    return folders
+
+
+def _users(row, using):
+    """returns the users whose mailbox holds the message on ``using``"""
+    get = row.get if isinstance(row, dict) else lambda name: getattr(row, name)
+    users = set([get('sender_id'), get('recipient_id')]) - set([None])
+    if sharding_enabled():
+        users = set(user_id for user_id in users if shard_for_user(user_id) == using)
+    return users
+
+
+def index_message(message, using=None):
+    """
+    Updates the index for the current state of a message or of a
+    dictionary with its ``id``, ``sender_id``, ``recipient_id``,
+    ``sent_at``, ``sender_deleted_at`` and ``recipient_deleted_at``.
+    """
+    index = get_index()
+    if index is None:
+        return
+    if isinstance(message, dict):
+        message_id, sent_at = message['id'], message['sent_at']
+    else:
+        message_id, sent_at = message.pk, message.sent_at
+        using = using or message._state.db
+    users = _users(message, using)
+    folders = set(pair for pair in get_folders(message) if pair[0] in users)
+    for user_id in users:
+        for folder in FOLDERS:
+            if (user_id, folder) in folders:
+                index.add(user_id, folder, message_id, score(sent_at))
+            else:
+                index.remove(user_id, folder, message_id)
+
+
+INDEX_FIELDS = ('id', 'sender', 'recipient', 'sent_at',
+                'sender_deleted_at', 'recipient_deleted_at')
+
+
+def _rows(queryset):
+    """yields the fields ``index_message`` needs as dictionaries"""
+    for values in queryset.values_list(*INDEX_FIELDS):
+        row = dict(zip(INDEX_FIELDS, values))
+        row['sender_id'] = row.pop('sender')
+        row['recipient_id'] = row.pop('recipient')
+        yield row
+
+
+def reindex(message_ids, using):
+    """updates the index for the messages with the given ids on ``using``"""
+    from django_messages.models import Message
+    if get_index() is None:
+        return
+    for row in _rows(Message.objects.using(using).filter(pk__in=list(message_ids))):
+        index_message(row, using)
+
+
+def unindex(rows, using=None):
+    """
+    Removes purged messages, given as ``(id, sender_id, recipient_id)``
+    tuples, from the index. With sharding the messages are only removed for
+    the users whose messages live on ``using``.
+    """
+    index = get_index()
+    if index is None:
+        return
+    for message_id, sender_id, recipient_id in rows:
+        users = set([sender_id, recipient_id]) - set([None])
+        if sharding_enabled() and using is not None:
+            users = set(user_id for user_id in users if shard_for_user(user_id) == using)
+        for user_id in users:
+            for folder in FOLDERS:
+                index.remove(user_id, folder, message_id)
+
+
+def rebuild(user, chunk_size=1000):
+    """
+    Builds the index of the user from the database. Returns the number of
+    indexed messages.
+    """
+    from django.db.models import Q
+    from django_messages.models import Message
+    index = get_index()
+    index.clear(user.pk)
+    messages = Message.objects.for_user(user).filter(
+        Q(sender=user) | Q(recipient=user)).order_by('pk')
+    last_pk = 0
+    indexed = 0
+    while True:
+        chunk = list(_rows(messages.filter(pk__gt=last_pk)[:chunk_size]))
+        if not chunk:
+            break
+        for row in chunk:
+            for user_id, folder in get_folders(row):
+                if user_id == user.pk:
+                    index.add(user_id, folder, row['id'], score(row['sent_at']))
+        indexed += len(chunk)
+        last_pk = chunk[-1]['id']
+    index.set_built(user.pk)
+    return indexed
+
+
+def message_saved(sender, instance, **kwargs):
+    """``post_save`` handler updating the index"""
+    index_message(instance)
@@ -0,0 +1,201 @@
+"""
+Lightweight timing hooks for mailbox operations.
+
+Instrumentation is disabled by default and costs a single settings lookup per
+operation. Set ``DJANGO_MESSAGES_INSTRUMENTATION = True`` to enable it; every
+instrumented operation then sends the ``operation_timed`` signal and is passed
+to the adapters listed in ``DJANGO_MESSAGES_INSTRUMENTATION_ADAPTERS``.
+"""
+import logging
+import time
+from functools import wraps
+from importlib import import_module
+
+from django.conf import settings
+from django.db import connections
+
+from django_messages.signals import operation_timed
+
+logger = logging.getLogger('django_messages.instrumentation')
+
+_adapter_cache = {}
+
+
+def is_enabled():
+    return getattr(settings, 'DJANGO_MESSAGES_INSTRUMENTATION', False)
+
+
+def get_adapters():
+    """
+    Returns the adapter instances configured in
+    ``DJANGO_MESSAGES_INSTRUMENTATION_ADAPTERS``.
+    """
+    paths = tuple(getattr(settings, 'DJANGO_MESSAGES_INSTRUMENTATION_ADAPTERS', ()))
+    if paths not in _adapter_cache:
+        adapters = []
+        for path in paths:
+            module_name, class_name = path.rsplit('.', 1)
+            adapters.append(getattr(import_module(module_name), class_name)())
+        _adapter_cache[paths] = adapters
+    return _adapter_cache[paths]
+
+
+def _query_log(connection):
+    log = getattr(connection, 'queries_log', None)
+    if log is None:
+        log = connection.queries
+    return log
+
+
+class LoggingAdapter(object):
+    """
+    Writes every measurement to the ``django_messages.instrumentation``
+    logger.
+    """
+    level = logging.INFO
+
+    def record(self, timer):
+        logger.log(self.level, "%s took %.2fms, %d queries, %s rows",
+            timer.name, timer.duration * 1000, timer.queries, timer.rows)
+
+
+class StatsdAdapter(object):
+    """
+    Sends timings and counters to statsd. Uses ``statsd.StatsClient`` unless
+    a client is passed in.
+    """
+    prefix = 'django_messages'
+
+    def __init__(self, client=None):
+        if client is None:
+            import statsd
+            client = statsd.StatsClient()
+        self.client = client
+
+    def record(self, timer):
+        name = '%s.%s' % (self.prefix, timer.name)
+        self.client.timing(name, timer.duration * 1000)
+        self.client.incr('%s.queries' % name, timer.queries)
+        if timer.rows is not None:
+            self.client.incr('%s.rows' % name, timer.rows)
+
+
+class Timer(object):
+    """
+    Measures duration and number of queries of the wrapped block. Set
+    ``rows`` inside the block to report the number of affected rows.
+    """
+    enabled = True
+
+    def __init__(self, name, **tags):
+        self.name = name
+        self.tags = tags
+        self.rows = None
+        self.duration = None
+        self.queries = None
+
+    def __enter__(self):
+        self._connections = list(connections.all())
+        self._debug_cursors = []
+        for connection in self._connections:
+            self._debug_cursors.append(self._force_debug_cursor(connection, True))
+        self._query_counts = [len(_query_log(c)) for c in self._connections]
+        self._start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.duration = time.time() - self._start
+        self.queries = 0
+        for connection, count, debug in zip(self._connections,
+                self._query_counts, self._debug_cursors):
+            log = _query_log(connection)
+            self.queries += max(len(log) - count, 0)
+            self._force_debug_cursor(connection, debug)
+            if isinstance(log, list) and not (debug or (debug is None and settings.DEBUG)):
+                # before Django 1.8 the log isn't bounded, forget the
+                # queries which were only logged for counting
+                del log[count:]
+        if exc_type is None:
+            self.emit()
+        return False
+
+    def _force_debug_cursor(self, connection, value):
+        attr = 'force_debug_cursor'
+        if not hasattr(connection, attr):
+            attr = 'use_debug_cursor'
+        previous = getattr(connection, attr)
+        setattr(connection, attr, value)
+        return previous
+
+    def emit(self):
+        operation_timed.send(sender=self.name, name=self.name,
+            duration=self.duration, queries=self.queries, rows=self.rows,
+            tags=self.tags)
+        for adapter in get_adapters():
+            adapter.record(self)
+
+
+class NullTimer(object):
+    """
+    Stand-in for ``Timer`` when instrumentation is disabled.
+    """
+    enabled = False
+    rows = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+NULL_TIMER = NullTimer()
+
+
+def instrument(name, **tags):
+    """
+    Returns a context manager measuring the enclosed block::
+
+        with instrument('purge') as timer:
+            timer.rows = do_work()
+    """
+    if not is_enabled():
+        return NULL_TIMER
+    return Timer(name, **tags)
+
+
+def instrument_iterator(name, iterable, **tags):
+    """
+    Returns an iterator over ``iterable`` which measures the time and
+    queries until it is exhausted, e.g. the content of a streaming response.
+    ``rows`` is the number of items.
+    """
+    if not is_enabled():
+        return iterable
+    return _timed_iterator(Timer(name, **tags), iterable)
+
+
+def _timed_iterator(timer, iterable):
+    with timer:
+        timer.rows = 0
+        for item in iterable:
+            timer.rows += 1
+            yield item
+
+
+def instrumented(name, rows=None):
+    """
+    Decorator version of ``instrument``. ``rows`` is an optional callable
+    computing the number of affected rows from the return value.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not is_enabled():
+                return func(*args, **kwargs)
+            with Timer(name) as timer:
+                result = func(*args, **kwargs)
+                if rows is not None:
+                    timer.rows = rows(result)
+            return result
+        return wrapper
+    return decorator
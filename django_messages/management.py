@@ -1,18 +1,10 @@
-from django.db.models import get_models, signals
-from django.conf import settings
-from django.utils.translation import ugettext_noop as _
+import django
+from django.db.models import signals
 
-if "notification" in settings.INSTALLED_APPS and getattr(settings, 'DJANGO_MESSAGES_NOTIFY', True):
-    from notification import models as notification
+from django_messages.utils import create_notice_types, get_notification
 
-    def create_notice_types(app, created_models, verbosity, **kwargs):
-        notification.create_notice_type("messages_received", _("Message Received"), _("you have received a message"), default=2)
-        notification.create_notice_type("messages_sent", _("Message Sent"), _("you have sent a message"), default=1)
-        notification.create_notice_type("messages_replied", _("Message Replied"), _("you have replied to a message"), default=1)
-        notification.create_notice_type("messages_reply_received", _("Reply Received"), _("you have received a reply to a message"), default=2)
-        notification.create_notice_type("messages_deleted", _("Message Deleted"), _("you have deleted a message"), default=1)
-        notification.create_notice_type("messages_recovered", _("Message Recovered"), _("you have undeleted a message"), default=1)
-
-    signals.post_syncdb.connect(create_notice_types, sender=notification)
-else:
-    print("Skipping creation of NoticeTypes as notification app not found")
+# Django 1.7+ connects create_notice_types in DjangoMessagesConfig.ready()
+if django.VERSION[:2] < (1, 7):
+    notification = get_notification()
+    if notification is not None:
+        signals.post_syncdb.connect(create_notice_types, sender=notification)
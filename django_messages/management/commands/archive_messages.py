@@ -0,0 +1,78 @@
+import datetime
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+from ...caching import bump_mailbox_versions
+from ...changes import record_purged
+from ...index import unindex
+from ...models import (Message, ArchivedMessage, Attachment,
+    ArchivedAttachment, MessageChange)
+from ...instrumentation import instrument
+from ... import quotas
+from ...sharding import get_databases
+
+
+class Command(BaseCommand):
+    args = '<minimum age in days (e.g. 90)>'
+    help = (
+        'Moves messages older than the given number of days, and their '
+        'attachments, from the message tables to the archive tables, in '
+        'batches.'
+    )
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', action='store', dest='batch_size',
+            type='int', default=1000,
+            help='Number of messages moved per transaction.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('You must provide the minimum age in days.')
+
+        try:
+            age_in_days = int(args[0])
+        except ValueError:
+            raise CommandError('"%s" is not an integer.' % args[0])
+
+        the_date = timezone.now() - datetime.timedelta(days=age_in_days)
+        batch_size = options['batch_size']
+
+        total = 0
+        with instrument('commands.archive_messages') as timer:
+            for using in get_databases(Message):
+                while True:
+                    moved = self.archive_batch(the_date, batch_size, using)
+                    if not moved:
+                        break
+                    total += moved
+            timer.rows = total
+        if int(options.get('verbosity', 1)) > 0:
+            self.stdout.write('Archived %d messages.' % total)
+
+    def archive_batch(self, the_date, batch_size, using):
+        messages = Message.objects.using(using)
+        with transaction.atomic(using=using):
+            batch = list(messages.select_for_update().filter(
+                sent_at__lt=the_date,
+            ).order_by('pk')[:batch_size])
+            if not batch:
+                return 0
+            pks = [m.pk for m in batch]
+            ArchivedMessage.objects.using(using).bulk_create(
+                [ArchivedMessage.from_message(m) for m in batch])
+            attachments = Attachment.objects.using(using).filter(message__in=pks)
+            ArchivedAttachment.objects.using(using).bulk_create(
+                [ArchivedAttachment.from_attachment(a) for a in attachments])
+            attachments.delete()
+            rows = [(m.pk, m.sender_id, m.recipient_id) for m in batch]
+            record_purged(rows, using, MessageChange.ARCHIVED)
+            messages.filter(pk__in=pks).delete()
+        unindex(rows, using)
+        bump_mailbox_versions(*[user_id for m in batch
+                                for user_id in (m.sender_id, m.recipient_id)])
+        recipients = set(m.recipient_id for m in batch) - set([None])
+        if quotas.is_enabled() and recipients:
+            quotas.recount(recipients)
+        return len(batch)
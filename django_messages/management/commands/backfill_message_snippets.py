@@ -0,0 +1,40 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from ...models import Message
+from ...utils import make_snippet
+from ...compression import decompress
+from ...instrumentation import instrument
+
+
+class Command(BaseCommand):
+    help = (
+        'Fills in the snippet column for messages saved before it existed.'
+    )
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', action='store', dest='batch_size',
+            type='int', default=1000,
+            help='Number of messages updated per transaction.'),
+    )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        last_pk = 0
+        total = 0
+        with instrument('commands.backfill_message_snippets') as timer:
+            while True:
+                batch = list(Message.objects.filter(
+                    pk__gt=last_pk, snippet='',
+                ).order_by('pk').values_list('pk', 'body')[:batch_size])
+                if not batch:
+                    break
+                with transaction.atomic():
+                    for pk, body in batch:
+                        Message.objects.filter(pk=pk).update(
+                            snippet=make_snippet(decompress(body)))
+                last_pk = batch[-1][0]
+                total += len(batch)
+            timer.rows = total
+        if int(options.get('verbosity', 1)) > 0:
+            self.stdout.write('Updated %d messages.' % total)
@@ -0,0 +1,34 @@
+import datetime
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from ...changes import compact
+from ...instrumentation import instrument
+
+
+class Command(BaseCommand):
+    args = '<minimum age in days (e.g. 30)>'
+    help = (
+        'Deletes entries of the mailbox change log older than the given number '
+        'of days which were superseded by a newer entry for the same message. '
+        'Clients syncing from an older cursor still get the latest state.'
+    )
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', action='store', dest='batch_size',
+            type='int', default=1000,
+            help='Number of entries examined per query.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('You must provide the minimum age in days.')
+        try:
+            age_in_days = int(args[0])
+        except ValueError:
+            raise CommandError('"%s" is not an integer.' % args[0])
+
+        the_date = timezone.now() - datetime.timedelta(days=age_in_days)
+        with instrument('commands.compact_message_changes') as timer:
+            timer.rows = deleted = compact(the_date, options['batch_size'])
+        if int(options.get('verbosity', 1)) > 0:
+            self.stdout.write('Deleted %d change log entries.' % deleted)
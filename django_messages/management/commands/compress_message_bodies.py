@@ -0,0 +1,58 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from ...models import Message
+from ...compression import compress, decompress, get_threshold, is_compressed
+from ...instrumentation import instrument
+
+
+class Command(BaseCommand):
+    help = (
+        'Compresses the bodies of existing messages which are longer than '
+        'the compression threshold and reports the number of bytes saved.'
+    )
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', action='store', dest='batch_size',
+            type='int', default=1000,
+            help='Number of messages read per batch.'),
+        make_option('--threshold', action='store', dest='threshold',
+            type='int', default=None,
+            help='Minimum body length to compress, defaults to '
+                 'DJANGO_MESSAGES_COMPRESS_THRESHOLD.'),
+    )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        threshold = options['threshold']
+        if threshold is None:
+            threshold = get_threshold()
+
+        last_pk = 0
+        compressed_count = 0
+        bytes_before = bytes_after = 0
+        with instrument('commands.compress_message_bodies') as timer:
+            while True:
+                batch = list(Message.objects.filter(
+                    pk__gt=last_pk,
+                ).order_by('pk').values_list('pk', 'body')[:batch_size])
+                if not batch:
+                    break
+                with transaction.atomic():
+                    for pk, body in batch:
+                        if is_compressed(body):
+                            continue
+                        compressed = compress(decompress(body), threshold)
+                        if not is_compressed(compressed):
+                            continue
+                        Message.objects.filter(pk=pk).update(body=compressed)
+                        compressed_count += 1
+                        bytes_before += len(body.encode('utf-8'))
+                        bytes_after += len(compressed.encode('utf-8'))
+                last_pk = batch[-1][0]
+            timer.rows = compressed_count
+        if int(options.get('verbosity', 1)) > 0:
+            self.stdout.write(
+                'Compressed %d messages, %d bytes saved (%d -> %d).' % (
+                    compressed_count, bytes_before - bytes_after,
+                    bytes_before, bytes_after))
@@ -1,7 +1,12 @@
 import datetime
 from django.core.management.base import BaseCommand, CommandError
 from django.utils import timezone
+from django.db import transaction
+from ...changes import is_enabled as changes_enabled, record_purged
+from ...index import get_index, unindex
 from ...models import Message
+from ...instrumentation import instrument
+from ...sharding import get_databases
 
 
 class Command(BaseCommand):
@@ -26,7 +31,33 @@ class Command(BaseCommand):
 
         the_date = timezone.now() - datetime.timedelta(days=age_in_days)
 
-        Message.objects.filter(
-            recipient_deleted_at__lte=the_date,
-            sender_deleted_at__lte=the_date,
-        ).delete()
+        with instrument('commands.delete_deleted_messages') as timer:
+            for using in get_databases(Message):
+                messages = Message.objects.using(using).filter(
+                    recipient_deleted_at__lte=the_date,
+                    sender_deleted_at__lte=the_date,
+                )
+                if changes_enabled() or get_index() is not None:
+                    timer.rows = (timer.rows or 0) + self.purge(messages)
+                    continue
+                deleted = messages.delete()
+                if isinstance(deleted, tuple):
+                    timer.rows = (timer.rows or 0) + deleted[0]
+
+    def purge(self, messages, batch_size=1000):
+        """
+        Deletes the messages in batches, records them as purged in the
+        change log and removes them from the mailbox index.
+        """
+        purged = 0
+        while True:
+            batch = list(messages.order_by('pk').values_list(
+                'pk', 'sender', 'recipient')[:batch_size])
+            if not batch:
+                return purged
+            with transaction.atomic(using=messages.db):
+                if changes_enabled():
+                    record_purged(batch, messages.db)
+                messages.filter(pk__in=[row[0] for row in batch]).delete()
+            unindex(batch, messages.db)
+            purged += len(batch)
@@ -0,0 +1,22 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from ...idempotency import delete_expired
+from ...instrumentation import instrument
+
+
+class Command(BaseCommand):
+    help = (
+        'Deletes idempotency keys of compose and broadcast requests which are '
+        'older than DJANGO_MESSAGES_IDEMPOTENCY_WINDOW.'
+    )
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', action='store', dest='batch_size',
+            type='int', default=1000,
+            help='Number of keys deleted per query.'),
+    )
+
+    def handle(self, *args, **options):
+        with instrument('commands.delete_expired_idempotency_keys') as timer:
+            timer.rows = deleted = delete_expired(options['batch_size'])
+        if int(options.get('verbosity', 1)) > 0:
+            self.stdout.write('Deleted %d idempotency keys.' % deleted)
@@ -0,0 +1,26 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from ...expiry import delete_expired
+from ...instrumentation import instrument
+
+
+class Command(BaseCommand):
+    help = (
+        'Deletes messages whose expiry date has passed, in small batches. '
+        'Run it regularly, e.g. every few minutes from cron.'
+    )
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', action='store', dest='batch_size',
+            type='int', default=500,
+            help='Number of messages deleted per transaction.'),
+        make_option('--max-batches', action='store', dest='max_batches',
+            type='int', default=None,
+            help='Maximum number of batches per database, unlimited by default.'),
+    )
+
+    def handle(self, *args, **options):
+        with instrument('commands.delete_expired_messages') as timer:
+            timer.rows = deleted = delete_expired(options['batch_size'],
+                                                  options['max_batches'])
+        if int(options.get('verbosity', 1)) > 0:
+            self.stdout.write('Deleted %d expired messages.' % deleted)
@@ -0,0 +1,45 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from ...instrumentation import instrument
+from ...models import AttachmentBlob
+from ...sharding import get_databases
+
+
+class Command(BaseCommand):
+    help = (
+        'Deletes the stored content of attachments which no longer belong '
+        'to any message or archived message, e.g. after '
+        'delete_deleted_messages.'
+    )
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', action='store', dest='batch_size',
+            type='int', default=500,
+            help='Number of files deleted per query.'),
+    )
+
+    def handle(self, *args, **options):
+        deleted = 0
+        with instrument('commands.delete_orphaned_attachments') as timer:
+            for using in get_databases(AttachmentBlob):
+                orphans = AttachmentBlob.objects.using(using).filter(
+                    attachments__isnull=True, archived_attachments__isnull=True,
+                    ).order_by('pk')
+                last_pk = 0
+                while True:
+                    batch = list(orphans.filter(pk__gt=last_pk)[:options['batch_size']])
+                    if not batch:
+                        break
+                    last_pk = batch[-1].pk
+                    blobs = AttachmentBlob.objects.using(using).filter(
+                        pk__in=[blob.pk for blob in batch])
+                    blobs.filter(attachments__isnull=True,
+                                 archived_attachments__isnull=True).delete()
+                    # blobs attached again in the meantime are kept
+                    kept = set(blobs.values_list('pk', flat=True))
+                    for blob in batch:
+                        if blob.pk not in kept:
+                            blob.file.delete(save=False)
+                            deleted += 1
+            timer.rows = deleted
+        if int(options.get('verbosity', 1)) > 0:
+            self.stdout.write('Deleted %d orphaned attachment files.' % deleted)
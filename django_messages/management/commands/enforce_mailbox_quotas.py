@@ -0,0 +1,64 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from ...instrumentation import instrument
+from ... import quotas
+from ...utils import get_user_model
+
+
+class Command(BaseCommand):
+    help = (
+        'Moves the oldest inbox messages of users over their quota to the '
+        'trash and deletes trash older than DJANGO_MESSAGES_TRASH_RETENTION_DAYS. '
+        'Does a limited amount of work per run, so it can be run often.'
+    )
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', action='store', dest='batch_size',
+            type='int', default=500,
+            help='Number of messages handled per query.'),
+        make_option('--max-users', action='store', dest='max_users',
+            type='int', default=100,
+            help='Maximum number of users over quota handled per run.'),
+        make_option('--max-batches', action='store', dest='max_batches',
+            type='int', default=10,
+            help='Maximum number of trash batches deleted per database and run.'),
+        make_option('--recount', action='store_true', dest='recount',
+            default=False,
+            help='Recompute the usage counters of all users first.'),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        batch_size = options['batch_size']
+
+        if options['recount']:
+            with instrument('commands.enforce_mailbox_quotas.recount') as timer:
+                timer.rows = self.recount(batch_size)
+            if verbosity > 0:
+                self.stdout.write('Recounted the mailboxes of %d users.' % timer.rows)
+
+        trashed = 0
+        if quotas.is_enabled():
+            with instrument('commands.enforce_mailbox_quotas.trash') as timer:
+                for usage in quotas.over_quota(options['max_users']):
+                    trashed += quotas.enforce_quota(usage, batch_size)
+                timer.rows = trashed
+
+        with instrument('commands.enforce_mailbox_quotas.purge') as timer:
+            timer.rows = purged = quotas.purge_trash(batch_size, options['max_batches'])
+
+        if verbosity > 0:
+            self.stdout.write('Moved %d messages to the trash, deleted %d messages.' % (
+                trashed, purged))
+
+    def recount(self, batch_size):
+        users = get_user_model().objects.order_by('pk').values_list('pk', flat=True)
+        last_pk = None
+        total = 0
+        while True:
+            batch = users if last_pk is None else users.filter(pk__gt=last_pk)
+            user_ids = list(batch[:batch_size])
+            if not user_ids:
+                return total
+            quotas.recount(user_ids)
+            total += len(user_ids)
+            last_pk = user_ids[-1]
@@ -0,0 +1,51 @@
+import codecs
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from ...export import export_mailbox, FORMATS
+from ...instrumentation import instrument
+from ...utils import get_user_model, get_username_field
+
+
+class Command(BaseCommand):
+    args = '<username>'
+    help = (
+        'Exports all messages of a user (inbox, outbox and trash) as JSON '
+        'lines or mbox.'
+    )
+    option_list = BaseCommand.option_list + (
+        make_option('--format', action='store', dest='format',
+            default='jsonl', choices=sorted(FORMATS),
+            help='Export format, jsonl (default) or mbox.'),
+        make_option('--output', action='store', dest='output', default=None,
+            help='File to write to, defaults to stdout.'),
+        make_option('--chunk-size', action='store', dest='chunk_size',
+            type='int', default=500,
+            help='Number of messages read from the database at once.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('You must provide a username.')
+
+        User = get_user_model()
+        try:
+            user = User.objects.get(**{get_username_field(): args[0]})
+        except User.DoesNotExist:
+            raise CommandError('User "%s" does not exist.' % args[0])
+
+        if options['output']:
+            output = codecs.open(options['output'], 'w', encoding='utf-8')
+        else:
+            output = self.stdout
+        count = 0
+        try:
+            with instrument('commands.export_messages') as timer:
+                for chunk in export_mailbox(user, options['format'],
+                                            options['chunk_size']):
+                    output.write(chunk)
+                    count += 1
+                timer.rows = count
+        finally:
+            if options['output']:
+                output.close()
@@ -0,0 +1,22 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from ...instrumentation import instrument
+from ...receipts import flush
+
+
+class Command(BaseCommand):
+    help = (
+        'Writes the reads buffered in the cache (see '
+        'DJANGO_MESSAGES_BUFFER_READS) to the database.'
+    )
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', action='store', dest='batch_size',
+            type='int', default=500,
+            help='Maximum number of messages updated per query.'),
+    )
+
+    def handle(self, *args, **options):
+        with instrument('commands.flush_read_receipts') as timer:
+            timer.rows = updated = flush(options['batch_size'])
+        if int(options.get('verbosity', 1)) > 0:
+            self.stdout.write('Marked %d messages as read.' % updated)
@@ -0,0 +1,278 @@
+import csv
+import io
+import json
+import time
+from collections import OrderedDict
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import router, transaction
+from django.db.models import Max
+from django.utils import six, timezone
+from django.utils.dateparse import parse_datetime
+from ...caching import bump_mailbox_versions
+from ...changes import record_changes
+from ...index import reindex
+from ...models import Message, MessageChange, never
+from ...instrumentation import instrument
+from ... import quotas
+from ...sharding import is_enabled as sharding_enabled
+from ...utils import get_user_model, get_username_field, make_snippet
+
+DATE_FIELDS = ('sent_at', 'read_at', 'replied_at', 'sender_deleted_at',
+               'recipient_deleted_at')
+
+
+class UserCache(object):
+    """
+    Maps usernames to user ids, keeping at most ``size`` entries.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.ids = OrderedDict()
+        self.User = get_user_model()
+        self.username_field = get_username_field()
+
+    def resolve(self, usernames):
+        """
+        Looks up all usernames missing from the cache with one query and
+        returns a dictionary of the given usernames to ids.
+        """
+        missing = set(name for name in usernames if name not in self.ids)
+        if missing:
+            for name, pk in self.User.objects.filter(**{
+                    '%s__in' % self.username_field: missing
+                    }).values_list(self.username_field, 'pk'):
+                self.ids[name] = pk
+        result = {}
+        for name in usernames:
+            pk = self.ids.pop(name, None)
+            if pk is not None:
+                # re-insert to mark the entry as recently used
+                self.ids[name] = pk
+                result[name] = pk
+        while len(self.ids) > self.size:
+            self.ids.popitem(last=False)
+        return result
+
+
+class Command(BaseCommand):
+    args = '<file>'
+    help = (
+        'Imports messages from a JSON lines or CSV file (e.g. written by '
+        'export_messages) without sending notifications. Dates are kept as '
+        'they are. The messages get new ids; the ids of the file are only '
+        'used to link replies to parents in the same file. Quota counters, '
+        'the mailbox index and the change log are updated.'
+    )
+    option_list = BaseCommand.option_list + (
+        make_option('--format', action='store', dest='format',
+            default=None, choices=['jsonl', 'csv'],
+            help='File format, guessed from the file extension by default.'),
+        make_option('--batch-size', action='store', dest='batch_size',
+            type='int', default=1000,
+            help='Number of messages inserted per query.'),
+        make_option('--cache-size', action='store', dest='cache_size',
+            type='int', default=10000,
+            help='Maximum number of usernames kept in memory.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('You must provide the file to import.')
+        if sharding_enabled():
+            raise CommandError('Importing into sharded databases is not supported.')
+
+        self.path = args[0]
+        self.format = options['format']
+        if self.format is None:
+            self.format = 'csv' if self.path.endswith('.csv') else 'jsonl'
+        self.verbosity = int(options.get('verbosity', 1))
+        self.using = router.db_for_write(Message)
+        users = UserCache(options['cache_size'])
+        # ids of the file which replies refer to, mapped to the new ids
+        self.parent_ids = self.read_parent_ids()
+        self.new_ids = {}
+        # (new id, parent id of the file) of replies read before their parent
+        self.pending = []
+        self.duplicates = 0
+
+        start = time.time()
+        imported = skipped = 0
+        with instrument('commands.import_messages') as timer:
+            for batch in self.read_batches(options['batch_size']):
+                records, messages, batch_skipped = self.build_messages(batch, users)
+                skipped += batch_skipped
+                if not messages:
+                    continue
+                with transaction.atomic(using=self.using):
+                    self.insert(messages)
+                    self.map_ids(records, messages)
+                self.update_mailboxes(messages)
+                imported += len(messages)
+                if self.verbosity > 1:
+                    self.report(imported, start)
+            unresolved = self.link_parents()
+            timer.rows = imported
+
+        if self.verbosity > 0:
+            self.report(imported, start)
+            if skipped:
+                self.stdout.write('Skipped %d messages with unknown users.' % skipped)
+            if self.duplicates:
+                self.stdout.write('Found %d records with the id of an earlier record; '
+                                  'replies were linked to the first.' % self.duplicates)
+        if unresolved:
+            self.stderr.write('Imported %d replies without their parent, which '
+                              'was not imported.' % unresolved)
+
+    def report(self, imported, start):
+        duration = max(time.time() - start, 0.001)
+        self.stdout.write('Imported %d messages in %.1fs (%d rows/s).' % (
+            imported, duration, imported / duration))
+
+    def read_records(self):
+        if self.format == 'csv':
+            if six.PY2:
+                with open(self.path, 'rb') as f:
+                    for row in csv.DictReader(f):
+                        yield dict((k, v.decode('utf-8')) for k, v in row.items())
+            else:
+                with io.open(self.path, encoding='utf-8', newline='') as f:
+                    for row in csv.DictReader(f):
+                        yield row
+        else:
+            with io.open(self.path, encoding='utf-8') as f:
+                for line in f:
+                    if line.strip():
+                        yield json.loads(line)
+
+    def read_parent_ids(self):
+        """reads the file once to find the ids replies refer to"""
+        return set(int(record['parent_id']) for record in self.read_records()
+                   if record.get('parent_id'))
+
+    def read_batches(self, batch_size):
+        batch = []
+        for record in self.read_records():
+            batch.append(record)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def parse_date(self, value):
+        if not value:
+            return None
+        value = parse_datetime(value)
+        if value is None:
+            return None
+        if settings.USE_TZ and timezone.is_naive(value):
+            value = timezone.make_aware(value, timezone.utc)
+        elif not settings.USE_TZ and timezone.is_aware(value):
+            value = timezone.make_naive(value, timezone.get_default_timezone())
+        return value
+
+    def build_messages(self, batch, users):
+        """
+        Returns the records which have known users, their unsaved messages
+        and the number of the other records.
+        """
+        user_ids = users.resolve(set(
+            name for record in batch
+            for name in (record.get('sender'), record.get('recipient')) if name))
+        records, messages = [], []
+        now = timezone.now()
+        for record in batch:
+            sender_id = user_ids.get(record.get('sender'))
+            recipient_id = user_ids.get(record.get('recipient'))
+            if sender_id is None or (record.get('recipient') and recipient_id is None):
+                continue
+            body = record.get('body') or ''
+            message = Message(
+                sender_id=sender_id,
+                recipient_id=recipient_id,
+                subject=record.get('subject') or '',
+                body=body,
+                snippet=make_snippet(body),
+                expires_at=self.parse_date(record.get('expires_at')) or never(),
+            )
+            for field in DATE_FIELDS:
+                setattr(message, field, self.parse_date(record.get(field)))
+            # like ``Message.save``
+            message.sent_at = message.sent_at or now
+            if record.get('parent_id'):
+                # parents earlier in the file are linked right away
+                message.parent_msg_id = self.new_ids.get(int(record['parent_id']))
+            records.append(record)
+            messages.append(message)
+        return records, messages, len(batch) - len(records)
+
+    def insert(self, messages):
+        """
+        Inserts the messages with ``bulk_create`` and sets their ids.
+        ``bulk_create`` doesn't return them, so they are read back in order:
+        rows above the largest id before the insert, matched by sender,
+        recipient and ``sent_at`` (to the second, some databases drop the
+        microseconds).
+        """
+        queryset = Message.objects.using(self.using)
+        last_id = queryset.aggregate(last_id=Max('pk'))['last_id'] or 0
+        queryset.bulk_create(messages)
+        inserted = {}
+        for values in queryset.filter(
+                pk__gt=last_id, sender__in=set(m.sender_id for m in messages),
+                ).order_by('pk').values_list('pk', 'sender', 'recipient', 'sent_at'):
+            pk, sender_id, recipient_id, sent_at = values
+            inserted.setdefault((sender_id, recipient_id, sent_at.replace(microsecond=0)),
+                                []).append(pk)
+        for message in messages:
+            ids = inserted.get((message.sender_id, message.recipient_id,
+                                message.sent_at.replace(microsecond=0)))
+            if not ids:
+                raise CommandError('The ids of the imported messages could not be '
+                                   'read back; nothing of this batch was imported.')
+            message.pk = ids.pop(0)
+
+    def map_ids(self, records, messages):
+        """remembers the new ids of parents and of replies read before them"""
+        for record, message in zip(records, messages):
+            if record.get('id') and int(record['id']) in self.parent_ids:
+                if int(record['id']) in self.new_ids:
+                    self.duplicates += 1
+                else:
+                    self.new_ids[int(record['id'])] = message.pk
+            if record.get('parent_id') and message.parent_msg_id is None:
+                self.pending.append((message.pk, int(record['parent_id'])))
+
+    def update_mailboxes(self, messages):
+        """
+        Updates the quota counters, the mailbox index, the change log and the
+        cached mailbox data of the users of the imported messages.
+        """
+        record_changes((user_id, message.pk, MessageChange.CREATED)
+                       for message in messages
+                       for user_id in set([message.sender_id, message.recipient_id]))
+        reindex([message.pk for message in messages], self.using)
+        recipients = set(message.recipient_id for message in messages) - set([None])
+        if quotas.is_enabled() and recipients:
+            quotas.recount(recipients)
+        bump_mailbox_versions(*[user_id for message in messages
+                                for user_id in (message.sender_id, message.recipient_id)])
+
+    def link_parents(self):
+        """
+        Links the replies which were read before their parent. Returns the
+        number of replies whose parent isn't in the file.
+        """
+        messages = Message.objects.using(self.using)
+        unresolved = 0
+        with transaction.atomic(using=self.using):
+            for message_id, parent_id in self.pending:
+                if parent_id in self.new_ids:
+                    messages.filter(pk=message_id).update(parent_msg=self.new_ids[parent_id])
+                else:
+                    unresolved += 1
+        return unresolved
@@ -0,0 +1,42 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from ...index import get_index, rebuild
+from ...instrumentation import instrument
+from ...utils import get_user_model, get_username_field
+
+
+class Command(BaseCommand):
+    args = '[<username> ...]'
+    help = (
+        'Builds the mailbox index configured in DJANGO_MESSAGES_INDEX_BACKEND '
+        'from the database, for the given users or for all users.'
+    )
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', action='store', dest='chunk_size',
+            type='int', default=1000,
+            help='Number of messages read per query.'),
+    )
+
+    def handle(self, *args, **options):
+        if get_index() is None:
+            raise CommandError('DJANGO_MESSAGES_INDEX_BACKEND is not set.')
+        User = get_user_model()
+        users = User.objects.order_by('pk')
+        if args:
+            users = users.filter(**{'%s__in' % get_username_field(): args})
+
+        indexed = count = 0
+        with instrument('commands.rebuild_mailbox_index') as timer:
+            last_pk = None
+            while True:
+                chunk = users if last_pk is None else users.filter(pk__gt=last_pk)
+                chunk = list(chunk[:options['chunk_size']])
+                if not chunk:
+                    break
+                for user in chunk:
+                    indexed += rebuild(user, options['chunk_size'])
+                count += len(chunk)
+                last_pk = chunk[-1].pk
+            timer.rows = indexed
+        if int(options.get('verbosity', 1)) > 0:
+            self.stdout.write('Indexed %d messages of %d users.' % (indexed, count))
@@ -0,0 +1,51 @@
+from django.conf import settings
+from django.core.cache import cache
+
+from django_messages.receipts import buffered_this_request, needs_flush, flush_user
+from django_messages.routers import pin_to_primary, has_written
+
+
+def pinning_cache_key(user):
+    return 'django_messages:pinned:%s' % user.pk
+
+
+class ReplicaPinningMiddleware(object):
+    """
+    Keeps reads of a user on the primary database for
+    ``DJANGO_MESSAGES_REPLICA_PIN_SECONDS`` seconds after the user changed
+    messages (by composing, deleting, undeleting or reading one), so they never
+    miss their own changes because of replication lag. Must be placed after
+    the ``AuthenticationMiddleware``.
+    """
+    def process_request(self, request):
+        pin_to_primary(False)
+        user = request.user
+        if user.is_authenticated() and cache.get(pinning_cache_key(user)):
+            pin_to_primary()
+
+    def process_response(self, request, response):
+        user = getattr(request, 'user', None)
+        if has_written() and user is not None and user.is_authenticated():
+            cache.set(pinning_cache_key(user), True,
+                getattr(settings, 'DJANGO_MESSAGES_REPLICA_PIN_SECONDS', 10))
+        pin_to_primary(False)
+        return response
+
+
+class ReadReceiptMiddleware(object):
+    """
+    Writes the buffered reads of the user to the database at the end of a
+    request which buffered a read, once there are
+    ``DJANGO_MESSAGES_READ_BUFFER_SIZE`` of them or the oldest is older than
+    ``DJANGO_MESSAGES_READ_BUFFER_SECONDS`` seconds. Must be placed after the
+    ``AuthenticationMiddleware``.
+    """
+    def process_request(self, request):
+        buffered_this_request()
+
+    def process_response(self, request, response):
+        user = getattr(request, 'user', None)
+        if (buffered_this_request() and user is not None and
+                user.is_authenticated() and needs_flush(user)):
+            flush_user(user.pk)
+        return response
@@ -1,47 +1,172 @@
+import datetime
+
+import django
 from django.conf import settings
-from django.db import models
-from django.db.models import signals
+from django.db import connections, models
+from django.db.models import Q
 from django.utils import timezone
 from django.utils.encoding import python_2_unicode_compatible
 from django.utils.translation import ugettext_lazy as _
 
+from django_messages.compression import CompressedTextField
+from django_messages.instrumentation import instrumented
+from django_messages.sharding import shard_for_user
+from django_messages.storage import attachment_storage
+from django_messages.utils import capped_count, make_snippet, SNIPPET_LENGTH
+from django_messages.warming import get_warm_mailbox
+
 AUTH_USER_MODEL = getattr(settings, 'AUTH_USER_MODEL', 'auth.User')
 
+# parents may have been moved to the ``ArchivedMessage`` table, so the
+# database must not enforce the self reference, and deleting a parent keeps
+# its replies
+PARENT_MSG_KWARGS = {'db_constraint': False, 'on_delete': models.DO_NOTHING}
+
+# with sharding, users live on another database than their messages
+USER_FK_KWARGS = {'db_constraint': False}
+
+
+def never():
+    """
+    Returns the ``expires_at`` of messages which don't expire. Storing a date
+    far in the future instead of ``NULL`` turns ``unexpired`` into a single
+    range on the indexed column.
+    """
+    value = datetime.datetime(9999, 12, 31)
+    if settings.USE_TZ:
+        value = timezone.make_aware(value, timezone.utc)
+    return value
+
+
+def unexpired(now=None, field='expires_at'):
+    """
+    Returns the predicate selecting messages which haven't expired, on
+    ``field`` to follow a relation.
+    """
+    now = now or timezone.now()
+    return Q(**{'%s__gt' % field: now})
 
-class MessageManager(models.Manager):
+
+class ShardedManager(models.Manager):
+
+    def for_user(self, user):
+        """
+        Returns all objects on the database holding the given user's
+        messages. Without sharding this is the default database.
+        """
+        queryset = self.all()
+        shard = shard_for_user(user)
+        if shard is not None:
+            queryset = queryset.using(shard)
+        return queryset
+
+
+class MessageManager(ShardedManager):
 
     def inbox_for(self, user):
         """
         Returns all messages that were received by the given user and are not
         marked as deleted.
         """
-        return self.filter(
+        return self.for_user(user).filter(
+            unexpired(),
             recipient=user,
             recipient_deleted_at__isnull=True,
-        )
+        ).defer('body')
 
     def outbox_for(self, user):
         """
         Returns all messages that were sent by the given user and are not
         marked as deleted.
         """
-        return self.filter(
+        return self.for_user(user).filter(
+            unexpired(),
             sender=user,
             sender_deleted_at__isnull=True,
-        )
+        ).defer('body')
 
     def trash_for(self, user):
         """
         Returns all messages that were either received or sent by the given
         user and are marked as deleted.
         """
-        return self.filter(
+        messages = self.for_user(user).filter(unexpired())
+        return (messages.filter(
             recipient=user,
             recipient_deleted_at__isnull=False,
-        ) | self.filter(
+        ) | messages.filter(
             sender=user,
             sender_deleted_at__isnull=False,
+        )).defer('body')
+
+    @instrumented('manager.page_for')
+    def page_for(self, folder, user, offset=0, limit=50):
+        """
+        Returns the messages ``offset`` to ``offset + limit`` of the user's
+        ``inbox``, ``outbox`` or ``trash``, newest first. The ids are taken
+        from the mailbox index if one is configured and built for the user
+        and the messages are loaded with one ``in_bulk`` query; otherwise, or
+        if the index lists messages which are no longer in the folder, the
+        page is sliced from ``inbox_for``, ``outbox_for`` or ``trash_for``.
+        Buffered reads of the user are applied to the messages.
+        """
+        from django_messages.index import get_index
+        from django_messages.receipts import with_buffered_reads
+        queryset = getattr(self, '%s_for' % folder)(user)
+        index = None
+        if self.model is Message:
+            queryset = with_buffered_reads(queryset, user)
+            index = get_index()
+        ids = index.page(user.pk, folder, offset, limit) if index is not None else None
+        if ids is not None:
+            messages = queryset.in_bulk(ids)
+            if len(messages) == len(ids):
+                return [messages[pk] for pk in ids]
+        return list(queryset[offset:offset + limit])
+
+    @instrumented('manager.folder_counts')
+    def folder_counts(self, user):
+        """
+        Returns a dictionary with the number of messages in the given user's
+        ``inbox``, ``outbox`` and ``trash`` and the number of ``unread``
+        messages in the inbox, computed with a single query.
+        """
+        from django_messages.receipts import get_buffered_reads
+        warm = get_warm_mailbox(user) if self.model is Message else None
+        if warm is not None:
+            return dict(warm['folders'])
+        queryset = self.for_user(user)
+        connection = connections[queryset.db]
+        qn = connection.ops.quote_name
+        recipient, sender = qn('recipient_id'), qn('sender_id')
+        recipient_deleted, sender_deleted = qn('recipient_deleted_at'), qn('sender_deleted_at')
+        unread = '%s = %%s AND %s IS NULL AND %s IS NULL' % (
+            recipient, recipient_deleted, qn('read_at'))
+        params = [user.pk]
+        buffered_reads = list(get_buffered_reads(user))
+        if buffered_reads:
+            unread += ' AND %s NOT IN (%s)' % (
+                qn(self.model._meta.pk.column), ', '.join(['%s'] * len(buffered_reads)))
+            params.extend(buffered_reads)
+        counts = (
+            ('inbox', '%s = %%s AND %s IS NULL' % (recipient, recipient_deleted), [user.pk]),
+            ('unread', unread, params),
+            ('outbox', '%s = %%s AND %s IS NULL' % (sender, sender_deleted), [user.pk]),
+            ('trash', '(%s = %%s AND %s IS NOT NULL) OR (%s = %%s AND %s IS NOT NULL)' % (
+                recipient, recipient_deleted, sender, sender_deleted), [user.pk, user.pk]),
         )
+        sql = ('SELECT %s FROM %s WHERE (%s = %%s OR %s = %%s) '
+               'AND %s > %%s') % (
+            ', '.join('SUM(CASE WHEN %s THEN 1 ELSE 0 END)' % condition
+                      for name, condition, condition_params in counts),
+            qn(self.model._meta.db_table), recipient, sender, qn('expires_at'))
+        params = [p for name, condition, condition_params in counts
+                  for p in condition_params] + [user.pk, user.pk, timezone.now()]
+        cursor = connection.cursor()
+        cursor.execute(sql, params)
+        row = cursor.fetchone()
+        return dict((name, int(value or 0))
+                    for (name, condition, condition_params), value in zip(counts, row))
 
 
 @python_2_unicode_compatible
@@ -50,15 +175,17 @@ class Message(models.Model):
     A private message from user to user
     """
     subject = models.CharField(_("Subject"), max_length=120)
-    body = models.TextField(_("Body"))
-    sender = models.ForeignKey(AUTH_USER_MODEL, related_name='sent_messages', verbose_name=_("Sender"))
-    recipient = models.ForeignKey(AUTH_USER_MODEL, related_name='received_messages', null=True, blank=True, verbose_name=_("Recipient"))
-    parent_msg = models.ForeignKey('self', related_name='next_messages', null=True, blank=True, verbose_name=_("Parent message"))
-    sent_at = models.DateTimeField(_("sent at"), null=True, blank=True)
+    body = CompressedTextField(_("Body"))
+    snippet = models.CharField(_("Snippet"), max_length=SNIPPET_LENGTH, blank=True, editable=False)
+    sender = models.ForeignKey(AUTH_USER_MODEL, related_name='sent_messages', verbose_name=_("Sender"), **USER_FK_KWARGS)
+    recipient = models.ForeignKey(AUTH_USER_MODEL, related_name='received_messages', null=True, blank=True, verbose_name=_("Recipient"), **USER_FK_KWARGS)
+    parent_msg = models.ForeignKey('self', related_name='next_messages', null=True, blank=True, verbose_name=_("Parent message"), **PARENT_MSG_KWARGS)
+    sent_at = models.DateTimeField(_("sent at"), null=True, blank=True, db_index=True)
     read_at = models.DateTimeField(_("read at"), null=True, blank=True)
     replied_at = models.DateTimeField(_("replied at"), null=True, blank=True)
     sender_deleted_at = models.DateTimeField(_("Sender deleted at"), null=True, blank=True)
     recipient_deleted_at = models.DateTimeField(_("Recipient deleted at"), null=True, blank=True)
+    expires_at = models.DateTimeField(_("expires at"), default=never, blank=True, db_index=True)
 
     objects = MessageManager()
 
@@ -74,6 +201,13 @@ class Message(models.Model):
             return True
         return False
 
+    def get_parent(self):
+        """
+        returns the parent message, which may already have been moved to
+        the archive
+        """
+        return get_message(self.parent_msg_id, using=self._state.db)
+
     def __str__(self):
         return self.subject
 
@@ -84,22 +218,257 @@ class Message(models.Model):
     def save(self, **kwargs):
         if not self.id:
             self.sent_at = timezone.now()
+        if 'expires_at' in self.__dict__ and self.expires_at is None:
+            self.expires_at = never()
+        # don't load a deferred body just to refresh the snippet
+        if 'body' in self.__dict__:
+            self.snippet = make_snippet(self.body)
         super(Message, self).save(**kwargs)
 
+    def expires(self):
+        """returns whether the message has an expiry date"""
+        return self.expires_at != never()
+
     class Meta:
         ordering = ['-sent_at']
         verbose_name = _("Message")
         verbose_name_plural = _("Messages")
+        # the folders including ``unexpired``
+        index_together = [
+            ('recipient', 'recipient_deleted_at', 'expires_at'),
+            ('sender', 'sender_deleted_at', 'expires_at'),
+        ]
+
+
+@python_2_unicode_compatible
+class ArchivedMessage(models.Model):
+    """
+    A message moved out of the ``Message`` table by the ``archive_messages``
+    command. Archived messages keep the primary key of the original message,
+    so links via ``parent_msg`` still resolve.
+    """
+    id = models.IntegerField(primary_key=True)
+    subject = models.CharField(_("Subject"), max_length=120)
+    body = CompressedTextField(_("Body"))
+    snippet = models.CharField(_("Snippet"), max_length=SNIPPET_LENGTH, blank=True, editable=False)
+    sender = models.ForeignKey(AUTH_USER_MODEL, related_name='archived_sent_messages', verbose_name=_("Sender"), **USER_FK_KWARGS)
+    recipient = models.ForeignKey(AUTH_USER_MODEL, related_name='archived_received_messages', null=True, blank=True, verbose_name=_("Recipient"), **USER_FK_KWARGS)
+    parent_msg_id = models.IntegerField(_("Parent message"), null=True, blank=True, db_index=True)
+    sent_at = models.DateTimeField(_("sent at"), null=True, blank=True, db_index=True)
+    read_at = models.DateTimeField(_("read at"), null=True, blank=True)
+    replied_at = models.DateTimeField(_("replied at"), null=True, blank=True)
+    sender_deleted_at = models.DateTimeField(_("Sender deleted at"), null=True, blank=True)
+    recipient_deleted_at = models.DateTimeField(_("Recipient deleted at"), null=True, blank=True)
+    expires_at = models.DateTimeField(_("expires at"), default=never, blank=True, db_index=True)
+    archived_at = models.DateTimeField(_("archived at"), default=timezone.now)
+
+    objects = MessageManager()
+
+    @classmethod
+    def from_message(cls, message):
+        """returns an unsaved archive copy of the given message"""
+        values = dict((f.attname, getattr(message, f.attname))
+                      for f in message._meta.fields)
+        return cls(**dict((f.attname, values[f.attname])
+                          for f in cls._meta.fields
+                          if f.attname in values))
+
+    def new(self):
+        return self.read_at is None
+
+    def replied(self):
+        return self.replied_at is not None
+
+    def get_parent(self):
+        """returns the parent message from either table"""
+        return get_message(self.parent_msg_id, using=self._state.db)
+
+    def __str__(self):
+        return self.subject
+
+    class Meta:
+        ordering = ['-sent_at']
+        verbose_name = _("Archived message")
+        verbose_name_plural = _("Archived messages")
+
+
+def get_message(message_id, using=None):
+    """
+    returns the message with the given id from the ``Message`` table or,
+    if it has been archived, from the ``ArchivedMessage`` table
+    """
+    if message_id is None:
+        return None
+    for model in (Message, ArchivedMessage):
+        try:
+            return model.objects.db_manager(using).get(pk=message_id)
+        except model.DoesNotExist:
+            pass
+    return None
+
+
+class MailboxUsage(models.Model):
+    """
+    The number of messages in a user's inbox and their stored size, kept up
+    to date when quotas are enabled (see ``django_messages.quotas``).
+    """
+    user = models.OneToOneField(AUTH_USER_MODEL, related_name='mailbox_usage', verbose_name=_("User"))
+    message_count = models.IntegerField(_("message count"), default=0, db_index=True)
+    stored_bytes = models.BigIntegerField(_("stored bytes"), default=0, db_index=True)
+    updated_at = models.DateTimeField(_("updated at"), auto_now=True)
+
+    class Meta:
+        verbose_name = _("Mailbox usage")
+        verbose_name_plural = _("Mailbox usages")
+
+
+class AttachmentBlob(models.Model):
+    """
+    The content of attached files, stored once per distinct content.
+    """
+    sha256 = models.CharField(_("SHA-256"), max_length=64, unique=True)
+    file = models.FileField(_("file"), upload_to='django_messages/attachments',
+                            storage=attachment_storage, max_length=255)
+    size = models.BigIntegerField(_("size"))
+    created_at = models.DateTimeField(_("created at"), default=timezone.now)
+
+    class Meta:
+        verbose_name = _("Attachment content")
+        verbose_name_plural = _("Attachment contents")
+
+
+@python_2_unicode_compatible
+class Attachment(models.Model):
+    """
+    A file attached to a message.
+    """
+    message = models.ForeignKey(Message, related_name='attachments', verbose_name=_("Message"))
+    blob = models.ForeignKey(AttachmentBlob, related_name='attachments', on_delete=models.PROTECT, verbose_name=_("Content"))
+    filename = models.CharField(_("filename"), max_length=255)
+    content_type = models.CharField(_("content type"), max_length=100)
+
+    objects = ShardedManager()
+
+    class Meta:
+        verbose_name = _("Attachment")
+        verbose_name_plural = _("Attachments")
+
+    def __str__(self):
+        return self.filename
+
+    def get_absolute_url(self):
+        return ('messages_attachment', [self.id])
+    get_absolute_url = models.permalink(get_absolute_url)
+
+
+@python_2_unicode_compatible
+class ArchivedAttachment(models.Model):
+    """
+    An attachment moved out of the ``Attachment`` table together with its
+    message by the ``archive_messages`` command. It keeps its primary key and
+    refers to the ``ArchivedMessage`` by id.
+    """
+    id = models.IntegerField(primary_key=True)
+    message_id = models.IntegerField(_("Message"), db_index=True)
+    blob = models.ForeignKey(AttachmentBlob, related_name='archived_attachments', on_delete=models.PROTECT, verbose_name=_("Content"))
+    filename = models.CharField(_("filename"), max_length=255)
+    content_type = models.CharField(_("content type"), max_length=100)
+    archived_at = models.DateTimeField(_("archived at"), default=timezone.now)
+
+    objects = ShardedManager()
+
+    class Meta:
+        verbose_name = _("Archived attachment")
+        verbose_name_plural = _("Archived attachments")
+
+    @classmethod
+    def from_attachment(cls, attachment):
+        """returns an unsaved archive copy of the given attachment"""
+        return cls(id=attachment.pk, message_id=attachment.message_id,
+                   blob_id=attachment.blob_id, filename=attachment.filename,
+                   content_type=attachment.content_type)
+
+    def __str__(self):
+        return self.filename
+
+
+class MessageChange(models.Model):
+    """
+    An entry of the change log of a user's mailbox (see
+    ``django_messages.changes``). The ids of the entries of a user only
+    increase, so the id of the last entry a client has seen is its cursor.
+    """
+    CREATED = 'created'
+    READ = 'read'
+    REPLIED = 'replied'
+    DELETED = 'deleted'
+    UNDELETED = 'undeleted'
+    PURGED = 'purged'
+    ARCHIVED = 'archived'
+    EVENT_CHOICES = (
+        (CREATED, _("created")),
+        (READ, _("read")),
+        (REPLIED, _("replied")),
+        (DELETED, _("deleted")),
+        (UNDELETED, _("undeleted")),
+        (PURGED, _("purged")),
+        (ARCHIVED, _("archived")),
+    )
+
+    user = models.ForeignKey(AUTH_USER_MODEL, related_name='message_changes', verbose_name=_("User"), **USER_FK_KWARGS)
+    # no foreign key, the message may have been deleted
+    message_id = models.IntegerField(_("message id"))
+    event = models.CharField(_("event"), max_length=10, choices=EVENT_CHOICES)
+    created_at = models.DateTimeField(_("created at"), default=timezone.now, db_index=True)
+
+    objects = ShardedManager()
+
+    class Meta:
+        ordering = ['id']
+        index_together = [('user', 'id')]
+        verbose_name = _("Message change")
+        verbose_name_plural = _("Message changes")
+
+
+class IdempotencyKey(models.Model):
+    """
+    A key sent along with a compose or broadcast request, with the messages
+    the request created (see ``django_messages.idempotency``). Keys are
+    unique per user, so a retried request finds the messages of the first.
+    """
+    user = models.ForeignKey(AUTH_USER_MODEL, related_name='message_idempotency_keys', verbose_name=_("User"), **USER_FK_KWARGS)
+    key = models.CharField(_("key"), max_length=64)
+    # ``[database, id]`` pairs of the created messages, empty while pending
+    messages = models.TextField(_("messages"), blank=True)
+    created_at = models.DateTimeField(_("created at"), default=timezone.now, db_index=True)
+
+    objects = ShardedManager()
+
+    class Meta:
+        unique_together = [('user', 'key')]
+        verbose_name = _("Idempotency key")
+        verbose_name_plural = _("Idempotency keys")
 
 
-def inbox_count_for(user):
+@instrumented('inbox_count_for')
+def inbox_count_for(user, cap=None):
     """
     returns the number of unread messages for the given user but does not
-    mark them seen
+    mark them seen. Counts at most ``cap`` (by default
+    ``DJANGO_MESSAGES_COUNT_CAP``) messages, see ``utils.capped_count``.
     """
-    return Message.objects.filter(recipient=user, read_at__isnull=True, recipient_deleted_at__isnull=True).count()
+    from django_messages.receipts import get_buffered_reads
+    if cap is None:
+        warm = get_warm_mailbox(user)
+        if warm is not None:
+            return warm['unread']
+    queryset = Message.objects.for_user(user).filter(unexpired(), recipient=user, read_at__isnull=True, recipient_deleted_at__isnull=True)
+    buffered_reads = get_buffered_reads(user)
+    if buffered_reads:
+        queryset = queryset.exclude(pk__in=list(buffered_reads))
+    return capped_count(queryset, cap)
 
-# fallback for email notification if django-notification could not be found
-if "notification" not in settings.INSTALLED_APPS and getattr(settings, 'DJANGO_MESSAGES_NOTIFY', True):
-    from django_messages.utils import new_message_email
-    signals.post_save.connect(new_message_email, sender=Message)
+# Django 1.7+ connects the signals in DjangoMessagesConfig.ready()
+if django.VERSION[:2] < (1, 7):
+    from django_messages.utils import connect_signals
+    connect_signals()
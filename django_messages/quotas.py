@@ -0,0 +1,203 @@
+"""
+Per-user mailbox quotas and retention rules.
+
+Quotas are configured with ``DJANGO_MESSAGES_QUOTA_MESSAGES`` (the maximum
+number of messages in a user's inbox) and ``DJANGO_MESSAGES_QUOTA_BYTES``
+(their maximum stored size). While a quota is set, the ``MailboxUsage``
+counters are updated whenever a message arrives in or leaves an inbox. The
+``enforce_mailbox_quotas`` command moves the oldest messages of users over
+quota to the trash and purges old trash in small batches, using the counters
+to find those users instead of counting their messages. Since messages
+created or deleted with ``update()`` and ``bulk_create()`` bypass the
+counters, a user is recounted before any of their messages is trashed.
+"""
+import datetime
+
+from django.conf import settings
+from django.db import connections, IntegrityError, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from django_messages.caching import bump_mailbox_versions
+from django_messages.compression import compress, is_compressed, is_enabled as compression_enabled
+from django_messages.changes import record_changes, record_purged
+from django_messages.index import reindex, unindex
+from django_messages.models import Message, MailboxUsage, MessageChange
+from django_messages.sharding import get_databases
+
+
+def get_message_quota():
+    return getattr(settings, 'DJANGO_MESSAGES_QUOTA_MESSAGES', None)
+
+
+def get_bytes_quota():
+    return getattr(settings, 'DJANGO_MESSAGES_QUOTA_BYTES', None)
+
+
+def get_trash_retention_days():
+    return getattr(settings, 'DJANGO_MESSAGES_TRASH_RETENTION_DAYS', None)
+
+
+def is_enabled():
+    return get_message_quota() is not None or get_bytes_quota() is not None
+
+
+def stored_size(message):
+    """
+    returns the number of characters the body of the message takes up in
+    the database
+    """
+    body = message.__dict__.get('body') or ''
+    if compression_enabled() and not is_compressed(body):
+        body = compress(body)
+    return len(body)
+
+
+def adjust_usage(user_id, messages, size):
+    """
+    Adds ``messages`` and ``size`` (which may be negative) to the counters of
+    the given user.
+    """
+    usage = MailboxUsage.objects.filter(user=user_id)
+    updated = usage.update(message_count=F('message_count') + messages,
+                           stored_bytes=F('stored_bytes') + size)
+    if not updated:
+        try:
+            with transaction.atomic():
+                MailboxUsage.objects.create(user_id=user_id,
+                    message_count=max(messages, 0), stored_bytes=max(size, 0))
+        except IntegrityError:
+            adjust_usage(user_id, messages, size)
+
+
+def message_received(sender, instance, created, **kwargs):
+    """post_save handler counting new messages in the recipient's inbox"""
+    if (created and is_enabled() and instance.recipient_id is not None and
+            instance.recipient_deleted_at is None):
+        adjust_usage(instance.recipient_id, 1, stored_size(instance))
+
+
+def track_inbox(message, removed):
+    """
+    Updates the counters of the recipient after ``message`` was moved from
+    the inbox to the trash (``removed=True``) or restored from the trash.
+    """
+    if not is_enabled():
+        return
+    sign = -1 if removed else 1
+    adjust_usage(message.recipient_id, sign, sign * stored_size(message))
+
+
+def over_quota(limit):
+    """returns up to ``limit`` usage counters of users over their quota"""
+    message_quota = get_message_quota()
+    bytes_quota = get_bytes_quota()
+    query = Q(pk__in=[])
+    if message_quota is not None:
+        query |= Q(message_count__gt=message_quota)
+    if bytes_quota is not None:
+        query |= Q(stored_bytes__gt=bytes_quota)
+    return list(MailboxUsage.objects.filter(query).select_related('user')[:limit])
+
+
+def enforce_quota(usage, batch_size):
+    """
+    Moves at most ``batch_size`` of the oldest messages of the user's inbox
+    to the trash, as many as needed to get the user under quota. Returns the
+    number of messages moved.
+
+    The counters of the user are recounted first, so a stale counter never
+    trashes messages of a user who is actually under quota, and again after
+    the messages were moved.
+    """
+    recount([usage.user_id])
+    usage = MailboxUsage.objects.get(pk=usage.pk)
+    message_quota = get_message_quota()
+    bytes_quota = get_bytes_quota()
+    excess_messages = excess_bytes = 0
+    if message_quota is not None:
+        excess_messages = usage.message_count - message_quota
+    if bytes_quota is not None:
+        excess_bytes = usage.stored_bytes - bytes_quota
+
+    inbox = Message.objects.inbox_for(usage.user).order_by('sent_at', 'pk')
+    ids = []
+    size = 0
+    if excess_messages > 0 or excess_bytes > 0:
+        for pk, body in inbox.values_list('pk', 'body')[:batch_size]:
+            if len(ids) >= excess_messages and size >= excess_bytes:
+                break
+            ids.append(pk)
+            size += len(body)
+    if ids:
+        messages = Message.objects.for_user(usage.user)
+        with transaction.atomic(using=messages.db):
+            # messages the recipient deleted in the meantime stay untouched
+            ids = list(messages.select_for_update().filter(
+                pk__in=ids, recipient=usage.user_id,
+                recipient_deleted_at__isnull=True,
+            ).values_list('pk', flat=True))
+            messages.filter(pk__in=ids, recipient_deleted_at__isnull=True).update(
+                recipient_deleted_at=timezone.now())
+            record_changes((usage.user_id, pk, MessageChange.DELETED) for pk in ids)
+        bump_mailbox_versions(usage.user_id)
+        reindex(ids, messages.db)
+        recount([usage.user_id])
+    return len(ids)
+
+
+def purge_trash(batch_size, max_batches):
+    """
+    Deletes messages which were deleted by sender and recipient more than
+    ``DJANGO_MESSAGES_TRASH_RETENTION_DAYS`` days ago, ``batch_size``
+    messages per transaction. Returns the number of deleted messages.
+    """
+    days = get_trash_retention_days()
+    if days is None:
+        return 0
+    the_date = timezone.now() - datetime.timedelta(days=days)
+    deleted = 0
+    for using in get_databases(Message):
+        messages = Message.objects.using(using)
+        for i in range(max_batches):
+            batch = list(messages.filter(
+                recipient_deleted_at__lte=the_date,
+                sender_deleted_at__lte=the_date,
+            ).values_list('pk', 'sender', 'recipient')[:batch_size])
+            if not batch:
+                break
+            with transaction.atomic(using=using):
+                record_purged(batch, using)
+                messages.filter(pk__in=[row[0] for row in batch]).delete()
+            unindex(batch, using)
+            deleted += len(batch)
+    return deleted
+
+
+def recount(user_ids):
+    """
+    Recomputes the usage counters of the given users with one query per
+    database.
+    """
+    totals = dict((pk, [0, 0]) for pk in user_ids)
+    table = Message._meta.db_table
+    for using in get_databases(Message):
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        cursor = connection.cursor()
+        cursor.execute(
+            "SELECT %s, COUNT(*), SUM(LENGTH(%s)) FROM %s "
+            "WHERE %s IN (%s) AND %s IS NULL GROUP BY %s" % (
+                qn('recipient_id'), qn('body'), qn(table),
+                qn('recipient_id'), ', '.join(['%s'] * len(totals)),
+                qn('recipient_deleted_at'), qn('recipient_id')),
+            list(totals))
+        for user_id, count, size in cursor.fetchall():
+            totals[user_id][0] += count
+            totals[user_id][1] += size or 0
+    for user_id, (count, size) in totals.items():
+        updated = MailboxUsage.objects.filter(user=user_id).update(
+            message_count=count, stored_bytes=size)
+        if not updated and count:
+            MailboxUsage.objects.create(user_id=user_id,
+                message_count=count, stored_bytes=size)
@@ -0,0 +1,131 @@
+"""
+Flood control for composing messages.
+
+``DJANGO_MESSAGES_RATE_LIMIT_MESSAGES`` limits the number of messages, and
+``DJANGO_MESSAGES_RATE_LIMIT_RECIPIENTS`` the number of recipients, a user can
+send to within ``DJANGO_MESSAGES_RATE_LIMIT_WINDOW`` seconds (default: one
+hour). Sending one message to ten users counts as one message and ten
+recipients. Staff users are exempt unless
+``DJANGO_MESSAGES_RATE_LIMIT_EXEMPT_STAFF`` is ``False``.
+
+The window slides: each counter is kept in the cache per fixed window, and the
+previous window is weighted by how much of it still overlaps the sliding one,
+so a check costs a single ``get_many`` whatever the number of messages sent.
+"""
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+def get_message_limit():
+    return getattr(settings, 'DJANGO_MESSAGES_RATE_LIMIT_MESSAGES', None)
+
+
+def get_recipient_limit():
+    return getattr(settings, 'DJANGO_MESSAGES_RATE_LIMIT_RECIPIENTS', None)
+
+
+def get_window():
+    return getattr(settings, 'DJANGO_MESSAGES_RATE_LIMIT_WINDOW', 60 * 60)
+
+
+def is_enabled():
+    return get_message_limit() is not None or get_recipient_limit() is not None
+
+
+def is_exempt(user):
+    return (user.is_staff and
+            getattr(settings, 'DJANGO_MESSAGES_RATE_LIMIT_EXEMPT_STAFF', True))
+
+
+def rate_cache_key(user_id, counter, window_number):
+    return 'django_messages:rate:%s:%s:%s' % (user_id, counter, window_number)
+
+
+def _limits():
+    return [(counter, limit) for counter, limit in
+            (('messages', get_message_limit()), ('recipients', get_recipient_limit()))
+            if limit is not None]
+
+
+def _windows(now=None):
+    """returns the current window number and the weight of the previous one"""
+    window = get_window()
+    now = time.time() if now is None else now
+    number = int(now // window)
+    return number, 1.0 - (now % window) / float(window)
+
+
+def _increment(key, delta):
+    cache.add(key, 0, get_window() * 2)
+    try:
+        return cache.incr(key, delta)
+    except ValueError:
+        # the key expired between ``add`` and ``incr``
+        cache.set(key, delta, get_window() * 2)
+        return delta
+
+
+def usage(user, now=None):
+    """
+    returns a dictionary of the messages and recipients sent by the user
+    within the sliding window
+    """
+    number, weight = _windows(now)
+    keys = dict(((counter, n), rate_cache_key(user.pk, counter, n))
+                for counter in ('messages', 'recipients')
+                for n in (number - 1, number))
+    values = cache.get_many(list(keys.values()))
+    return dict((counter, values.get(keys[counter, number], 0) +
+                 values.get(keys[counter, number - 1], 0) * weight)
+                for counter in ('messages', 'recipients'))
+
+
+def consume(user, recipients, now=None):
+    """
+    Counts a message to ``recipients`` users sent by the user. Returns
+    ``False``, without counting it, if this would exceed a limit.
+    """
+    if not is_enabled() or is_exempt(user):
+        return True
+    number, weight = _windows(now)
+    amounts = {'messages': 1, 'recipients': recipients}
+    counted = []
+    allowed = True
+    previous = cache.get_many([rate_cache_key(user.pk, counter, number - 1)
+                               for counter, limit in _limits()])
+    for counter, limit in _limits():
+        key = rate_cache_key(user.pk, counter, number)
+        # incrementing first keeps concurrent requests from all passing
+        total = _increment(key, amounts[counter])
+        counted.append((key, amounts[counter]))
+        total += previous.get(rate_cache_key(user.pk, counter, number - 1), 0) * weight
+        if total > limit:
+            allowed = False
+            break
+    if not allowed:
+        _decrement(counted)
+    return allowed
+
+
+def refund(user, recipients, now=None):
+    """
+    Takes back a message counted by ``consume`` at ``now`` which wasn't
+    sent after all.
+    """
+    if not is_enabled() or is_exempt(user):
+        return
+    number, weight = _windows(now)
+    amounts = {'messages': 1, 'recipients': recipients}
+    _decrement([(rate_cache_key(user.pk, counter, number), amounts[counter])
+                for counter, limit in _limits()])
+
+
+def _decrement(counted):
+    for key, amount in counted:
+        try:
+            cache.decr(key, amount)
+        except ValueError:
+            # the key expired in the meantime
+            pass
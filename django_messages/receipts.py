@@ -0,0 +1,222 @@
+"""
+Buffered read receipts.
+
+With ``DJANGO_MESSAGES_BUFFER_READS = True`` opening a message doesn't write
+``read_at`` right away. The read is kept in the cache, in one entry per user
+mapping message ids to the time they were read, and is applied to the messages
+and unread counts shown to that user. Buffered reads are written to the
+database with one ``UPDATE`` per user and minute by ``flush_read_receipts`` or
+by the ``ReadReceiptMiddleware`` at the end of a request.
+"""
+import datetime
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models.query import QuerySet
+from django.utils import timezone
+
+from django_messages.caching import bump_mailbox_versions
+from django_messages.changes import record_changes
+from django_messages.models import Message, MessageChange
+
+USERS_KEY = 'django_messages:reads:users'
+
+_state = threading.local()
+
+
+def is_enabled():
+    return getattr(settings, 'DJANGO_MESSAGES_BUFFER_READS', False)
+
+
+def get_buffer_size():
+    return getattr(settings, 'DJANGO_MESSAGES_READ_BUFFER_SIZE', 100)
+
+
+def get_buffer_seconds():
+    return getattr(settings, 'DJANGO_MESSAGES_READ_BUFFER_SECONDS', 60)
+
+
+def get_buffer_timeout():
+    return getattr(settings, 'DJANGO_MESSAGES_READ_BUFFER_TIMEOUT', 60 * 60 * 24)
+
+
+def buffer_cache_key(user_id):
+    return 'django_messages:reads:%s' % user_id
+
+
+class _Lock(object):
+    """
+    A lock held in the cache, so it works across processes. ``acquired`` is
+    ``False`` if the lock couldn't be taken within ``wait`` seconds.
+    """
+    def __init__(self, key, wait=1.0):
+        self.key = key + ':lock'
+        self.wait = wait
+        self.acquired = False
+
+    def __enter__(self):
+        deadline = time.time() + self.wait
+        while not cache.add(self.key, 1, 10):
+            if time.time() > deadline:
+                return self
+            time.sleep(0.005)
+        self.acquired = True
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.acquired:
+            cache.delete(self.key)
+        return False
+
+
+def get_buffered_reads(user):
+    """returns a dictionary of message ids to read times of the user"""
+    if not is_enabled():
+        return {}
+    return cache.get(buffer_cache_key(getattr(user, 'pk', user))) or {}
+
+
+def buffer_read(user, message, read_at):
+    """
+    Records that the user read the message and sets ``read_at`` on it. Returns
+    ``False`` if reads aren't buffered (or the buffer is busy), in which case
+    the caller has to write ``read_at`` itself.
+    """
+    if not is_enabled():
+        return False
+    key = buffer_cache_key(user.pk)
+    with _Lock(key) as lock:
+        if not lock.acquired:
+            return False
+        reads = cache.get(key) or {}
+        read_at = reads.setdefault(message.pk, read_at)
+        # a user missing from the set of users would never be flushed
+        if len(reads) == 1 and not _update_users(add=user.pk):
+            return False
+        cache.set(key, reads, get_buffer_timeout())
+    message.read_at = read_at
+    bump_mailbox_versions(user.pk)
+    _state.buffered = True
+    return True
+
+
+def _update_users(add=None, remove=None):
+    """
+    Adds a user to or removes one from the set of users with buffered reads.
+    Returns ``False`` if the set is busy and wasn't changed.
+    """
+    with _Lock(USERS_KEY, wait=5.0) as lock:
+        if not lock.acquired:
+            return False
+        users = cache.get(USERS_KEY) or set()
+        if add is not None:
+            users.add(add)
+        if remove is not None:
+            users.discard(remove)
+        cache.set(USERS_KEY, users, get_buffer_timeout())
+    return True
+
+
+def buffered_this_request():
+    """returns whether a read was buffered in this thread since the last call"""
+    buffered = getattr(_state, 'buffered', False)
+    _state.buffered = False
+    return buffered
+
+
+def needs_flush(user):
+    reads = get_buffered_reads(user)
+    if not reads:
+        return False
+    oldest = min(reads.values())
+    return (len(reads) >= get_buffer_size() or
+            oldest <= timezone.now() - datetime.timedelta(seconds=get_buffer_seconds()))
+
+
+def flush_user(user_id, batch_size=500):
+    """
+    Writes the buffered reads of the user to the database and removes them
+    from the buffer. Returns the number of updated messages. If the buffer is
+    busy the reads stay buffered for the next flush; since only messages
+    which are still unread are updated, writing them again is harmless.
+    """
+    key = buffer_cache_key(user_id)
+    reads = cache.get(key) or {}
+    if not reads:
+        return 0
+    # reads of the same minute are written together
+    by_minute = {}
+    for pk, read_at in reads.items():
+        by_minute.setdefault(read_at.replace(second=0, microsecond=0), []).append(pk)
+    queryset = Message.objects.for_user(user_id).filter(
+        recipient=user_id, read_at__isnull=True)
+    updated = 0
+    senders = {}
+    for read_at, pks in by_minute.items():
+        for i in range(0, len(pks), batch_size):
+            batch = queryset.filter(pk__in=pks[i:i + batch_size])
+            senders.update(batch.values_list('pk', 'sender'))
+            updated += batch.update(read_at=read_at)
+    # like the views, the read is recorded for the sender and the recipient
+    record_changes((change_user_id, pk, MessageChange.READ)
+                   for pk, sender_id in senders.items()
+                   for change_user_id in set([sender_id, user_id]))
+    # the buffer is only cleared after the update, so unread counts stay
+    # correct while it runs
+    with _Lock(key, wait=5.0) as lock:
+        if not lock.acquired:
+            return updated
+        remaining = cache.get(key) or {}
+        for pk, read_at in reads.items():
+            if remaining.get(pk) == read_at:
+                del remaining[pk]
+        if remaining:
+            cache.set(key, remaining, get_buffer_timeout())
+        else:
+            cache.delete(key)
+            # if the set of users is busy the user stays in it until the
+            # next flush, which finds nothing to do
+            _update_users(remove=user_id)
+    return updated
+
+
+def flush(batch_size=500):
+    """flushes the buffered reads of all users"""
+    updated = 0
+    for user_id in cache.get(USERS_KEY) or set():
+        updated += flush_user(user_id, batch_size)
+    return updated
+
+
+class BufferedReadQuerySet(QuerySet):
+    """
+    Sets ``read_at`` of the messages it returns which have a buffered read.
+    """
+    buffered_reads = None
+
+    def iterator(self):
+        for message in super(BufferedReadQuerySet, self).iterator():
+            if message.read_at is None and message.pk in self.buffered_reads:
+                message.read_at = self.buffered_reads[message.pk]
+            yield message
+
+    def _clone(self, *args, **kwargs):
+        clone = super(BufferedReadQuerySet, self)._clone(*args, **kwargs)
+        clone.buffered_reads = self.buffered_reads
+        return clone
+
+
+def with_buffered_reads(queryset, user):
+    """
+    Returns ``queryset`` with the buffered reads of the user applied to its
+    messages.
+    """
+    reads = get_buffered_reads(user)
+    if not reads:
+        return queryset
+    queryset = BufferedReadQuerySet(model=queryset.model,
+        query=queryset.query.clone(), using=queryset._db)
+    queryset.buffered_reads = reads
+    return queryset
@@ -0,0 +1,157 @@
+"""
+Database routers for django-messages.
+
+Add ``ReplicaRouter`` to ``DATABASE_ROUTERS`` and set
+``DJANGO_MESSAGES_REPLICA_DATABASE`` to send reads of messages to a read
+replica. Use it together with ``ReplicaPinningMiddleware``, which keeps users
+who just changed their mailbox on the primary database for a while.
+
+Outside requests, e.g. in management commands or task queue workers, wrap
+each unit of work in ``pinning_scope()`` so a write only pins the reads of
+that unit.
+
+``ShardRouter`` is used when messages are sharded by user, see
+``django_messages.sharding``.
+"""
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+from django_messages.sharding import get_shards
+
+_state = threading.local()
+
+
+def pin_to_primary(pinned=True):
+    """
+    Routes all further reads of the current thread to the primary database.
+    """
+    _state.pinned = pinned
+    if not pinned:
+        _state.wrote = False
+
+
+def unpin(**kwargs):
+    """
+    unpins the thread at the end of a request, connected to
+    ``request_finished`` by ``connect_signals``
+    """
+    pin_to_primary(False)
+
+
+@contextmanager
+def pinning_scope():
+    """
+    Starts the thread unpinned and unpins it again afterwards, so a write
+    within the block doesn't keep later reads of the thread on the primary.
+    """
+    pin_to_primary(False)
+    try:
+        yield
+    finally:
+        pin_to_primary(False)
+
+
+def is_pinned():
+    return getattr(_state, 'pinned', False)
+
+
+def has_written():
+    """returns whether messages were written since the thread was unpinned"""
+    return getattr(_state, 'wrote', False)
+
+
+def get_primary_database():
+    return getattr(settings, 'DJANGO_MESSAGES_PRIMARY_DATABASE', DEFAULT_DB_ALIAS)
+
+
+def get_replica_database():
+    return getattr(settings, 'DJANGO_MESSAGES_REPLICA_DATABASE', None)
+
+
+class ReplicaRouter(object):
+    """
+    Reads django-messages models from the replica and writes them to the
+    primary database. Every write pins the current thread to the primary, so
+    users always read their own writes, until the end of the request or of
+    the ``pinning_scope``.
+
+    Idempotency keys and the change log are always read from the primary: a
+    lagging replica would let a resubmitted form send its messages again and
+    move a client's cursor past changes it hasn't seen.
+    """
+    app_label = 'django_messages'
+    primary_models = ('IdempotencyKey', 'MessageChange')
+
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label != self.app_label:
+            return None
+        replica = get_replica_database()
+        if (replica is None or is_pinned() or
+                model._meta.object_name in self.primary_models):
+            return get_primary_database()
+        return replica
+
+    def db_for_write(self, model, **hints):
+        if model._meta.app_label != self.app_label:
+            return None
+        _state.wrote = True
+        _state.pinned = True
+        return get_primary_database()
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = (get_primary_database(), get_replica_database())
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+
+def get_user_database():
+    return getattr(settings, 'DJANGO_MESSAGES_USER_DATABASE', DEFAULT_DB_ALIAS)
+
+
+class ShardRouter(object):
+    """
+    Keeps sharded messages on the database they were loaded from and looks
+    up related users on ``DJANGO_MESSAGES_USER_DATABASE``. The tables of
+    django-messages are only created on the shards, all other tables only
+    off the shards.
+    """
+    app_label = 'django_messages'
+    # models whose rows are kept next to the users instead of on the shards
+    user_database_models = ('MailboxUsage',)
+
+    def _db_for_instance(self, model, hints):
+        instance = hints.get('instance')
+        if instance is None or instance._meta.app_label != self.app_label:
+            return None
+        if model._meta.app_label == self.app_label:
+            return instance._state.db
+        return get_user_database()
+
+    def db_for_read(self, model, **hints):
+        return self._db_for_instance(model, hints)
+
+    def db_for_write(self, model, **hints):
+        return self._db_for_instance(model, hints)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if self.app_label in (obj1._meta.app_label, obj2._meta.app_label):
+            return True
+        return None
+
+    def allow_migrate(self, db, model):
+        shards = get_shards()
+        if not shards:
+            return None
+        if (model._meta.app_label == self.app_label and
+                model._meta.object_name not in self.user_database_models):
+            return db in shards
+        if db in shards and db != get_user_database():
+            return False
+        return None
+
+    # Django < 1.7
+    allow_syncdb = allow_migrate
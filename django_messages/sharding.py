@@ -0,0 +1,55 @@
+"""
+Horizontal sharding of messages by user.
+
+Set ``DJANGO_MESSAGES_SHARDS`` to a list of database aliases and add
+``django_messages.routers.ShardRouter`` to ``DATABASE_ROUTERS``. Each user's
+messages then live on the shard chosen by hashing the user's primary key. A
+message between users on different shards is stored twice: the recipient's
+copy on the recipient's shard and the sender's copy on the sender's shard.
+"""
+import zlib
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import router
+
+
+def get_shards():
+    return list(getattr(settings, 'DJANGO_MESSAGES_SHARDS', ()))
+
+
+def is_enabled():
+    return bool(get_shards())
+
+
+def shard_for_user(user):
+    """
+    Returns the database alias holding the messages of the given user (or
+    user id), or ``None`` if sharding is disabled.
+    """
+    shards = get_shards()
+    if not shards:
+        return None
+    pk = getattr(user, 'pk', user)
+    checksum = zlib.crc32(str(pk).encode('ascii')) & 0xffffffff
+    return shards[checksum % len(shards)]
+
+
+def group_by_shard(users):
+    """
+    Returns a list of ``(alias, users)`` pairs grouping the given users by
+    their shard. The alias is ``None`` if sharding is disabled.
+    """
+    if not is_enabled():
+        return [(None, list(users))]
+    groups = OrderedDict()
+    for user in users:
+        groups.setdefault(shard_for_user(user), []).append(user)
+    return list(groups.items())
+
+
+def get_databases(model):
+    """
+    Returns the aliases of all databases holding rows of the given model.
+    """
+    return get_shards() or [router.db_for_write(model)]
@@ -0,0 +1,5 @@
+from django.dispatch import Signal
+
+# Sent after an instrumented mailbox operation finished, see
+# ``django_messages.instrumentation``. ``sender`` is the operation name.
+operation_timed = Signal(providing_args=['name', 'duration', 'queries', 'rows', 'tags'])
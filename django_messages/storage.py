@@ -0,0 +1,28 @@
+from django.conf import settings
+from django.core.files.storage import get_storage_class
+try:
+    from django.core.signals import setting_changed
+except ImportError:
+    # Django < 1.8
+    from django.test.signals import setting_changed
+from django.utils.functional import LazyObject, empty
+
+
+class AttachmentStorage(LazyObject):
+    """
+    The storage of attachments, ``DJANGO_MESSAGES_ATTACHMENT_STORAGE`` (a
+    dotted path to a storage class) or the default file storage.
+    """
+    def _setup(self):
+        path = getattr(settings, 'DJANGO_MESSAGES_ATTACHMENT_STORAGE', None)
+        self._wrapped = get_storage_class(path)()
+
+attachment_storage = AttachmentStorage()
+
+
+def reset_attachment_storage(sender, setting, **kwargs):
+    """sets the storage up again when the settings change in tests"""
+    if setting in ('DJANGO_MESSAGES_ATTACHMENT_STORAGE', 'DEFAULT_FILE_STORAGE', 'MEDIA_ROOT'):
+        attachment_storage._wrapped = empty
+
+setting_changed.connect(reset_attachment_storage)
@@ -1,5 +1,7 @@
 from django.template import Library, Node, TemplateSyntaxError
 
+from django_messages.models import Message, inbox_count_for
+
 class InboxOutput(Node):
     def __init__(self, varname=None):
         self.varname = varname
@@ -7,8 +9,11 @@ class InboxOutput(Node):
     def render(self, context):
         try:
             user = context['user']
-            count = user.received_messages.filter(read_at__isnull=True, recipient_deleted_at__isnull=True).count()
-        except (KeyError, AttributeError):
+        except KeyError:
+            user = None
+        if user is not None and user.is_authenticated():
+            count = inbox_count_for(user)
+        else:
             count = ''
         if self.varname is not None:
             context[self.varname] = count
@@ -41,5 +46,38 @@ def do_print_inbox_count(parser, token):
     else:
         return InboxOutput()
 
+class FolderCountsNode(Node):
+    def __init__(self, varname):
+        self.varname = varname
+
+    def render(self, context):
+        try:
+            user = context['user']
+        except KeyError:
+            user = None
+        if user is not None and user.is_authenticated():
+            context[self.varname] = Message.objects.folder_counts(user)
+        else:
+            context[self.varname] = {}
+        return ""
+
+def do_folder_counts(parser, token):
+    """
+    A templatetag to get the number of messages in each folder of a logged in
+    user with one query. The result has the keys ``inbox``, ``unread``,
+    ``outbox`` and ``trash``.
+    Usage::
+
+        {% load inbox %}
+        {% folder_counts as counts %}
+        {{ counts.inbox }} ({{ counts.unread }}), {{ counts.outbox }}, {{ counts.trash }}
+
+    """
+    bits = token.contents.split()
+    if len(bits) != 3 or bits[1] != 'as':
+        raise TemplateSyntaxError("folder_counts tag must be used as {% folder_counts as var %}")
+    return FolderCountsNode(bits[2])
+
 register = Library()
 register.tag('inbox_count', do_print_inbox_count)
+register.tag('folder_counts', do_folder_counts)
@@ -0,0 +1,50 @@
+from django.core.cache import cache
+from django.template import Library, Node, TemplateSyntaxError
+
+from django_messages.caching import get_fragment_timeout, fragment_cache_key
+
+
+class MessageCacheNode(Node):
+    def __init__(self, nodelist, message, fragment_name):
+        self.nodelist = nodelist
+        self.message = message
+        self.fragment_name = fragment_name
+
+    def render(self, context):
+        timeout = get_fragment_timeout()
+        if not timeout:
+            return self.nodelist.render(context)
+        key = fragment_cache_key(self.fragment_name,
+                                 self.message.resolve(context))
+        value = cache.get(key)
+        if value is None:
+            value = self.nodelist.render(context)
+            cache.set(key, value, timeout)
+        return value
+
+def do_cache_message(parser, token):
+    """
+    Caches the enclosed part of a template for the given message until the
+    state of the message changes. Caching is only enabled if
+    ``DJANGO_MESSAGES_FRAGMENT_CACHE_TIMEOUT`` is set.
+    Usage::
+
+        {% load message_cache %}
+        {% cache_message message "inbox_row" %}
+            ... rendering of the message ...
+        {% endcache_message %}
+
+    """
+    bits = token.split_contents()
+    if len(bits) != 3:
+        raise TemplateSyntaxError("cache_message tag takes exactly two arguments")
+    fragment_name = bits[2]
+    if not (fragment_name[0] == fragment_name[-1] and fragment_name[0] in ('"', "'")):
+        raise TemplateSyntaxError("second argument to cache_message tag must be a quoted name")
+    nodelist = parser.parse(('endcache_message',))
+    parser.delete_first_token()
+    return MessageCacheNode(nodelist, parser.compile_filter(bits[1]),
+                            fragment_name[1:-1])
+
+register = Library()
+register.tag('cache_message', do_cache_message)
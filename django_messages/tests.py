@@ -1,8 +1,40 @@
+import datetime
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+import django
+from django.conf import settings
+from django.contrib.admin.models import LogEntry
+from django.contrib.auth.models import Group
+from django.core.cache import cache
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from django.core import mail
+from django.core.management import call_command
+from django.core.signals import request_finished
+from django.db import connection, router
 from django.test import TestCase
 from django.test.client import Client
 from django.core.urlresolvers import reverse
+from django.test.utils import override_settings, CaptureQueriesContext
 from django.utils import timezone
-from django_messages.models import Message
+from django.utils.functional import empty
+from django_messages import idempotency
+from django_messages.admin import MessageAdminForm
+from django_messages.compression import EncodedText, is_compressed
+from django_messages.export import iter_mailbox
+from django_messages.forms import ComposeForm
+from django_messages.routers import ReplicaRouter, ShardRouter, pin_to_primary, pinning_scope
+from django_messages.sharding import shard_for_user
+from django_messages.models import (Message, ArchivedMessage, Attachment,
+    ArchivedAttachment, AttachmentBlob, IdempotencyKey, MailboxUsage, MessageChange, inbox_count_for)
+from django_messages.receipts import get_buffered_reads
+from django_messages.warming import get_warm_mailbox
+from django_messages.signals import operation_timed
 from django_messages.utils import format_subject, format_quote
 
 from .utils import get_user_model
@@ -163,6 +195,23 @@ class IntegrationTestCase(TestCase):
             u"Re: %(subject)s" % {'subject': self.T_MESSAGE_DATA[0]['subject']}
         )
 
+    def testViewReplyForm(self):
+        """ the reply form of the message view is built on first use """
+        msg = Message.objects.create(sender=self.user_2,
+                                     recipient=self.user_1,
+                                     subject=self.T_MESSAGE_DATA[0]['subject'],
+                                     body=self.T_MESSAGE_DATA[0]['body'])
+        response = self.c.get(reverse('messages_detail',
+                              kwargs={'message_id': msg.pk}))
+        self.assertEqual(response.status_code, 200)
+        reply_form = response.context['reply_form']
+        self.assertTrue(reply_form._wrapped is empty)
+        self.assertEqual(
+            reply_form.initial['body'],
+            format_quote(self.user_2, self.T_MESSAGE_DATA[0]['body'])
+        )
+        self.assertEqual(len(list(reply_form)), 3)
+
 
 class FormatTestCase(TestCase):
     """ some tests for helper functions """
@@ -173,3 +222,1440 @@ class FormatTestCase(TestCase):
         self.assertEqual(format_subject(u"Re[2]: foo bar"), u"Re[3]: foo bar")
         self.assertEqual(format_subject(u"Re[10]: foo bar"),
                          u"Re[11]: foo bar")
+
+    def testQuoteMaxLength(self):
+        """ long bodies are cut off before quoting """
+        quote = format_quote(u"user", u"x" * 100, max_length=10)
+        self.assertEqual(quote, u"user wrote:\n> xxxxxxxxxx\n> [...]")
+        with self.settings(DJANGO_MESSAGES_QUOTE_MAX_LENGTH=10):
+            self.assertEqual(format_quote(u"user", u"x" * 100), quote)
+
+
+class UsersTestCase(TestCase):
+    """ creates users and clients logged in as them """
+    password = '123456'
+
+    def create_users(self, *usernames):
+        """ creates the users as ``self.user1``, ``self.user2``, ... """
+        for number, username in enumerate(usernames, 1):
+            setattr(self, 'user%d' % number, User.objects.create_user(
+                username, '%s@example.com' % username, self.password))
+
+    def login(self, username):
+        """ returns a client logged in as the user """
+        c = Client()
+        c.login(username=username, password=self.password)
+        return c
+
+
+class InstrumentationTestCase(UsersTestCase):
+    def setUp(self):
+        self.create_users('user5', 'user6')
+        self.events = []
+        operation_timed.connect(self.record)
+
+    def tearDown(self):
+        operation_timed.disconnect(self.record)
+
+    def record(self, sender, **kwargs):
+        self.events.append(kwargs)
+
+    def compose(self):
+        form = ComposeForm({'recipient': 'user5, user6',
+                            'subject': 'Subject', 'body': 'Body'})
+        self.assertTrue(form.is_valid())
+        return form.save(sender=self.user1)
+
+    def testDisabled(self):
+        """ nothing is reported unless instrumentation is enabled """
+        self.compose()
+        self.assertEqual(self.events, [])
+
+    @override_settings(DJANGO_MESSAGES_INSTRUMENTATION=True)
+    def testComposeSave(self):
+        """ compose reports duration, queries and affected rows """
+        self.compose()
+        event = [e for e in self.events
+                 if e['name'] == 'forms.compose.save'][0]
+        self.assertEqual(event['rows'], 2)
+        self.assertTrue(event['queries'] >= 2)
+        self.assertTrue(event['duration'] >= 0)
+
+    @override_settings(DJANGO_MESSAGES_INSTRUMENTATION=True)
+    def testExport(self):
+        """ the export is measured while it is streamed """
+        self.compose()
+        c = self.login('user5')
+        response = c.get(reverse('messages_export'))
+        self.assertFalse([e for e in self.events if e['name'] == 'views.export'])
+        b''.join(response.streaming_content)
+        event = [e for e in self.events if e['name'] == 'views.export'][0]
+        self.assertEqual(event['rows'], 2)
+        self.assertTrue(event['queries'] >= 1)
+
+    @override_settings(DJANGO_MESSAGES_INSTRUMENTATION=True, DEBUG=False)
+    def testQueryLogBounded(self):
+        """ queries logged only for counting don't pile up """
+        from django_messages.instrumentation import _query_log
+        count = len(_query_log(connection))
+        self.compose()
+        self.assertTrue(self.events[-1]['queries'] > 0)
+        if isinstance(_query_log(connection), list):
+            self.assertEqual(len(_query_log(connection)), count)
+
+
+class ArchiveTestCase(UsersTestCase):
+    def setUp(self):
+        self.create_users('user7', 'user8')
+        self.old = Message.objects.create(sender=self.user1,
+                                          recipient=self.user2,
+                                          subject='Old', body='Old')
+        self.reply = Message.objects.create(sender=self.user2,
+                                            recipient=self.user1,
+                                            subject='Re: Old', body='New',
+                                            parent_msg=self.old)
+        Message.objects.filter(pk=self.old.pk).update(
+            sent_at=timezone.now() - datetime.timedelta(days=100))
+
+    def testArchive(self):
+        """ old messages move to the archive table, replies keep resolving """
+        call_command('archive_messages', '90', batch_size=1, verbosity=0)
+        self.assertEqual(Message.objects.inbox_for(self.user2).count(), 0)
+        self.assertEqual(Message.objects.inbox_for(self.user1).count(), 1)
+        archived = ArchivedMessage.objects.inbox_for(self.user2)
+        self.assertEqual([m.pk for m in archived], [self.old.pk])
+        reply = Message.objects.get(pk=self.reply.pk)
+        self.assertEqual(reply.get_parent().pk, self.old.pk)
+        self.assertTrue(isinstance(reply.get_parent(), ArchivedMessage))
+
+    @override_settings(DJANGO_MESSAGES_CHANGE_LOG=True,
+                       DJANGO_MESSAGES_QUOTA_MESSAGES=10,
+                       DJANGO_MESSAGES_INDEX_BACKEND='django_messages.index.MemoryIndex')
+    def testArchiveCleansUp(self):
+        """ archiving keeps attachments, records changes and updates the index and counters """
+        from django_messages import index
+        index._index_cache.clear()
+        index.rebuild(self.user2)
+        blob = AttachmentBlob.objects.create(sha256='0' * 64, size=1, file='blob')
+        attachment = Attachment.objects.create(message=self.old, blob=blob,
+                                               filename='a.txt',
+                                               content_type='text/plain')
+        call_command('enforce_mailbox_quotas', recount=True, verbosity=0)
+        self.assertEqual(MailboxUsage.objects.get(user=self.user2).message_count, 1)
+        call_command('archive_messages', '90', verbosity=0)
+        self.assertFalse(Attachment.objects.exists())
+        archived = ArchivedAttachment.objects.get()
+        self.assertEqual((archived.pk, archived.message_id, archived.blob_id),
+                         (attachment.pk, self.old.pk, blob.pk))
+        call_command('delete_orphaned_attachments', verbosity=0)
+        self.assertTrue(AttachmentBlob.objects.filter(pk=blob.pk).exists())
+        self.assertEqual(set(MessageChange.objects.filter(event=MessageChange.ARCHIVED)
+                             .values_list('user', 'message_id')),
+                         set([(self.user1.pk, self.old.pk), (self.user2.pk, self.old.pk)]))
+        self.assertFalse(MessageChange.objects.filter(event=MessageChange.PURGED).exists())
+        self.assertEqual(Message.objects.page_for('inbox', self.user2), [])
+        self.assertEqual(MailboxUsage.objects.get(user=self.user2).message_count, 0)
+        index._index_cache.clear()
+
+
+class SnippetTestCase(UsersTestCase):
+    def setUp(self):
+        self.create_users('user9', 'user10')
+        self.msg = Message.objects.create(sender=self.user1,
+                                          recipient=self.user2,
+                                          subject='Subject',
+                                          body='Lorem   ipsum\n' * 20)
+
+    def testSnippet(self):
+        """ the snippet is filled in on save and list views defer the body """
+        self.assertEqual(len(self.msg.snippet), 100)
+        self.assertTrue(self.msg.snippet.startswith('Lorem ipsum Lorem'))
+        message = Message.objects.inbox_for(self.user2)[0]
+        self.assertFalse('body' in message.__dict__)
+        self.assertEqual(message.snippet, self.msg.snippet)
+
+    def testBackfill(self):
+        """ the backfill command fills in missing snippets """
+        Message.objects.update(snippet='')
+        call_command('backfill_message_snippets', verbosity=0)
+        self.assertEqual(Message.objects.get(pk=self.msg.pk).snippet,
+                         self.msg.snippet)
+
+
+class CompressionTestCase(UsersTestCase):
+    BODY = u'> quoted line of a long reply chain\n' * 100
+
+    def setUp(self):
+        self.create_users('user11', 'user12')
+
+    def stored_body(self, message):
+        return Message.objects.filter(pk=message.pk).values_list(
+            'body', flat=True)[0]
+
+    @override_settings(DJANGO_MESSAGES_COMPRESS_BODY=True)
+    def testCompressOnSave(self):
+        """ large bodies are stored compressed and read back transparently """
+        msg = Message.objects.create(sender=self.user1, recipient=self.user2,
+                                     subject='Subject', body=self.BODY)
+        short = Message.objects.create(sender=self.user1,
+                                       recipient=self.user2,
+                                       subject='Subject', body='short')
+        self.assertTrue(is_compressed(self.stored_body(msg)))
+        self.assertTrue(len(self.stored_body(msg)) < len(self.BODY))
+        self.assertEqual(self.stored_body(short), 'short')
+        self.assertEqual(Message.objects.get(pk=msg.pk).body, self.BODY)
+
+    def testCompressCommand(self):
+        """ the command compresses existing rows """
+        msg = Message.objects.create(sender=self.user1, recipient=self.user2,
+                                     subject='Subject', body=self.BODY)
+        self.assertFalse(is_compressed(self.stored_body(msg)))
+        call_command('compress_message_bodies', verbosity=0)
+        self.assertTrue(is_compressed(self.stored_body(msg)))
+        self.assertEqual(Message.objects.get(pk=msg.pk).body, self.BODY)
+
+    def testPrefixInText(self):
+        """ text starting with a compression prefix is stored escaped """
+        body = u'\x01zlib:not base64'
+        for enabled in (False, True):
+            with self.settings(DJANGO_MESSAGES_COMPRESS_BODY=enabled):
+                msg = Message.objects.create(sender=self.user1, recipient=self.user2,
+                                             subject='Subject', body=body)
+            self.assertFalse(is_compressed(self.stored_body(msg)))
+            self.assertEqual(Message.objects.get(pk=msg.pk).body, body)
+
+    def testUndecodableValue(self):
+        """ a stored value which can't be decompressed is returned as it is """
+        msg = Message.objects.create(sender=self.user1, recipient=self.user2,
+                                     subject='Subject', body='Body')
+        Message.objects.filter(pk=msg.pk).update(body=EncodedText(u'\x01zlib:bm90IHpsaWI='))
+        self.assertEqual(Message.objects.get(pk=msg.pk).body, u'\x01zlib:bm90IHpsaWI=')
+
+
+@override_settings(
+    DJANGO_MESSAGES_REPLICA_DATABASE='replica',
+    MIDDLEWARE_CLASSES=(
+        'django.contrib.sessions.middleware.SessionMiddleware',
+        'django.contrib.auth.middleware.AuthenticationMiddleware',
+        'django.contrib.messages.middleware.MessageMiddleware',
+        'django_messages.middleware.ReplicaPinningMiddleware',
+    ))
+class ReplicaRoutingTestCase(UsersTestCase):
+    """
+    Uses a second, empty SQLite database as the replica, so reads which are
+    routed to the replica see no messages at all.
+    """
+    multi_db = True
+
+    def setUp(self):
+        self.routers = router.routers
+        router.routers = [ReplicaRouter()]
+        self.create_users('user13', 'user14')
+        User.objects.db_manager('replica').create_user(
+            'user13', 'user13@example.com', self.password)
+        self.c = self.login('user13')
+
+    def tearDown(self):
+        router.routers = self.routers
+        pin_to_primary(False)
+
+    def testRouting(self):
+        """ reads go to the replica unless the thread wrote messages """
+        pin_to_primary(False)
+        self.assertEqual(Message.objects.inbox_for(self.user1).db, 'replica')
+        Message.objects.create(sender=self.user1, recipient=self.user2,
+                               subject='Subject', body='Body')
+        self.assertEqual(Message.objects.inbox_for(self.user1).db, 'default')
+        self.assertEqual(Message.objects.using('default').count(), 1)
+        self.assertEqual(Message.objects.using('replica').count(), 0)
+        pin_to_primary(False)
+        self.assertEqual(MessageChange.objects.all().db, 'default')
+        self.assertEqual(IdempotencyKey.objects.all().db, 'default')
+
+    def testPinningScope(self):
+        """ writes outside requests only pin the thread until the end of the scope """
+        with pinning_scope():
+            Message.objects.create(sender=self.user1, recipient=self.user2,
+                                   subject='Subject', body='Body')
+            self.assertEqual(Message.objects.inbox_for(self.user1).db, 'default')
+        self.assertEqual(Message.objects.inbox_for(self.user1).db, 'replica')
+        Message.objects.create(sender=self.user1, recipient=self.user2,
+                               subject='Subject', body='Body')
+        request_finished.send(sender=self.__class__)
+        self.assertEqual(Message.objects.inbox_for(self.user1).db, 'replica')
+
+    def testReadYourWrites(self):
+        """ the sender sees the message in the outbox right after sending """
+        response = self.c.post(reverse('messages_compose'), {
+            'recipient': 'user14', 'subject': 'Subject', 'body': 'Body'})
+        self.assertEqual(response.status_code, 302)
+        response = self.c.get(reverse('messages_outbox'))
+        self.assertEqual(len(response.context['message_list']), 1)
+        # without the pin the request reads from the (lagging) replica
+        self.c.logout()
+        self.c.login(username='user13', password=self.password)
+        cache.clear()
+        response = self.c.get(reverse('messages_outbox'))
+        self.assertEqual(len(response.context['message_list']), 0)
+
+
+@override_settings(DJANGO_MESSAGES_SHARDS=['shard1', 'shard2'])
+class ShardingTestCase(UsersTestCase):
+    multi_db = True
+    # users with fixed ids, so their shards are known
+    USERS = (
+        (1001, 'shard_sender', 'shard2'),
+        (1002, 'shard_local', 'shard2'),
+        (1004, 'shard_remote', 'shard1'),
+    )
+
+    def setUp(self):
+        self.routers = router.routers
+        router.routers = [ShardRouter()]
+        users = []
+        for pk, username, shard in self.USERS:
+            user = User(pk=pk, username=username, email='%s@example.com' % username)
+            user.set_password(self.password)
+            user.save()
+            self.assertEqual(shard_for_user(user), shard)
+            users.append(user)
+        self.sender, self.local, self.remote = users
+        self.c = self.login(self.remote.username)
+
+    def tearDown(self):
+        router.routers = self.routers
+
+    def compose(self):
+        form = ComposeForm({
+            'recipient': '%s, %s' % (self.local.username, self.remote.username),
+            'subject': 'Subject', 'body': 'Body'})
+        self.assertTrue(form.is_valid())
+        return form.save(sender=self.sender)
+
+    def testFanOut(self):
+        """ messages are stored on the shards of sender and recipients """
+        self.compose()
+        self.assertEqual(Message.objects.using('default').count(), 0)
+        self.assertEqual(Message.objects.outbox_for(self.sender).count(), 2)
+        self.assertEqual(Message.objects.inbox_for(self.local).count(), 1)
+        self.assertEqual(Message.objects.inbox_for(self.remote).count(), 1)
+        self.assertEqual(
+            Message.objects.inbox_for(self.remote).db,
+            shard_for_user(self.remote))
+
+    def testViewAndPurge(self):
+        """ views and the purge command work on the user's shard """
+        self.compose()
+        message = Message.objects.inbox_for(self.remote)[0]
+        response = self.c.get(reverse('messages_detail',
+                                      kwargs={'message_id': message.pk}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['message'].sender, self.sender)
+        self.c.get(reverse('messages_delete',
+                           kwargs={'message_id': message.pk}))
+        self.assertEqual(Message.objects.trash_for(self.remote).count(), 1)
+        # the remote copy was marked as deleted by the sender when sent
+        two_days_ago = timezone.now() - datetime.timedelta(days=2)
+        Message.objects.using(shard_for_user(self.remote)).filter(
+            recipient=self.remote).update(recipient_deleted_at=two_days_ago,
+                                          sender_deleted_at=two_days_ago)
+        call_command('delete_deleted_messages', '1')
+        self.assertEqual(Message.objects.trash_for(self.remote).count(), 0)
+        self.assertEqual(Message.objects.outbox_for(self.sender).count(), 2)
+
+    @override_settings(DJANGO_MESSAGES_CHANGE_LOG=True)
+    def testPurgeChanges(self):
+        """ purging a shard records changes only for users living there """
+        self.compose()
+        two_days_ago = timezone.now() - datetime.timedelta(days=2)
+        Message.objects.using(shard_for_user(self.remote)).update(
+            recipient_deleted_at=two_days_ago, sender_deleted_at=two_days_ago)
+        call_command('delete_deleted_messages', '1')
+        purged = MessageChange.objects.filter(event=MessageChange.PURGED)
+        self.assertEqual(purged.using(shard_for_user(self.remote)).count(), 1)
+        self.assertEqual(purged.using(shard_for_user(self.sender)).count(), 0)
+
+    def testSenderCopyFlag(self):
+        """ post_save handlers can tell the sender's copies apart """
+        from django.db.models.signals import post_save
+        saved = []
+
+        def receiver(sender, instance, **kwargs):
+            saved.append((instance.recipient, getattr(instance, 'is_sender_copy', False)))
+        post_save.connect(receiver, sender=Message)
+        try:
+            self.compose()
+        finally:
+            post_save.disconnect(receiver, sender=Message)
+        self.assertEqual(sorted(saved, key=lambda s: (s[0].pk, s[1])), [
+            (self.local, False), (self.remote, False), (self.remote, True)])
+
+    def testAdmin(self):
+        """ messages sent in the admin are stored on the shards of their users """
+        User.objects.create_superuser('shard_admin', 'admin@example.com', self.password)
+        c = self.login('shard_admin')
+        response = c.post(reverse('admin:django_messages_message_add'), {
+            'sender': self.sender.pk, 'recipient': self.local.pk, 'group': 'all',
+            'subject': 'Broadcast', 'body': 'Body',
+            'sent_at_0': '2010-01-01', 'sent_at_1': '12:00:00'})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(Message.objects.using('default').count(), 0)
+        for user in (self.local, self.remote):
+            message = Message.objects.inbox_for(user).get(subject='Broadcast')
+            self.assertEqual(message._state.db, shard_for_user(user))
+        # one message for every user, including the sender and the admin
+        self.assertEqual(Message.objects.outbox_for(self.sender)
+                         .filter(subject='Broadcast').count(), 4)
+
+    def testAllowMigrate(self):
+        """ message tables are only created on the shards, users off them """
+        shard_router = ShardRouter()
+        self.assertTrue(shard_router.allow_migrate('shard1', Message))
+        self.assertFalse(shard_router.allow_migrate('default', Message))
+        self.assertEqual(shard_router.allow_migrate('default', MailboxUsage), None)
+        self.assertFalse(shard_router.allow_migrate('shard1', MailboxUsage))
+        self.assertFalse(shard_router.allow_migrate('shard2', User))
+        self.assertEqual(shard_router.allow_migrate('default', User), None)
+
+
+class AdminTestCase(UsersTestCase):
+    def setUp(self):
+        self.admin = User.objects.create_superuser(
+            'admin', 'admin@example.com', self.password)
+        self.create_users('user15', 'user16')
+        Message.objects.create(sender=self.user1, recipient=self.user2,
+                               subject='From 1', body='Body')
+        Message.objects.create(sender=self.user2, recipient=self.user1,
+                               subject='From 2', body='Body')
+        self.c = self.login('admin')
+
+    def testChangelistFilters(self):
+        """ sender and recipient are filtered by id """
+        url = reverse('admin:django_messages_message_changelist')
+        response = self.c.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['cl'].result_count, 2)
+        response = self.c.get(url, {'sender__id__exact': self.user1.pk})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([m.subject for m in response.context['cl'].result_list],
+                         ['From 1'])
+        response = self.c.get(url, {'recipient__id__exact': self.user1.pk})
+        self.assertEqual([m.subject for m in response.context['cl'].result_list],
+                         ['From 2'])
+        self.assertEqual(response.context['cl'].full_result_count, 2)
+
+    def testGroupChoicesCached(self):
+        """ group choices are cached until a group changes """
+        cache.clear()
+        Group.objects.create(name='Group 1')
+        MessageAdminForm()
+        with self.assertNumQueries(0):
+            MessageAdminForm()
+        Group.objects.create(name='Group 2')
+        self.assertEqual(len(MessageAdminForm().fields['group'].choices), 4)
+
+
+class ExportTestCase(UsersTestCase):
+    def setUp(self):
+        self.create_users('user17', 'user18')
+        self.msg = Message.objects.create(sender=self.user1,
+                                          recipient=self.user2,
+                                          subject='Subject',
+                                          body='From here\nBody')
+        Message.objects.create(sender=self.user2, recipient=self.user1,
+                               subject='Re: Subject', body='Reply',
+                               parent_msg=self.msg,
+                               recipient_deleted_at=timezone.now())
+        self.c = self.login('user17')
+
+    def testJsonl(self):
+        """ the whole mailbox is streamed as JSON lines """
+        response = self.c.get(reverse('messages_export'))
+        self.assertEqual(response.status_code, 200)
+        lines = b''.join(response.streaming_content).decode('utf-8').splitlines()
+        data = [json.loads(line) for line in lines]
+        self.assertEqual([d['folders'] for d in data], [['outbox'], ['trash']])
+        self.assertEqual(data[1]['parent_id'], self.msg.pk)
+        self.assertEqual(data[0]['recipient'], 'user18')
+
+    def testArchived(self):
+        """ archived messages are exported in order with the others """
+        Message.objects.filter(pk=self.msg.pk).update(
+            sent_at=timezone.now() - datetime.timedelta(days=100))
+        call_command('archive_messages', '90', verbosity=0)
+        exported = [m.pk for m in iter_mailbox(self.user1)]
+        self.assertEqual(exported, sorted(exported))
+        self.assertEqual(len(exported), 2)
+        self.assertTrue(isinstance(next(iter_mailbox(self.user1)), ArchivedMessage))
+
+    def testMbox(self):
+        """ mbox exports quote lines starting with 'From ' """
+        response = self.c.get(reverse('messages_export'), {'format': 'mbox'})
+        content = b''.join(response.streaming_content).decode('utf-8')
+        self.assertEqual(content.count('\nFrom: '), 2)
+        self.assertTrue('\n>From here\n' in content)
+        self.assertTrue('In-Reply-To: <%s@django-messages>' % self.msg.pk
+                        in content)
+        response = self.c.get(reverse('messages_export'), {'format': 'xml'})
+        self.assertEqual(response.status_code, 404)
+
+
+class ImportTestCase(UsersTestCase):
+    def setUp(self):
+        self.create_users('user19', 'user20')
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, name, content):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def testJsonl(self):
+        """ messages keep their dates, replies are linked """
+        records = [
+            {'id': 1001, 'sender': 'user19', 'recipient': 'user20',
+             'subject': 'Subject', 'body': 'Body',
+             'sent_at': '2010-01-01T10:00:00Z',
+             'read_at': '2010-01-02T10:00:00Z'},
+            {'id': 1002, 'parent_id': 1001, 'sender': 'user20',
+             'recipient': 'user19', 'subject': 'Re: Subject', 'body': 'Reply',
+             'sent_at': '2010-01-03T10:00:00Z',
+             'expires_at': '2030-01-01T10:00:00Z'},
+            {'id': 1003, 'sender': 'unknown', 'recipient': 'user19',
+             'subject': 'Subject', 'body': 'Body'},
+        ]
+        path = self.write('messages.jsonl',
+                          '\n'.join(json.dumps(r) for r in records))
+        call_command('import_messages', path, batch_size=1, verbosity=0)
+        self.assertEqual(Message.objects.count(), 2)
+        self.assertEqual(len(mail.outbox), 0)
+        message = Message.objects.get(subject='Subject')
+        self.assertEqual(message.sent_at.year, 2010)
+        self.assertFalse(message.new())
+        self.assertFalse(message.expires())
+        self.assertEqual(message.snippet, 'Body')
+        reply = Message.objects.get(subject='Re: Subject')
+        self.assertEqual(reply.parent_msg, message)
+        self.assertEqual(reply.expires_at.year, 2030)
+
+    def testIds(self):
+        """ messages get new ids, replies are only linked to parents in the file """
+        from django.utils.six import StringIO
+        existing = Message.objects.create(sender=self.user1, recipient=self.user2,
+                                          subject='Existing', body='Body')
+        records = [
+            {'id': existing.pk + 100, 'parent_id': existing.pk, 'sender': 'user20',
+             'recipient': 'user19', 'subject': 'Re: Imported', 'body': 'Reply'},
+            {'id': existing.pk, 'sender': 'user20', 'recipient': 'user19',
+             'subject': 'Imported', 'body': 'Body'},
+            {'id': existing.pk + 200, 'parent_id': 5000, 'sender': 'user20',
+             'recipient': 'user19', 'subject': 'Re: Unknown', 'body': 'Reply'},
+        ]
+        path = self.write('messages.jsonl',
+                          '\n'.join(json.dumps(r) for r in records))
+        stderr = StringIO()
+        call_command('import_messages', path, batch_size=1, verbosity=0, stderr=stderr)
+        self.assertEqual(Message.objects.get(pk=existing.pk).subject, 'Existing')
+        imported = Message.objects.get(subject='Imported')
+        self.assertEqual(Message.objects.get(subject='Re: Imported').parent_msg, imported)
+        self.assertEqual(Message.objects.get(subject='Re: Unknown').parent_msg, None)
+        self.assertTrue('1 replies without their parent' in stderr.getvalue())
+
+    @override_settings(DJANGO_MESSAGES_CHANGE_LOG=True, DJANGO_MESSAGES_QUOTA_MESSAGES=10,
+                       DJANGO_MESSAGES_INDEX_BACKEND='django_messages.index.MemoryIndex')
+    def testMailboxes(self):
+        """ the counters, the index and the change log include imported messages """
+        from django_messages import index
+        index._index_cache.clear()
+        call_command('rebuild_mailbox_index', verbosity=0)
+        path = self.write('messages.jsonl', json.dumps(
+            {'sender': 'user19', 'recipient': 'user20', 'subject': 'Subject', 'body': 'Body'}))
+        call_command('import_messages', path, verbosity=0)
+        message = Message.objects.get()
+        self.assertEqual(MailboxUsage.objects.get(user=self.user2).message_count, 1)
+        self.assertEqual(index.get_index().page(self.user2.pk, 'inbox', 0, 10), [message.pk])
+        self.assertEqual(sorted(MessageChange.objects.values_list('user', 'message_id', 'event')),
+                         [(self.user1.pk, message.pk, 'created'),
+                          (self.user2.pk, message.pk, 'created')])
+        index._index_cache.clear()
+
+    def testCsv(self):
+        """ CSV files with a header row can be imported """
+        path = self.write('messages.csv',
+                          'sender,recipient,subject,body,sent_at\n'
+                          'user19,user20,Subject,"Body, with comma",'
+                          '2011-05-01 12:00:00\n')
+        call_command('import_messages', path, verbosity=0)
+        message = Message.objects.inbox_for(self.user2)[0]
+        self.assertEqual(message.body, 'Body, with comma')
+        self.assertEqual(message.sent_at.year, 2011)
+
+
+@override_settings(DJANGO_MESSAGES_FRAGMENT_CACHE_TIMEOUT=60)
+class FragmentCacheTestCase(UsersTestCase):
+    def setUp(self):
+        self.create_users('user21', 'user22')
+        self.msg = Message.objects.create(sender=self.user1,
+                                          recipient=self.user2,
+                                          subject='Subject', body='Body')
+        cache.clear()
+        self.c = self.login('user22')
+
+    def get_inbox(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.c.get(reverse('messages_inbox'))
+        return response.content.decode('utf-8'), len(queries)
+
+    def testRowsCached(self):
+        """ rows are rendered once until the message changes """
+        content, first = self.get_inbox()
+        self.assertTrue('<strong>' in content)
+        cached_content, second = self.get_inbox()
+        self.assertEqual(cached_content, content)
+        # the sender of the message isn't loaded for the cached row
+        self.assertEqual(second, first - 1)
+        self.c.get(reverse('messages_detail',
+                           kwargs={'message_id': self.msg.pk}))
+        content, third = self.get_inbox()
+        self.assertFalse('<strong>' in content)
+        self.assertEqual(third, first)
+
+    def testBodyChange(self):
+        """ the message view is rendered again when the body changes """
+        from django_messages.caching import message_version
+        message = Message.objects.get(pk=self.msg.pk)
+        message.body = 'x' * 200
+        message.save()
+        version = message_version(Message.objects.get(pk=self.msg.pk))
+        message.body = 'x' * 200 + 'y'
+        message.save()
+        self.assertNotEqual(message_version(Message.objects.get(pk=self.msg.pk)), version)
+        # the rows of list views don't load the body
+        row = Message.objects.inbox_for(self.user2)[0]
+        with self.assertNumQueries(0):
+            message_version(row)
+
+
+@override_settings(DJANGO_MESSAGES_QUOTA_MESSAGES=2,
+                   DJANGO_MESSAGES_TRASH_RETENTION_DAYS=30)
+class QuotaTestCase(UsersTestCase):
+    def setUp(self):
+        self.create_users('user23', 'user24')
+        now = timezone.now()
+        self.msgs = []
+        for i in range(4):
+            msg = Message.objects.create(sender=self.user1, recipient=self.user2,
+                                         subject='Subject %d' % i, body='Body')
+            Message.objects.filter(pk=msg.pk).update(
+                sent_at=now - datetime.timedelta(days=4 - i))
+            self.msgs.append(msg)
+
+    def usage(self):
+        return MailboxUsage.objects.get(user=self.user2)
+
+    def testCounters(self):
+        """ received, deleted and recovered messages update the counters """
+        self.assertEqual(self.usage().message_count, 4)
+        self.assertEqual(self.usage().stored_bytes, 16)
+        c = self.login('user24')
+        c.get(reverse('messages_delete', kwargs={'message_id': self.msgs[0].pk}))
+        c.get(reverse('messages_delete', kwargs={'message_id': self.msgs[0].pk}))
+        self.assertEqual(self.usage().message_count, 3)
+        c.get(reverse('messages_undelete', kwargs={'message_id': self.msgs[0].pk}))
+        self.assertEqual(self.usage().message_count, 4)
+        self.assertFalse(MailboxUsage.objects.filter(user=self.user1).exists())
+
+    def testEnforceQuota(self):
+        """ the oldest messages of users over quota are moved to the trash """
+        call_command('enforce_mailbox_quotas', verbosity=0)
+        inbox = Message.objects.inbox_for(self.user2)
+        self.assertEqual(sorted(m.pk for m in inbox),
+                         [self.msgs[2].pk, self.msgs[3].pk])
+        self.assertEqual(self.usage().message_count, 2)
+        self.assertEqual(self.usage().stored_bytes, 8)
+
+    def testStaleCounter(self):
+        """ users are recounted before their messages are trashed """
+        Message.objects.filter(pk__in=[self.msgs[0].pk, self.msgs[1].pk]).update(
+            recipient_deleted_at=timezone.now())
+        self.assertEqual(self.usage().message_count, 4)
+        call_command('enforce_mailbox_quotas', verbosity=0)
+        inbox = Message.objects.inbox_for(self.user2)
+        self.assertEqual(sorted(m.pk for m in inbox),
+                         [self.msgs[2].pk, self.msgs[3].pk])
+        self.assertEqual(self.usage().message_count, 2)
+
+    def testRecount(self):
+        """ the recount rebuilds the usage rows from the messages in the inbox """
+        MailboxUsage.objects.all().delete()
+        Message.objects.filter(pk=self.msgs[0].pk).update(
+            recipient_deleted_at=timezone.now())
+        with override_settings(DJANGO_MESSAGES_QUOTA_MESSAGES=None):
+            call_command('enforce_mailbox_quotas', recount=True, verbosity=0)
+        self.assertEqual(self.usage().message_count, 3)
+        self.assertEqual(self.usage().stored_bytes, 12)
+        self.assertFalse(MailboxUsage.objects.filter(user=self.user1).exists())
+
+    def testTrashRetention(self):
+        """ messages trashed by both users for longer than the retention are purged """
+        old = timezone.now() - datetime.timedelta(days=31)
+        Message.objects.filter(pk__in=[self.msgs[0].pk, self.msgs[1].pk]).update(
+            sender_deleted_at=old, recipient_deleted_at=old)
+        Message.objects.filter(pk=self.msgs[2].pk).update(sender_deleted_at=old)
+        call_command('enforce_mailbox_quotas', batch_size=1, verbosity=0)
+        self.assertEqual(sorted(Message.objects.values_list('pk', flat=True)),
+                         [self.msgs[2].pk, self.msgs[3].pk])
+
+class ImportTimeTestCase(TestCase):
+    IMPORT_SCRIPT = (
+        "import sys, time\n"
+        "start = time.time()\n"
+        "import django\n"
+        "if hasattr(django, 'setup'):\n"
+        "    django.setup()\n"
+        "import django_messages.views, django_messages.forms, django_messages.admin\n"
+        "print('%f' % (time.time() - start))\n"
+        "print('django.contrib.sites.models' in sys.modules)\n"
+    )
+
+    def testImportTime(self):
+        """ setting up and importing the app is fast and has no side effects """
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        process = subprocess.Popen([sys.executable, '-c', self.IMPORT_SCRIPT],
+                                   env=env, stdout=subprocess.PIPE)
+        output = process.communicate()[0].decode('utf-8').split()
+        self.assertEqual(process.returncode, 0)
+        duration, sites_imported = float(output[0]), output[1]
+        self.assertEqual(len(output), 2)
+        if django.VERSION[:2] >= (1, 7):
+            # before, loading the user model imports all installed apps,
+            # and the admin imports the sites framework
+            self.assertEqual(sites_imported, 'False')
+        self.assertTrue(duration < 5, 'importing took %.2fs' % duration)
+
+
+@override_settings(DJANGO_MESSAGES_BUFFER_READS=True)
+class ReadReceiptTestCase(UsersTestCase):
+    def setUp(self):
+        self.create_users('user25', 'user26')
+        self.msg1 = Message.objects.create(sender=self.user1, recipient=self.user2,
+                                           subject='Subject 1', body='Body')
+        self.msg2 = Message.objects.create(sender=self.user1, recipient=self.user2,
+                                           subject='Subject 2', body='Body')
+        cache.clear()
+        self.c = self.login('user26')
+
+    def read(self, msg):
+        return self.c.get(reverse('messages_detail', kwargs={'message_id': msg.pk}))
+
+    def testBufferedRead(self):
+        """ reads are visible right away and written by the flush command """
+        self.read(self.msg1)
+        self.assertEqual(Message.objects.get(pk=self.msg1.pk).read_at, None)
+        self.assertEqual(list(get_buffered_reads(self.user2)), [self.msg1.pk])
+        self.assertEqual(inbox_count_for(self.user2), 1)
+        response = self.c.get(reverse('messages_inbox'))
+        self.assertEqual(response.content.decode('utf-8').count('<strong>'), 1)
+        call_command('flush_read_receipts', verbosity=0)
+        self.assertNotEqual(Message.objects.get(pk=self.msg1.pk).read_at, None)
+        self.assertEqual(Message.objects.get(pk=self.msg2.pk).read_at, None)
+        self.assertEqual(get_buffered_reads(self.user2), {})
+        self.assertEqual(inbox_count_for(self.user2), 1)
+
+    def testMiddlewareFlush(self):
+        """ the middleware writes the buffer once it is full """
+        middleware = settings.MIDDLEWARE_CLASSES + (
+            'django_messages.middleware.ReadReceiptMiddleware',)
+        with override_settings(MIDDLEWARE_CLASSES=middleware,
+                               DJANGO_MESSAGES_READ_BUFFER_SIZE=2):
+            self.read(self.msg1)
+            self.assertEqual(Message.objects.filter(read_at__isnull=False).count(), 0)
+            self.read(self.msg2)
+            self.assertEqual(Message.objects.filter(read_at__isnull=False).count(), 2)
+        self.assertEqual(get_buffered_reads(self.user2), {})
+
+    @override_settings(DJANGO_MESSAGES_CHANGE_LOG=True)
+    def testFlushRecordsChanges(self):
+        """ flushed reads are recorded once for the sender and the recipient """
+        from django_messages.receipts import flush_user
+        self.read(self.msg1)
+        flush_user(self.user2.pk)
+        self.assertEqual(sorted(MessageChange.objects.filter(event=MessageChange.READ)
+                                .values_list('user', 'message_id')),
+                         sorted([(self.user1.pk, self.msg1.pk), (self.user2.pk, self.msg1.pk)]))
+
+    @override_settings(DJANGO_MESSAGES_CHANGE_LOG=True)
+    def testFlushAgain(self):
+        """ reads left in the buffer by a busy flush are not written twice """
+        from django_messages.receipts import buffer_cache_key, flush_user
+        self.read(self.msg1)
+        reads = get_buffered_reads(self.user2)
+        self.assertEqual(flush_user(self.user2.pk), 1)
+        cache.set(buffer_cache_key(self.user2.pk), reads)
+        self.assertEqual(flush_user(self.user2.pk), 0)
+        self.assertEqual(get_buffered_reads(self.user2), {})
+        self.assertEqual(MessageChange.objects.filter(event=MessageChange.READ).count(), 2)
+
+class FolderCountsTestCase(UsersTestCase):
+    def setUp(self):
+        self.create_users('user27', 'user28')
+        now = timezone.now()
+        Message.objects.create(sender=self.user1, recipient=self.user2,
+                               subject='Unread', body='Body')
+        Message.objects.create(sender=self.user1, recipient=self.user2,
+                               subject='Read', body='Body', read_at=now)
+        Message.objects.create(sender=self.user2, recipient=self.user1,
+                               subject='Sent', body='Body')
+        Message.objects.create(sender=self.user1, recipient=self.user2,
+                               subject='Deleted', body='Body',
+                               recipient_deleted_at=now)
+        Message.objects.create(sender=self.user2, recipient=self.user2,
+                               subject='Note', body='Body', read_at=now,
+                               sender_deleted_at=now, recipient_deleted_at=now)
+
+    def testFolderCounts(self):
+        """ the counts match the folders and are computed with one query """
+        with CaptureQueriesContext(connection) as queries:
+            counts = Message.objects.folder_counts(self.user2)
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(counts, {
+            'inbox': Message.objects.inbox_for(self.user2).count(),
+            'unread': inbox_count_for(self.user2),
+            'outbox': Message.objects.outbox_for(self.user2).count(),
+            'trash': Message.objects.trash_for(self.user2).count(),
+        })
+        self.assertEqual(counts, {'inbox': 2, 'unread': 1, 'outbox': 1, 'trash': 2})
+
+    def testTemplateTag(self):
+        """ the folder_counts tag puts the counts of the user into the context """
+        from django.template import Context, Template
+        template = Template('{% load inbox %}{% folder_counts as counts %}'
+                            '{{ counts.inbox }}/{{ counts.unread }}/'
+                            '{{ counts.outbox }}/{{ counts.trash }}')
+        self.assertEqual(template.render(Context({'user': self.user1})), '1/1/3/0')
+
+class CappedCountTestCase(UsersTestCase):
+    def setUp(self):
+        self.create_users('user29', 'user30')
+        for i in range(5):
+            Message.objects.create(sender=self.user1, recipient=self.user2,
+                                   subject='Subject %d' % i, body='Body')
+
+    def testCappedCount(self):
+        """ counting stops after the cap and renders as "N+" """
+        self.assertEqual(inbox_count_for(self.user2), 5)
+        count = inbox_count_for(self.user2, cap=3)
+        self.assertEqual(count, 3)
+        self.assertEqual('%s' % count, '3+')
+        count = inbox_count_for(self.user2, cap=5)
+        self.assertEqual(count, 5)
+        self.assertEqual('%s' % count, '5')
+
+    @override_settings(DJANGO_MESSAGES_COUNT_CAP=2)
+    def testCountCapSetting(self):
+        """ DJANGO_MESSAGES_COUNT_CAP caps the counts of the template tag and views """
+        from django.template import Context, Template
+        template = Template('{% load inbox %}{% inbox_count %}')
+        self.assertEqual(template.render(Context({'user': self.user2})), '2+')
+        c = self.login('user30')
+        response = c.get(reverse('messages_inbox'))
+        self.assertEqual('%s' % response.context['message_count'], '2+')
+        response = c.get(reverse('messages_trash'))
+        self.assertEqual('%s' % response.context['message_count'], '0')
+
+@override_settings(DJANGO_MESSAGES_WARM_CACHE_ON_LOGIN=True,
+                   DJANGO_MESSAGES_WARM_CACHE_BACKGROUND=False,
+                   DJANGO_MESSAGES_FRAGMENT_CACHE_TIMEOUT=60)
+class CacheWarmingTestCase(UsersTestCase):
+    def setUp(self):
+        self.create_users('user31', 'user32')
+        self.msg = Message.objects.create(sender=self.user1, recipient=self.user2,
+                                          subject='Subject', body='Body')
+        cache.clear()
+        self.c = self.login('user32')
+
+    def testWarmOnLogin(self):
+        """ logging in loads the inbox and counts into the cache """
+        warm = get_warm_mailbox(self.user2)
+        self.assertEqual([m.pk for m in warm['inbox']], [self.msg.pk])
+        self.assertEqual(warm['unread'], 1)
+        self.assertEqual(warm['folders']['inbox'], 1)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(inbox_count_for(self.user2), 1)
+            self.assertEqual(Message.objects.folder_counts(self.user2)['inbox'], 1)
+        self.assertEqual(len(queries), 0)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.c.get(reverse('messages_inbox'))
+        self.assertTrue('Subject' in response.content.decode('utf-8'))
+        # only the session and the user are loaded
+        self.assertEqual(len(queries), 2)
+
+    def testInvalidation(self):
+        """ changes of the mailbox replace the cached data """
+        Message.objects.create(sender=self.user1, recipient=self.user2,
+                               subject='Another subject', body='Body')
+        self.assertEqual(get_warm_mailbox(self.user2), None)
+        response = self.c.get(reverse('messages_inbox'))
+        self.assertTrue('Another subject' in response.content.decode('utf-8'))
+        self.c.login(username='user32', password=self.password)
+        self.c.get(reverse('messages_detail', kwargs={'message_id': self.msg.pk}))
+        self.assertEqual(get_warm_mailbox(self.user2), None)
+        self.assertEqual(inbox_count_for(self.user2), 1)
+
+    @override_settings(DJANGO_MESSAGES_BUFFER_READS=True)
+    def testBufferedReads(self):
+        """ warmed rows and the unread count agree on buffered reads """
+        from django_messages.receipts import buffer_read
+        from django_messages.warming import warm_mailbox
+        buffer_read(self.user2, self.msg, timezone.now())
+        warm = warm_mailbox(self.user2)
+        self.assertEqual(warm['unread'], 0)
+        self.assertFalse(warm['inbox'][0].new())
+
+@override_settings(DJANGO_MESSAGES_CHANGE_LOG=True, DJANGO_MESSAGES_CHANGE_LOG_DELAY=0)
+class ChangeLogTestCase(UsersTestCase):
+    def setUp(self):
+        self.create_users('user33', 'user34')
+        self.c1 = self.login('user33')
+        self.c2 = self.login('user34')
+
+    def get_changes(self, client, since=0, limit=100):
+        response = client.get(reverse('messages_changes'),
+                              {'since': since, 'limit': limit})
+        self.assertEqual(response['Content-Type'], 'application/json')
+        return json.loads(response.content.decode('utf-8'))
+
+    def testEvents(self):
+        """ the views record the changes of both mailboxes """
+        self.c1.post(reverse('messages_compose'), {
+            'recipient': 'user34', 'subject': 'Subject', 'body': 'Body'})
+        msg = Message.objects.get(sender=self.user1)
+        self.c2.get(reverse('messages_detail', kwargs={'message_id': msg.pk}))
+        self.c2.post(reverse('messages_reply', kwargs={'message_id': msg.pk}), {
+            'recipient': 'user33', 'subject': 'Re: Subject', 'body': 'Reply'})
+        self.c2.get(reverse('messages_delete', kwargs={'message_id': msg.pk}))
+        self.c2.get(reverse('messages_delete', kwargs={'message_id': msg.pk}))
+        self.c2.get(reverse('messages_undelete', kwargs={'message_id': msg.pk}))
+        reply = Message.objects.get(sender=self.user2)
+
+        data = self.get_changes(self.c2)
+        self.assertEqual([(c['message_id'], c['event']) for c in data['changes']], [
+            (msg.pk, 'created'), (msg.pk, 'read'), (reply.pk, 'created'),
+            (msg.pk, 'replied'), (msg.pk, 'deleted'), (msg.pk, 'undeleted')])
+        self.assertEqual(data['cursor'], data['changes'][-1]['id'])
+        self.assertFalse(data['more'])
+        data = self.get_changes(self.c1)
+        self.assertEqual([c['event'] for c in data['changes']],
+                         ['created', 'read', 'created', 'replied'])
+
+        # paging
+        first = self.get_changes(self.c2, limit=4)
+        self.assertTrue(first['more'])
+        rest = self.get_changes(self.c2, since=first['cursor'], limit=4)
+        self.assertFalse(rest['more'])
+        self.assertEqual(len(first['changes']) + len(rest['changes']), 6)
+        self.assertEqual(self.get_changes(self.c2, since=rest['cursor'])['changes'], [])
+        self.assertEqual(self.c2.get(reverse('messages_changes'),
+                                     {'since': 'x'}).status_code, 400)
+
+    def testDelay(self):
+        """ recent changes and those after them are held back """
+        old = timezone.now() - datetime.timedelta(seconds=10)
+        first = MessageChange.objects.create(user=self.user2, message_id=1,
+                                             event='created', created_at=old)
+        MessageChange.objects.create(user=self.user2, message_id=2, event='created')
+        MessageChange.objects.create(user=self.user2, message_id=3,
+                                     event='created', created_at=old)
+        with self.settings(DJANGO_MESSAGES_CHANGE_LOG_DELAY=5):
+            data = self.get_changes(self.c2)
+        self.assertEqual([c['message_id'] for c in data['changes']], [1])
+        self.assertEqual(data['cursor'], first.pk)
+        self.assertFalse(data['more'])
+        data = self.get_changes(self.c2, since=data['cursor'])
+        self.assertEqual([c['message_id'] for c in data['changes']], [2, 3])
+
+    def testPurgeAndCompaction(self):
+        """ purged messages are recorded and old entries compacted """
+        old = timezone.now() - datetime.timedelta(days=10)
+        msg = Message.objects.create(sender=self.user1, recipient=self.user2,
+                                     subject='Subject', body='Body',
+                                     sender_deleted_at=old, recipient_deleted_at=old)
+        MessageChange.objects.create(user=self.user2, message_id=msg.pk,
+                                     event='created', created_at=old)
+        MessageChange.objects.create(user=self.user2, message_id=msg.pk,
+                                     event='deleted', created_at=old)
+        call_command('delete_deleted_messages', '5')
+        self.assertEqual(list(MessageChange.objects.filter(user=self.user2)
+                              .values_list('event', flat=True)),
+                         ['created', 'deleted', 'purged'])
+        call_command('compact_message_changes', '5', verbosity=0)
+        self.assertEqual(list(MessageChange.objects.filter(user=self.user2)
+                              .values_list('event', flat=True)), ['created', 'purged'])
+        self.assertEqual(list(MessageChange.objects.filter(user=self.user1)
+                              .values_list('event', flat=True)), ['purged'])
+
+class RemoteStorage(FileSystemStorage):
+    """a storage whose files have no local path"""
+    def _open(self, name, mode='rb'):
+        return File(open(super(RemoteStorage, self).path(name), mode))
+
+    def path(self, name):
+        raise NotImplementedError
+
+
+@override_settings(DJANGO_MESSAGES_ATTACHMENTS=True)
+class AttachmentTestCase(UsersTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.storage_settings = override_settings(
+            DJANGO_MESSAGES_ATTACHMENT_STORAGE='django.core.files.storage.FileSystemStorage',
+            MEDIA_ROOT=self.directory)
+        self.storage_settings.enable()
+        self.create_users('user35', 'user36', 'user37')
+        self.c = self.login('user35')
+
+    def tearDown(self):
+        self.storage_settings.disable()
+        shutil.rmtree(self.directory)
+
+    def send(self, content=b'0123456789'):
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        self.c.post(reverse('messages_compose'), {
+            'recipient': 'user36, user37', 'subject': 'Subject', 'body': 'Body',
+            'attachment': SimpleUploadedFile('digits.txt', content, 'text/plain'),
+        })
+
+    def download(self, username, attachment, **headers):
+        c = self.login(username)
+        return c.get(reverse('messages_attachment', kwargs={
+            'attachment_id': attachment.pk}), **headers)
+
+    def testDeduplication(self):
+        """ a file sent to several recipients, or again, is stored once """
+        self.send()
+        self.send()
+        self.assertEqual(Attachment.objects.count(), 4)
+        self.assertEqual(AttachmentBlob.objects.count(), 1)
+        self.assertEqual(len(os.listdir(os.path.join(
+            self.directory, 'django_messages', 'attachments'))), 1)
+
+    def testDownload(self):
+        """ sender and recipient can download the attachment, others can't """
+        self.send()
+        attachment = Attachment.objects.get(message__recipient=self.user2)
+        response = self.download('user36', attachment)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), b'0123456789')
+        self.assertEqual(response['Content-Type'], 'text/plain')
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertTrue('digits.txt' in response['Content-Disposition'])
+        self.assertEqual(self.download('user35', attachment).status_code, 200)
+        self.assertEqual(self.download('user37', attachment).status_code, 404)
+
+    def testRange(self):
+        """ range and conditional requests are answered """
+        self.send()
+        attachment = Attachment.objects.get(message__recipient=self.user2)
+        response = self.download('user36', attachment, HTTP_RANGE='bytes=2-5')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content), b'2345')
+        self.assertEqual(response['Content-Range'], 'bytes 2-5/10')
+        self.assertEqual(response['Content-Length'], '4')
+        response = self.download('user36', attachment, HTTP_RANGE='bytes=-3')
+        self.assertEqual(b''.join(response.streaming_content), b'789')
+        response = self.download('user36', attachment, HTTP_RANGE='bytes=20-')
+        self.assertEqual(response.status_code, 416)
+        response = self.download('user36', attachment,
+                                 HTTP_IF_NONE_MATCH='"%s"' % attachment.blob.sha256)
+        self.assertEqual(response.status_code, 304)
+
+    def testAccelRedirect(self):
+        """ nginx serves the file with x-accel-redirect """
+        self.send()
+        attachment = Attachment.objects.get(message__recipient=self.user2)
+        with self.settings(DJANGO_MESSAGES_ATTACHMENT_SENDFILE='x-accel-redirect'):
+            response = self.download('user36', attachment)
+        self.assertEqual(response['X-Accel-Redirect'],
+                         '/protected/' + attachment.blob.file.name)
+        self.assertEqual(response.content, b'')
+
+    def testSendfile(self):
+        """ x-sendfile falls back to streaming for storages without paths """
+        self.send()
+        attachment = Attachment.objects.get(message__recipient=self.user2)
+        with self.settings(DJANGO_MESSAGES_ATTACHMENT_SENDFILE='x-sendfile'):
+            response = self.download('user36', attachment)
+            self.assertEqual(response['X-Sendfile'], attachment.blob.file.path)
+            with self.settings(DJANGO_MESSAGES_ATTACHMENT_STORAGE='django_messages.tests.RemoteStorage'):
+                response = self.download('user36', attachment)
+        self.assertFalse(response.has_header('X-Sendfile'))
+        self.assertEqual(b''.join(response.streaming_content), b'0123456789')
+
+
+@override_settings(DJANGO_MESSAGES_INDEX_BACKEND='django_messages.index.MemoryIndex')
+class MailboxIndexTestCase(UsersTestCase):
+    def setUp(self):
+        from django_messages import index
+        index._index_cache.clear()
+        self.index = index.get_index()
+        self.create_users('user38', 'user39')
+        now = timezone.now()
+        self.messages = [
+            Message.objects.create(sender=self.user1, recipient=self.user2,
+                                   subject='Message %d' % i, body='Body',
+                                   sent_at=now - datetime.timedelta(minutes=10 - i))
+            for i in range(5)
+        ]
+
+    def tearDown(self):
+        from django_messages import index
+        index._index_cache.clear()
+
+    def pks(self, messages):
+        # pages defer the body, and before Django 1.7 deferred instances
+        # don't compare equal to full ones
+        return [m.pk for m in messages]
+
+    def testPageBeforeRebuild(self):
+        """ the database is used until the index of the user is built """
+        self.assertEqual(self.index.page(self.user2.pk, 'inbox', 0, 10), None)
+        page = Message.objects.page_for('inbox', self.user2, 0, 2)
+        self.assertEqual(self.pks(page), self.pks(self.messages[:-3:-1]))
+
+    def testPages(self):
+        call_command('rebuild_mailbox_index', 'user38', 'user39', verbosity=0)
+        self.assertEqual(self.index.count(self.user2.pk, 'inbox'), 5)
+        self.assertEqual(self.index.count(self.user1.pk, 'outbox'), 5)
+        with self.assertNumQueries(1):
+            page = Message.objects.page_for('inbox', self.user2, 1, 2)
+        self.assertEqual(self.pks(page), [self.messages[3].pk, self.messages[2].pk])
+        self.assertEqual(self.pks(Message.objects.page_for('outbox', self.user1, 4, 10)),
+                         [self.messages[0].pk])
+
+    def testUpdates(self):
+        call_command('rebuild_mailbox_index', verbosity=0)
+        c = self.login('user39')
+        msg = self.messages[4]
+        c.get(reverse('messages_delete', kwargs={'message_id': msg.pk}))
+        self.assertEqual(self.pks(Message.objects.page_for('trash', self.user2)), [msg.pk])
+        self.assertFalse(msg.pk in self.pks(Message.objects.page_for('inbox', self.user2)))
+        self.assertTrue(msg.pk in self.pks(Message.objects.page_for('outbox', self.user1)))
+        c.get(reverse('messages_undelete', kwargs={'message_id': msg.pk}))
+        self.assertEqual(self.pks(Message.objects.page_for('inbox', self.user2, 0, 1)),
+                         [msg.pk])
+        self.assertEqual(Message.objects.page_for('trash', self.user2), [])
+
+        c.post(reverse('messages_compose'), {
+            'recipient': 'user38', 'subject': 'New', 'body': 'Body'})
+        new = Message.objects.get(subject='New')
+        self.assertEqual(self.pks(Message.objects.page_for('inbox', self.user1)), [new.pk])
+        self.assertEqual(self.pks(Message.objects.page_for('outbox', self.user2)), [new.pk])
+
+        old = timezone.now() - datetime.timedelta(days=10)
+        Message.objects.filter(pk=msg.pk).update(
+            sender_deleted_at=old, recipient_deleted_at=old)
+        call_command('delete_deleted_messages', '5')
+        self.assertEqual(self.index.count(self.user2.pk, 'inbox'), 4)
+        self.assertEqual(self.index.count(self.user1.pk, 'outbox'), 4)
+
+    @override_settings(DJANGO_MESSAGES_PAGE_SIZE=2)
+    def testFolderViews(self):
+        """ with an index the folder views list a page at a time """
+        call_command('rebuild_mailbox_index', verbosity=0)
+        c = self.login('user39')
+        pages = []
+        for page in (1, 2, 3):
+            response = c.get(reverse('messages_inbox'), {'page': page})
+            pages.append((self.pks(response.context['message_list']),
+                          response.context['previous_page'],
+                          response.context['next_page']))
+        self.assertEqual(pages, [
+            ([self.messages[4].pk, self.messages[3].pk], None, 2),
+            ([self.messages[2].pk, self.messages[1].pk], 1, 3),
+            ([self.messages[0].pk], 2, None),
+        ])
+        self.assertEqual(response.context['message_count'], 5)
+        self.assertTrue('?page=2' in response.content.decode('utf-8'))
+        # the page is read from the index
+        self.index.remove(self.user2.pk, 'inbox', self.messages[4].pk)
+        response = c.get(reverse('messages_inbox'))
+        self.assertEqual(self.pks(response.context['message_list']),
+                         [self.messages[3].pk, self.messages[2].pk])
+        response = self.login('user38').get(reverse('messages_outbox'))
+        self.assertEqual(self.pks(response.context['message_list']),
+                         [self.messages[4].pk, self.messages[3].pk])
+
+    def testStaleEntries(self):
+        """ pages with messages no longer in the folder are read from the database """
+        call_command('rebuild_mailbox_index', verbosity=0)
+        Message.objects.filter(pk=self.messages[4].pk).update(
+            expires_at=timezone.now() - datetime.timedelta(minutes=1))
+        self.assertEqual(self.pks(Message.objects.page_for('inbox', self.user2, 0, 2)),
+                         [self.messages[3].pk, self.messages[2].pk])
+
+
+@override_settings(DJANGO_MESSAGES_RATE_LIMIT_MESSAGES=2,
+                   DJANGO_MESSAGES_RATE_LIMIT_RECIPIENTS=3)
+class RateLimitTestCase(UsersTestCase):
+    def setUp(self):
+        cache.clear()
+        self.create_users('user40', 'user41', 'user42')
+        self.c = self.login('user40')
+
+    def tearDown(self):
+        cache.clear()
+
+    def send(self, recipients):
+        return self.c.post(reverse('messages_compose'), {
+            'recipient': recipients, 'subject': 'Subject', 'body': 'Body'})
+
+    def testLimits(self):
+        """ messages and recipients are limited within a sliding window """
+        from django_messages import ratelimit
+        window = ratelimit.get_window()
+        now = 1000 * window
+        self.assertTrue(ratelimit.consume(self.user1, 2, now))
+        # a third recipient would still fit, a fourth doesn't
+        self.assertFalse(ratelimit.consume(self.user1, 2, now))
+        self.assertTrue(ratelimit.consume(self.user1, 1, now))
+        self.assertFalse(ratelimit.consume(self.user1, 1, now))
+        self.assertEqual(ratelimit.usage(self.user1, now),
+                         {'messages': 2, 'recipients': 3})
+        # the window slides: half way through the next one half still counts
+        later = now + window * 1.5
+        self.assertEqual(ratelimit.usage(self.user1, later),
+                         {'messages': 1, 'recipients': 1.5})
+        self.assertTrue(ratelimit.consume(self.user1, 1, later))
+        self.assertTrue(ratelimit.consume(self.user1, 1, now + window * 3))
+
+    def testComposeView(self):
+        """ a limited compose answers 429 and sends nothing """
+        self.assertEqual(self.send('user41, user42').status_code, 302)
+        response = self.send('user41, user42')
+        self.assertEqual(response.status_code, 429)
+        self.assertTrue(response.context['form'].non_field_errors())
+        self.assertEqual(Message.objects.filter(sender=self.user1).count(), 2)
+
+    def testRefund(self):
+        """ a message which failed to send doesn't count """
+        from django_messages import ratelimit
+        form = ComposeForm({'recipient': 'user41, user42', 'subject': 'Subject',
+                            'body': 'Body'}, sender=self.user1)
+        self.assertTrue(form.is_valid())
+        self.assertEqual(ratelimit.usage(self.user1)['messages'], 1)
+        def fail(*args):
+            raise ValueError
+        form.send = fail
+        self.assertRaises(ValueError, form.save, sender=self.user1)
+        self.assertEqual(ratelimit.usage(self.user1), {'messages': 0, 'recipients': 0})
+
+    def testStaffIsExempt(self):
+        """ staff users aren't limited """
+        self.user1.is_staff = True
+        self.user1.save()
+        for i in range(3):
+            self.assertEqual(self.send('user41, user42').status_code, 302)
+        self.assertEqual(Message.objects.filter(sender=self.user1).count(), 6)
+
+    def testUrlRecipients(self):
+        """ recipients from the url are cut to the recipient limit """
+        response = self.c.get(reverse('messages_compose_to',
+                                      kwargs={'recipient': 'user40+user40+user40+user41'}))
+        self.assertEqual(response.context['form'].fields['recipient'].initial, [self.user1])
+
+
+class ExpiryTestCase(UsersTestCase):
+    def setUp(self):
+        self.create_users('user43', 'user44')
+        now = timezone.now()
+        self.kept = Message.objects.create(sender=self.user1, recipient=self.user2,
+                                           subject='Kept', body='Body')
+        self.later = Message.objects.create(sender=self.user1, recipient=self.user2,
+                                            subject='Later', body='Body',
+                                            expires_at=now + datetime.timedelta(days=1))
+        self.expired = Message.objects.create(sender=self.user1, recipient=self.user2,
+                                              subject='Expired', body='Body',
+                                              expires_at=now - datetime.timedelta(minutes=1))
+
+    def testHidden(self):
+        """ expired messages disappear from folders, counts and views """
+        self.assertEqual(set(m.pk for m in Message.objects.inbox_for(self.user2)),
+                         set([self.kept.pk, self.later.pk]))
+        self.assertEqual(set(m.pk for m in Message.objects.outbox_for(self.user1)),
+                         set([self.kept.pk, self.later.pk]))
+        self.assertEqual(Message.objects.folder_counts(self.user2),
+                         {'inbox': 2, 'unread': 2, 'outbox': 0, 'trash': 0})
+        self.assertEqual(inbox_count_for(self.user2), 2)
+        c = self.login('user44')
+        response = c.get(reverse('messages_detail', kwargs={'message_id': self.expired.pk}))
+        self.assertEqual(response.status_code, 404)
+        response = c.get(reverse('messages_detail', kwargs={'message_id': self.later.pk}))
+        self.assertEqual(response.status_code, 200)
+        for name in ('messages_delete', 'messages_undelete'):
+            response = c.get(reverse(name, kwargs={'message_id': self.expired.pk}))
+            self.assertEqual(response.status_code, 404)
+        exported = [m.pk for m in iter_mailbox(self.user2)]
+        self.assertEqual(exported, [self.kept.pk, self.later.pk])
+
+    def testNever(self):
+        """ messages without an expiry date are selected by a single range """
+        from django_messages.models import never
+        message = Message(sender=self.user1, recipient=self.user2,
+                          subject='Subject', body='Body', expires_at=None)
+        message.save()
+        self.assertEqual(Message.objects.get(pk=message.pk).expires_at, never())
+        self.assertFalse(self.kept.expires())
+        self.assertTrue(self.later.expires())
+        sql = str(Message.objects.inbox_for(self.user2).query).upper()
+        self.assertFalse('EXPIRES_AT" IS NULL' in sql)
+
+    def testWarmCacheTimeout(self):
+        """ warmed mailbox data isn't cached beyond the next expiry """
+        from django_messages.warming import get_timeout
+        now = timezone.now()
+        self.assertEqual(get_timeout(self.user2, now), 300)
+        Message.objects.create(sender=self.user1, recipient=self.user2,
+                               subject='Soon', body='Body',
+                               expires_at=now + datetime.timedelta(seconds=60))
+        self.assertEqual(get_timeout(self.user2, now), 60)
+
+    def testSweep(self):
+        """ the sweep deletes expired messages and keeps their replies """
+        reply = Message.objects.create(sender=self.user2, recipient=self.user1,
+                                       subject='Re: Expired', body='Body',
+                                       parent_msg=self.expired)
+        with self.settings(DJANGO_MESSAGES_CHANGE_LOG=True):
+            call_command('delete_expired_messages', batch_size=1, verbosity=0)
+        self.assertEqual(set(Message.objects.all()), set([self.kept, self.later, reply]))
+        self.assertEqual(Message.objects.get(pk=reply.pk).parent_msg, None)
+        self.assertEqual(MessageChange.objects.filter(message_id=self.expired.pk,
+                                                      event='purged').count(), 2)
+
+    def testCompose(self):
+        """ compose stores the expiry date of the messages """
+        form = ComposeForm({'recipient': 'user44', 'subject': 'Code', 'body': '1234'})
+        self.assertTrue(form.is_valid())
+        expires_at = timezone.now() + datetime.timedelta(minutes=10)
+        message = form.save(sender=self.user1, expires_at=expires_at)[0]
+        self.assertEqual(Message.objects.get(pk=message.pk).expires_at, expires_at)
+
+
+@override_settings(DJANGO_MESSAGES_IDEMPOTENCY_KEYS=True)
+class IdempotencyTestCase(UsersTestCase):
+    def setUp(self):
+        self.admin = User.objects.create_superuser(
+            'admin2', 'admin2@example.com', self.password)
+        self.create_users('user45', 'user46', 'user47')
+        self.c = self.login('user45')
+
+    def compose(self, key, **headers):
+        return self.c.post(reverse('messages_compose'), {
+            'recipient': 'user46, user47', 'subject': 'Subject', 'body': 'Body',
+            'idempotency_key': key}, **headers)
+
+    def testRetriedCompose(self):
+        """ a resubmitted compose form doesn't send the message again """
+        response = self.c.get(reverse('messages_compose'))
+        key = response.context['form'].fields['idempotency_key'].initial
+        self.assertTrue(key)
+        self.assertEqual(self.compose(key).status_code, 302)
+        self.assertEqual(self.compose(key).status_code, 302)
+        self.assertEqual(Message.objects.filter(sender=self.user1).count(), 2)
+        self.compose('other')
+        self.assertEqual(Message.objects.filter(sender=self.user1).count(), 4)
+        # a header replaces the key of the form
+        self.compose('a', HTTP_IDEMPOTENCY_KEY='header')
+        self.compose('b', HTTP_IDEMPOTENCY_KEY='header')
+        self.assertEqual(Message.objects.filter(sender=self.user1).count(), 6)
+
+    def testSaveReturnsOriginalMessages(self):
+        """ saving a resubmitted form returns the messages sent first """
+        data = {'recipient': 'user46', 'subject': 'Subject', 'body': 'Body',
+                'idempotency_key': 'key'}
+        form = ComposeForm(data, sender=self.user1)
+        self.assertTrue(form.is_valid())
+        first = form.save(sender=self.user1)
+        form = ComposeForm(data, sender=self.user1)
+        self.assertTrue(form.is_valid())
+        self.assertEqual(form.save(sender=self.user1), first)
+
+    def testExpiry(self):
+        """ keys can be reused after the window and are deleted by the command """
+        self.compose('key')
+        with self.settings(DJANGO_MESSAGES_IDEMPOTENCY_WINDOW=0):
+            self.compose('key')
+            self.assertEqual(Message.objects.filter(sender=self.user1).count(), 4)
+            call_command('delete_expired_idempotency_keys', verbosity=0)
+        self.assertFalse(IdempotencyKey.objects.exists())
+
+    def testRetriedBroadcast(self):
+        """ a resubmitted admin broadcast isn't sent again """
+        c = self.login('admin2')
+        url = reverse('admin:django_messages_message_add')
+        key = c.get(url).context['adminform'].form.fields['idempotency_key'].initial
+        data = {'sender': self.admin.pk, 'recipient': self.user1.pk, 'group': 'all',
+                'subject': 'Announcement', 'body': 'Body', 'idempotency_key': key}
+        for i in range(2):
+            response = c.post(url, data)
+            self.assertEqual(response.status_code, 302)
+        self.assertEqual(Message.objects.filter(subject='Announcement').count(),
+                         User.objects.count())
+        self.assertEqual(LogEntry.objects.filter(user=self.admin).count(), 1)
+
+    def testPendingKey(self):
+        """ a retry while the first submission is being sent sends nothing """
+        IdempotencyKey.objects.create(user=self.user1, key='key')
+        response = self.compose('key')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.context['form'].non_field_errors())
+        IdempotencyKey.objects.create(user=self.admin, key='key')
+        c = self.login('admin2')
+        response = c.post(reverse('admin:django_messages_message_add'), {
+            'sender': self.admin.pk, 'recipient': self.user1.pk, 'group': '',
+            'subject': 'Announcement', 'body': 'Body', 'idempotency_key': 'key',
+            '_continue': '1'})
+        self.assertRedirects(response, reverse('admin:django_messages_message_changelist'))
+        self.assertFalse(Message.objects.exists())
+        self.assertFalse(LogEntry.objects.exists())
+
+    def testAbandonedKey(self):
+        """ a key whose request died before sending is taken over """
+        record = IdempotencyKey.objects.create(user=self.user1, key='key')
+        IdempotencyKey.objects.filter(pk=record.pk).update(
+            created_at=timezone.now() - datetime.timedelta(minutes=5))
+        self.assertEqual(self.compose('key').status_code, 302)
+        self.assertEqual(Message.objects.filter(sender=self.user1).count(), 2)
+        self.assertTrue(IdempotencyKey.objects.get(pk=record.pk).messages)
+
+    def testFailedSend(self):
+        """ the key of a submission which failed can be used again """
+        def fail():
+            Message.objects.create(sender=self.user1, recipient=self.user2,
+                                   subject='Subject', body='Body')
+            raise ValueError
+        self.assertRaises(ValueError, idempotency.send_once, self.user1, 'key', fail)
+        self.assertFalse(IdempotencyKey.objects.exists())
+        self.assertFalse(Message.objects.exists())
+        self.assertEqual(self.compose('key').status_code, 302)
+
+STRESS_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'tests', 'stress.py')
+
+
+@unittest.skipUnless(os.path.exists(STRESS_SCRIPT), 'tests/stress.py not found')
+class StressTestCase(TestCase):
+    def testNoLostUpdates(self):
+        """ concurrent reads, deletes and replies don't overwrite each other """
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        process = subprocess.Popen([sys.executable, STRESS_SCRIPT,
+                                    '--processes=2', '--threads=2',
+                                    '--messages=10', '--rounds=2'],
+                                   env=env, stdout=subprocess.PIPE)
+        output = process.communicate()[0].decode('utf-8')
+        self.assertTrue('lost updates: 0' in output, output)
+        self.assertTrue('failed operations: 0' in output, output)
+        self.assertEqual(process.returncode, 0)
@@ -14,4 +14,7 @@ urlpatterns = patterns('',
     url(r'^delete/(?P<message_id>[\d]+)/$', delete, name='messages_delete'),
     url(r'^undelete/(?P<message_id>[\d]+)/$', undelete, name='messages_undelete'),
     url(r'^trash/$', trash, name='messages_trash'),
+    url(r'^export/$', export, name='messages_export'),
+    url(r'^changes/$', changes, name='messages_changes'),
+    url(r'^attachment/(?P<attachment_id>[\d]+)/$', attachment, name='messages_attachment'),
 )
@@ -1,24 +1,96 @@
+import json
 import re
-import django
+from django.utils import six
+from django.utils.encoding import python_2_unicode_compatible
 from django.utils.text import wrap
-from django.utils.translation import ugettext, ugettext_lazy as _
-from django.contrib.sites.models import Site
+from django.utils.translation import ugettext, ugettext_lazy as _, ugettext_noop
 from django.template.loader import render_to_string
 from django.conf import settings
 
-# favour django-mailer but fall back to django.core.mail
+from django_messages.instrumentation import instrumented
 
-if "mailer" in settings.INSTALLED_APPS:
-    from mailer import send_mail
-else:
-    from django.core.mail import send_mail
+# The optional integrations below are resolved on first use, to keep importing
+# django-messages cheap.
 
-def format_quote(sender, body):
+def get_send_mail():
+    """
+    Returns the ``send_mail`` function of django-mailer if it is installed,
+    otherwise the one of ``django.core.mail``.
+    """
+    if "mailer" in settings.INSTALLED_APPS:
+        from mailer import send_mail
+    else:
+        from django.core.mail import send_mail
+    return send_mail
+
+def get_notification():
+    """
+    Returns the ``models`` module of django-notification if it is installed
+    and ``DJANGO_MESSAGES_NOTIFY`` is not disabled, otherwise ``None``.
+    """
+    if "notification" in settings.INSTALLED_APPS and getattr(settings, 'DJANGO_MESSAGES_NOTIFY', True):
+        from notification import models as notification
+        return notification
+    return None
+
+def create_notice_types(*args, **kwargs):
+    """
+    Creates the django-notification notice types used by django-messages.
+    Connected to ``post_migrate`` (``post_syncdb`` before Django 1.7).
+    """
+    notification = get_notification()
+    if notification is None:
+        return
+    _ = ugettext_noop
+    notification.create_notice_type("messages_received", _("Message Received"), _("you have received a message"), default=2)
+    notification.create_notice_type("messages_sent", _("Message Sent"), _("you have sent a message"), default=1)
+    notification.create_notice_type("messages_replied", _("Message Replied"), _("you have replied to a message"), default=1)
+    notification.create_notice_type("messages_reply_received", _("Reply Received"), _("you have received a reply to a message"), default=2)
+    notification.create_notice_type("messages_deleted", _("Message Deleted"), _("you have deleted a message"), default=1)
+    notification.create_notice_type("messages_recovered", _("Message Recovered"), _("you have undeleted a message"), default=1)
+
+def connect_signals():
+    """
+    Connects the signal handlers of django-messages. Called from
+    ``DjangoMessagesConfig.ready()``, or when the models are loaded on
+    Django versions without app configs.
+    """
+    from django.db.models import signals
+    from django_messages.models import Message
+    # fallback for email notification if django-notification could not be found
+    if get_notification() is None and getattr(settings, 'DJANGO_MESSAGES_NOTIFY', True):
+        signals.post_save.connect(new_message_email, sender=Message,
+            dispatch_uid='django_messages.new_message_email')
+    from django_messages.quotas import message_received
+    signals.post_save.connect(message_received, sender=Message,
+        dispatch_uid='django_messages.quotas.message_received')
+    from django.contrib.auth.signals import user_logged_in
+    from django_messages.caching import invalidate_mailboxes
+    from django_messages.warming import warm_on_login
+    signals.post_save.connect(invalidate_mailboxes, sender=Message,
+        dispatch_uid='django_messages.caching.invalidate_mailboxes')
+    user_logged_in.connect(warm_on_login,
+        dispatch_uid='django_messages.warming.warm_on_login')
+    from django_messages.index import message_saved
+    signals.post_save.connect(message_saved, sender=Message,
+        dispatch_uid='django_messages.index.message_saved')
+    from django.core.signals import request_finished
+    from django_messages.routers import unpin
+    request_finished.connect(unpin,
+        dispatch_uid='django_messages.routers.unpin')
+
+def format_quote(sender, body, max_length=None):
     """
     Wraps text at 55 chars and prepends each
     line with `> `.
     Used for quoting messages in replies.
+    Bodies longer than ``max_length`` (defaults to the
+    ``DJANGO_MESSAGES_QUOTE_MAX_LENGTH`` setting) are cut off.
     """
+    if max_length is None:
+        max_length = getattr(settings, 'DJANGO_MESSAGES_QUOTE_MAX_LENGTH', None)
+    if max_length is not None and len(body) > max_length:
+        body = body[:max_length] + u'\n[...]'
     lines = wrap(body, 55).split('\n')
     for i, line in enumerate(lines):
         lines[i] = "> %s" % line
@@ -28,6 +100,18 @@ def format_quote(sender, body):
         'body': quote
     }
 
+SNIPPET_LENGTH = 100
+
+def make_snippet(body, length=SNIPPET_LENGTH):
+    """
+    Returns the beginning of ``body`` with all whitespace collapsed. Used
+    for message previews in list views.
+    """
+    snippet = ' '.join(body.split())
+    if len(snippet) > length:
+        snippet = snippet[:length - 3].rstrip() + '...'
+    return snippet
+
 def format_subject(subject):
     """
     Prepends 'Re:' to the subject. To avoid multiple 'Re:'s
@@ -56,6 +140,7 @@ def format_subject(subject):
         'prefix': prefix
     }
     
+@instrumented('new_message_email')
 def new_message_email(sender, instance, signal, 
         subject_prefix=_(u'New Message: %(subject)s'),
         template_name="django_messages/new_message.html",
@@ -71,8 +156,14 @@ def new_message_email(sender, instance, signal,
     if default_protocol is None:
         default_protocol = getattr(settings, 'DEFAULT_HTTP_PROTOCOL', 'http')
 
+    # the sender's copy of a sharded message, see ComposeForm.save_sender_copy
+    if getattr(instance, 'is_sender_copy', False):
+        return
+
     if 'created' in kwargs and kwargs['created']:
         try:
+            from django.contrib.sites.models import Site
+            send_mail = get_send_mail()
             current_domain = Site.objects.get_current().domain
             subject = subject_prefix % {'subject': instance.subject}
             message = render_to_string(template_name, {
@@ -87,17 +178,123 @@ def new_message_email(sender, instance, signal,
             pass #fail silently
 
 
+def get_count_cap():
+    return getattr(settings, 'DJANGO_MESSAGES_COUNT_CAP', None)
+
+
+def approximate_counts_enabled():
+    return getattr(settings, 'DJANGO_MESSAGES_APPROXIMATE_COUNTS', False)
+
+
+def _planner_estimate(queryset):
+    """
+    Returns the number of rows PostgreSQL or MySQL expect the queryset to
+    return, or ``None`` for other databases.
+    """
+    from django.db import connections
+    connection = connections[queryset.db]
+    if connection.vendor not in ('postgresql', 'mysql'):
+        return None
+    sql, params = queryset.query.sql_with_params()
+    cursor = connection.cursor()
+    if connection.vendor == 'postgresql':
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+        plan = cursor.fetchone()[0]
+        if isinstance(plan, six.string_types):
+            plan = json.loads(plan)
+        return int(plan[0]['Plan']['Plan Rows'])
+    cursor.execute('EXPLAIN ' + sql, params)
+    columns = [column[0] for column in cursor.description]
+    row = cursor.fetchone()
+    if row is None or row[columns.index('rows')] is None:
+        return None
+    return int(row[columns.index('rows')])
+
+
+def estimated_count(queryset, minimum=1000, approximate=False):
+    """
+    Returns the number of rows of an unfiltered queryset as estimated by
+    PostgreSQL or MySQL, which is much cheaper than ``COUNT(*)`` on large
+    tables. With ``approximate=True`` filtered querysets are estimated with
+    the query planner's row estimate. Falls back to an exact count for other
+    querysets and databases and for estimates below ``minimum``.
+    """
+    from django.db import connections
+    estimate = None
+    if not queryset.query.where:
+        connection = connections[queryset.db]
+        table = queryset.model._meta.db_table
+        sql = None
+        if connection.vendor == 'postgresql':
+            sql = "SELECT reltuples::bigint FROM pg_class WHERE relname = %s"
+        elif connection.vendor == 'mysql':
+            sql = ("SELECT table_rows FROM information_schema.tables "
+                   "WHERE table_schema = DATABASE() AND table_name = %s")
+        if sql is not None:
+            cursor = connection.cursor()
+            cursor.execute(sql, [table])
+            row = cursor.fetchone()
+            if row and row[0] is not None:
+                estimate = int(row[0])
+    elif approximate:
+        estimate = _planner_estimate(queryset)
+    if estimate is not None and estimate >= minimum:
+        return estimate
+    return queryset.count()
+
+
+@python_2_unicode_compatible
+class CappedCount(int):
+    """
+    A count which stopped at ``cap``; it is rendered as e.g. "999+" if there
+    are more rows.
+    """
+    def __new__(cls, value, capped=False):
+        count = super(CappedCount, cls).__new__(cls, value)
+        count.capped = capped
+        return count
+
+    def __str__(self):
+        if self.capped:
+            return u'%d+' % self
+        return u'%d' % self
+
+
+def capped_count(queryset, cap=None):
+    """
+    Counts the rows of the queryset, but at most ``cap`` (by default
+    ``DJANGO_MESSAGES_COUNT_CAP``) of them, with a ``LIMIT``-ed subquery.
+    Returns a ``CappedCount``, or a plain ``int`` if no cap is set.
+    """
+    from django.db import connections
+    if cap is None:
+        cap = get_count_cap()
+    if cap is None:
+        return queryset.count()
+    sql, params = queryset.values('pk').order_by()[:cap + 1].query.sql_with_params()
+    cursor = connections[queryset.db].cursor()
+    cursor.execute('SELECT COUNT(*) FROM (%s) capped' % sql, params)
+    count = cursor.fetchone()[0]
+    if count > cap:
+        return CappedCount(cap, capped=True)
+    return CappedCount(count)
+
+
+def total_count(queryset):
+    """
+    Returns the number of rows for a total shown to users: estimated with
+    ``DJANGO_MESSAGES_APPROXIMATE_COUNTS``, capped with
+    ``DJANGO_MESSAGES_COUNT_CAP`` and exact otherwise.
+    """
+    if approximate_counts_enabled():
+        return estimated_count(queryset, approximate=True)
+    return capped_count(queryset)
+
+
 def get_user_model():
-    if django.VERSION[:2] >= (1, 5):
-        from django.contrib.auth import get_user_model
-        return get_user_model()
-    else:
-        from django.contrib.auth.models import User
-        return User
+    from django.contrib.auth import get_user_model
+    return get_user_model()
 
 
 def get_username_field():
-    if django.VERSION[:2] >= (1, 5):
-        return get_user_model().USERNAME_FIELD
-    else:
-        return 'username'
+    return get_user_model().USERNAME_FIELD
@@ -1,37 +1,113 @@
-from django.http import Http404, HttpResponseRedirect
+import json
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, HttpResponseRedirect, StreamingHttpResponse
 from django.shortcuts import render_to_response, get_object_or_404
 from django.template import RequestContext
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
 from django.utils.translation import ugettext as _
 from django.utils import timezone
+from django.utils.functional import SimpleLazyObject, new_method_proxy
 from django.core.urlresolvers import reverse
-from django.conf import settings
 
-from django_messages.models import Message
+from django_messages.attachments import is_enabled as attachments_enabled, serve as serve_attachment
+from django_messages.changes import changes_since, record_change
+from django_messages.models import Attachment, Message, MessageChange, unexpired
+from django_messages import idempotency
+from django_messages.index import get_index, index_message
 from django_messages.forms import ComposeForm
-from django_messages.utils import format_quote, get_user_model, get_username_field
+from django_messages.utils import (format_quote, get_user_model,
+    get_username_field, get_notification, total_count)
+from django_messages.instrumentation import instrument_iterator, instrumented
+from django_messages.export import export_mailbox, FORMATS as EXPORT_FORMATS
+from django_messages.quotas import track_inbox
+from django_messages.ratelimit import get_recipient_limit, is_exempt as is_rate_limit_exempt
+from django_messages.receipts import buffer_read, with_buffered_reads
+from django_messages.caching import bump_mailbox_versions
+from django_messages.warming import get_warm_mailbox
 
 User = get_user_model()
 
-if "notification" in settings.INSTALLED_APPS and getattr(settings, 'DJANGO_MESSAGES_NOTIFY', True):
-    from notification import models as notification
-else:
-    notification = None
+class LazyForm(SimpleLazyObject):
+    """
+    A form which is only instantiated when it is used in a template.
+    """
+    __iter__ = new_method_proxy(iter)
+
+def _set_timestamp(user, message, field, value):
+    """
+    Sets ``field`` of the message to ``value`` if it is currently empty (or,
+    if ``value`` is ``None``, if it is set). Only this column is written, so
+    concurrent requests changing other columns of the message don't
+    overwrite each other. Returns whether the row was changed.
+    """
+    changed = Message.objects.for_user(user).filter(**{
+        'pk': message.pk, '%s__isnull' % field: value is not None,
+    }).update(**{field: value})
+    setattr(message, field, value)
+    if changed:
+        bump_mailbox_versions(message.sender_id, message.recipient_id)
+        if field in ('sender_deleted_at', 'recipient_deleted_at'):
+            index_message(message, using=Message.objects.for_user(user).db)
+    return bool(changed)
+
+def get_page_size():
+    return getattr(settings, 'DJANGO_MESSAGES_PAGE_SIZE', 50)
+
+def _folder_context(request, folder, message_list):
+    """
+    Returns the context listing a folder, given as a queryset or, if it is
+    already loaded, as a list. With a mailbox index the folder is listed a
+    page of ``DJANGO_MESSAGES_PAGE_SIZE`` messages at a time, read with
+    ``Message.objects.page_for``, and the page is chosen with ``?page=``.
+    """
+    loaded = isinstance(message_list, list)
+    if loaded:
+        message_count = len(message_list)
+    else:
+        message_count = SimpleLazyObject(lambda: total_count(message_list))
+    if get_index() is None:
+        return {'message_list': message_list, 'message_count': message_count}
+    try:
+        page = max(int(request.GET.get('page', 1)), 1)
+    except ValueError:
+        page = 1
+    size = get_page_size()
+    offset = (page - 1) * size
+    if loaded:
+        messages = message_list[offset:offset + size + 1]
+    else:
+        # one more message tells whether there is a next page
+        messages = Message.objects.page_for(folder, request.user, offset, size + 1)
+    return {
+        'message_list': messages[:size],
+        'message_count': message_count,
+        'page': page,
+        'previous_page': page - 1 or None,
+        'next_page': page + 1 if len(messages) > size else None,
+    }
 
 @login_required
+@instrumented('views.inbox')
 def inbox(request, template_name='django_messages/inbox.html'):
     """
     Displays a list of received messages for the current user.
     Optional Arguments:
         ``template_name``: name of the template to use.
     """
-    message_list = Message.objects.inbox_for(request.user)
-    return render_to_response(template_name, {
-        'message_list': message_list,
-    }, context_instance=RequestContext(request))
+    warm = get_warm_mailbox(request.user)
+    if warm is not None and warm['inbox'] is not None:
+        message_list = warm['inbox']
+    else:
+        message_list = with_buffered_reads(Message.objects.inbox_for(request.user), request.user)
+    return render_to_response(template_name,
+        _folder_context(request, 'inbox', message_list),
+        context_instance=RequestContext(request))
 
 @login_required
+@instrumented('views.outbox')
 def outbox(request, template_name='django_messages/outbox.html'):
     """
     Displays a list of sent messages by the current user.
@@ -39,11 +115,12 @@ def outbox(request, template_name='django_messages/outbox.html'):
         ``template_name``: name of the template to use.
     """
     message_list = Message.objects.outbox_for(request.user)
-    return render_to_response(template_name, {
-        'message_list': message_list,
-    }, context_instance=RequestContext(request))
+    return render_to_response(template_name,
+        _folder_context(request, 'outbox', message_list),
+        context_instance=RequestContext(request))
 
 @login_required
+@instrumented('views.trash')
 def trash(request, template_name='django_messages/trash.html'):
     """
     Displays a list of deleted messages.
@@ -53,11 +130,20 @@ def trash(request, template_name='django_messages/trash.html'):
     by sender and recipient.
     """
     message_list = Message.objects.trash_for(request.user)
-    return render_to_response(template_name, {
-        'message_list': message_list,
+    return render_to_response(template_name,
+        _folder_context(request, 'trash', message_list),
+        context_instance=RequestContext(request))
+
+def _compose_response(request, template_name, form):
+    response = render_to_response(template_name, {
+        'form': form,
     }, context_instance=RequestContext(request))
+    if getattr(form, 'rate_limited', False):
+        response.status_code = 429
+    return response
 
 @login_required
+@instrumented('views.compose')
 def compose(request, recipient=None, form_class=ComposeForm,
         template_name='django_messages/compose.html', success_url=None, recipient_filter=None):
     """
@@ -73,7 +159,8 @@ def compose(request, recipient=None, form_class=ComposeForm,
     """
     if request.method == "POST":
         sender = request.user
-        form = form_class(request.POST, recipient_filter=recipient_filter)
+        form = form_class(idempotency.request_data(request), request.FILES, recipient_filter=recipient_filter,
+                          sender=request.user)
         if form.is_valid():
             form.save(sender=request.user)
             messages.info(request, _(u"Message successfully sent."))
@@ -85,13 +172,15 @@ def compose(request, recipient=None, form_class=ComposeForm,
     else:
         form = form_class()
         if recipient is not None:
-            recipients = [u for u in User.objects.filter(**{'%s__in' % get_username_field(): [r.strip() for r in recipient.split('+')]})]
+            usernames = [r.strip() for r in recipient.split('+')]
+            if get_recipient_limit() is not None and not is_rate_limit_exempt(request.user):
+                usernames = usernames[:get_recipient_limit()]
+            recipients = [u for u in User.objects.filter(**{'%s__in' % get_username_field(): usernames})]
             form.fields['recipient'].initial = recipients
-    return render_to_response(template_name, {
-        'form': form,
-    }, context_instance=RequestContext(request))
+    return _compose_response(request, template_name, form)
 
 @login_required
+@instrumented('views.reply')
 def reply(request, message_id, form_class=ComposeForm,
         template_name='django_messages/compose.html', success_url=None,
         recipient_filter=None, quote_helper=format_quote,
@@ -103,14 +192,15 @@ def reply(request, message_id, form_class=ComposeForm,
     assign a different ``quote_helper`` kwarg in your url-conf.
 
     """
-    parent = get_object_or_404(Message, id=message_id)
+    parent = get_object_or_404(Message.objects.for_user(request.user).filter(unexpired()), id=message_id)
 
     if parent.sender != request.user and parent.recipient != request.user:
         raise Http404
 
     if request.method == "POST":
         sender = request.user
-        form = form_class(request.POST, recipient_filter=recipient_filter)
+        form = form_class(idempotency.request_data(request), request.FILES, recipient_filter=recipient_filter,
+                          sender=request.user)
         if form.is_valid():
             form.save(sender=request.user, parent_msg=parent)
             messages.info(request, _(u"Message successfully sent."))
@@ -123,11 +213,10 @@ def reply(request, message_id, form_class=ComposeForm,
             'subject': subject_template % {'subject': parent.subject},
             'recipient': [parent.sender,]
             })
-    return render_to_response(template_name, {
-        'form': form,
-    }, context_instance=RequestContext(request))
+    return _compose_response(request, template_name, form)
 
 @login_required
+@instrumented('views.delete')
 def delete(request, message_id, success_url=None):
     """
     Marks a message as deleted by sender or recipient. The message is not
@@ -142,54 +231,68 @@ def delete(request, message_id, success_url=None):
     """
     user = request.user
     now = timezone.now()
-    message = get_object_or_404(Message, id=message_id)
+    message = get_object_or_404(
+        Message.objects.for_user(request.user).filter(unexpired()), id=message_id)
     deleted = False
     if success_url is None:
         success_url = reverse('messages_inbox')
     if 'next' in request.GET:
         success_url = request.GET['next']
+    changed = False
     if message.sender == user:
-        message.sender_deleted_at = now
+        changed = _set_timestamp(user, message, 'sender_deleted_at', now)
         deleted = True
     if message.recipient == user:
-        message.recipient_deleted_at = now
+        if _set_timestamp(user, message, 'recipient_deleted_at', now):
+            track_inbox(message, removed=True)
+            changed = True
         deleted = True
+    if changed:
+        record_change(message, MessageChange.DELETED, [user.pk])
     if deleted:
-        message.save()
         messages.info(request, _(u"Message successfully deleted."))
+        notification = get_notification()
         if notification:
             notification.send([user], "messages_deleted", {'message': message,})
         return HttpResponseRedirect(success_url)
     raise Http404
 
 @login_required
+@instrumented('views.undelete')
 def undelete(request, message_id, success_url=None):
     """
     Recovers a message from trash. This is achieved by removing the
     ``(sender|recipient)_deleted_at`` from the model.
     """
     user = request.user
-    message = get_object_or_404(Message, id=message_id)
+    message = get_object_or_404(
+        Message.objects.for_user(request.user).filter(unexpired()), id=message_id)
     undeleted = False
     if success_url is None:
         success_url = reverse('messages_inbox')
     if 'next' in request.GET:
         success_url = request.GET['next']
+    changed = False
     if message.sender == user:
-        message.sender_deleted_at = None
+        changed = _set_timestamp(user, message, 'sender_deleted_at', None)
         undeleted = True
     if message.recipient == user:
-        message.recipient_deleted_at = None
+        if _set_timestamp(user, message, 'recipient_deleted_at', None):
+            track_inbox(message, removed=False)
+            changed = True
         undeleted = True
+    if changed:
+        record_change(message, MessageChange.UNDELETED, [user.pk])
     if undeleted:
-        message.save()
         messages.info(request, _(u"Message successfully recovered."))
+        notification = get_notification()
         if notification:
             notification.send([user], "messages_recovered", {'message': message,})
         return HttpResponseRedirect(success_url)
     raise Http404
 
 @login_required
+@instrumented('views.view')
 def view(request, message_id, form_class=ComposeForm, quote_helper=format_quote,
         subject_template=_(u"Re: %(subject)s"),
         template_name='django_messages/view.html'):
@@ -201,24 +304,95 @@ def view(request, message_id, form_class=ComposeForm, quote_helper=format_quote,
     If the user is the recipient and the message is unread
     ``read_at`` is set to the current datetime.
     If the user is the recipient a reply form will be added to the
-    tenplate context, otherwise 'reply_form' will be None.
+    tenplate context, otherwise 'reply_form' will be None. The form is only
+    built when the template uses it.
     """
     user = request.user
     now = timezone.now()
-    message = get_object_or_404(Message, id=message_id)
+    message = get_object_or_404(Message.objects.for_user(request.user).filter(unexpired()), id=message_id)
     if (message.sender != user) and (message.recipient != user):
         raise Http404
     if message.read_at is None and message.recipient == user:
-        message.read_at = now
-        message.save()
+        if (not buffer_read(user, message, now) and
+                _set_timestamp(user, message, 'read_at', now)):
+            record_change(message, MessageChange.READ)
 
-    context = {'message': message, 'reply_form': None}
+    context = {'message': message, 'reply_form': None, 'attachments': []}
+    if attachments_enabled():
+        context['attachments'] = message.attachments.select_related('blob')
     if message.recipient == user:
-        form = form_class(initial={
+        # quoting long bodies is expensive, only do it if the form is used
+        context['reply_form'] = LazyForm(lambda: form_class(initial={
             'body': quote_helper(message.sender, message.body),
             'subject': subject_template % {'subject': message.subject},
             'recipient': [message.sender,]
-            })
-        context['reply_form'] = form
+            }))
     return render_to_response(template_name, context,
         context_instance=RequestContext(request))
+
+@login_required
+def export(request, chunk_size=500):
+    """
+    Streams all messages of the current user (inbox, outbox and trash) as a
+    download. The format is chosen with the ``format`` querystring parameter
+    and is either ``jsonl`` (the default) or ``mbox``.
+    Optional arguments:
+        ``chunk_size``: number of messages read from the database at once
+    """
+    format = request.GET.get('format', 'jsonl')
+    if format not in EXPORT_FORMATS:
+        raise Http404
+    # the mailbox is only read while the response is streamed
+    response = StreamingHttpResponse(
+        instrument_iterator('views.export', export_mailbox(request.user, format, chunk_size)),
+        content_type=EXPORT_FORMATS[format])
+    response['Content-Disposition'] = 'attachment; filename="messages.%s"' % format
+    return response
+
+@login_required
+@instrumented('views.changes')
+def changes(request, max_limit=500):
+    """
+    Returns the changes of the current user's mailbox after the change with
+    the id given in the ``since`` querystring parameter as JSON, at most
+    ``limit`` (default 100, at most ``max_limit``) of them. Clients pass the
+    returned ``cursor`` as ``since`` of the next request and repeat while
+    ``more`` is true.
+    """
+    try:
+        since = int(request.GET.get('since', 0))
+        limit = min(int(request.GET.get('limit', 100)), max_limit)
+    except ValueError:
+        return HttpResponseBadRequest()
+    if limit < 1:
+        return HttpResponseBadRequest()
+    change_list, more = changes_since(request.user, since, limit)
+    data = {
+        'changes': [{
+            'id': change.pk,
+            'message_id': change.message_id,
+            'event': change.event,
+            'created_at': change.created_at,
+        } for change in change_list],
+        'cursor': change_list[-1].pk if change_list else since,
+        'more': more,
+    }
+    return HttpResponse(json.dumps(data, cls=DjangoJSONEncoder),
+                        content_type='application/json')
+
+@login_required
+@instrumented('views.attachment')
+def attachment(request, attachment_id):
+    """
+    Sends an attachment to the sender or recipient of its message. Supports
+    ``Range`` requests, see ``django_messages.attachments.serve``.
+    """
+    if not attachments_enabled():
+        raise Http404
+    attachment = get_object_or_404(
+        Attachment.objects.for_user(request.user).select_related('message', 'blob')
+        .filter(unexpired(field='message__expires_at')), id=attachment_id)
+    message = attachment.message
+    if request.user.pk not in (message.sender_id, message.recipient_id):
+        raise Http404
+    return serve_attachment(request, attachment)
@@ -0,0 +1,146 @@
+"""
+Warms the mailbox cache when a user logs in.
+
+With ``DJANGO_MESSAGES_WARM_CACHE_ON_LOGIN = True`` logging in queues the
+user for one of ``DJANGO_MESSAGES_WARM_CACHE_THREADS`` background threads,
+which loads the user's inbox (with senders), the unread count and the folder
+counts into the cache, and renders the inbox rows into the fragment cache.
+Logins finding ``DJANGO_MESSAGES_WARM_CACHE_QUEUE_SIZE`` users waiting
+aren't warmed. The inbox view, ``inbox_count_for`` and
+``MessageManager.folder_counts`` use this data until a message of the user
+changes or ``DJANGO_MESSAGES_MAILBOX_CACHE_TIMEOUT`` seconds have passed,
+or until the next message of the user expires if that is sooner.
+"""
+import logging
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+from django.db.models import Min, Q
+from django.template.loader import render_to_string
+from django.utils import timezone, translation
+from django.utils.six.moves import queue
+
+from django_messages.caching import (get_fragment_timeout, get_mailbox_timeout,
+    mailbox_cache_enabled, mailbox_cache_key, mailbox_version)
+
+logger = logging.getLogger('django_messages.warming')
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_inbox_limit():
+    return getattr(settings, 'DJANGO_MESSAGES_WARM_CACHE_MESSAGES', 100)
+
+
+def get_thread_count():
+    return getattr(settings, 'DJANGO_MESSAGES_WARM_CACHE_THREADS', 2)
+
+
+def get_queue_size():
+    return getattr(settings, 'DJANGO_MESSAGES_WARM_CACHE_QUEUE_SIZE', 100)
+
+
+def get_warm_mailbox(user):
+    """
+    Returns the cached mailbox data of the user, or ``None`` if there is
+    none for the current version of the mailbox.
+    """
+    if not mailbox_cache_enabled():
+        return None
+    return cache.get(mailbox_cache_key(user.pk, mailbox_version(user.pk)))
+
+
+def get_timeout(user, now=None):
+    """
+    returns how long the mailbox data of the user may be cached: the
+    mailbox timeout, cut short by the next message to expire
+    """
+    from django_messages.models import Message
+    now = now or timezone.now()
+    timeout = get_mailbox_timeout()
+    next_expiry = Message.objects.for_user(user).filter(
+        Q(sender=user) | Q(recipient=user), expires_at__gt=now,
+    ).aggregate(next_expiry=Min('expires_at'))['next_expiry']
+    if next_expiry is not None:
+        delta = next_expiry - now
+        timeout = min(timeout, delta.days * 86400 + delta.seconds)
+    return timeout
+
+
+def warm_mailbox(user, language=None, tzinfo=None):
+    """
+    Loads the mailbox data of the user into the cache. ``language`` and
+    ``tzinfo`` are used for rendering the inbox rows.
+    """
+    from django_messages.models import Message, inbox_count_for
+    from django_messages.receipts import with_buffered_reads
+    version = mailbox_version(user.pk)
+    limit = get_inbox_limit()
+    # like the unread count, the rows include reads which weren't flushed yet
+    inbox = list(with_buffered_reads(
+        Message.objects.inbox_for(user).select_related('sender'), user)[:limit + 1])
+    data = {
+        # larger inboxes are loaded by the view
+        'inbox': inbox if len(inbox) <= limit else None,
+        'unread': inbox_count_for(user),
+        'folders': Message.objects.folder_counts(user),
+    }
+    if get_fragment_timeout():
+        with translation.override(language):
+            with timezone.override(tzinfo):
+                for message in inbox[:limit]:
+                    render_to_string('django_messages/inbox_row.html', {'message': message})
+    timeout = get_timeout(user)
+    if timeout > 0:
+        # a change during warming replaced the version, so this is never served
+        cache.set(mailbox_cache_key(user.pk, version), data, timeout)
+    return data
+
+
+def _work(tasks):
+    while True:
+        user, language, tzinfo = tasks.get()
+        try:
+            warm_mailbox(user, language, tzinfo)
+        except Exception:
+            logger.exception('Warming the mailbox cache of user %s failed', user.pk)
+        finally:
+            for connection in connections.all():
+                connection.close()
+            tasks.task_done()
+
+
+def get_queue():
+    """returns the queue of users to warm, starting its threads on first use"""
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = queue.Queue(get_queue_size())
+            for i in range(get_thread_count()):
+                thread = threading.Thread(target=_work, args=(_queue,))
+                thread.daemon = True
+                thread.start()
+        return _queue
+
+
+def warm_on_login(sender, request, user, **kwargs):
+    """
+    ``user_logged_in`` handler warming the mailbox cache of the user, in a
+    background thread unless ``DJANGO_MESSAGES_WARM_CACHE_BACKGROUND`` is
+    ``False``.
+    """
+    if not mailbox_cache_enabled():
+        return
+    language = translation.get_language()
+    tzinfo = timezone.get_current_timezone()
+    if not getattr(settings, 'DJANGO_MESSAGES_WARM_CACHE_BACKGROUND', True):
+        warm_mailbox(user, language, tzinfo)
+        return
+    try:
+        get_queue().put_nowait((user, language, tzinfo))
+    except queue.Full:
+        # the mailbox is loaded by the views as usual
+        logger.debug('Not warming the mailbox cache of user %s, the queue is full', user.pk)
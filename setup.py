@@ -9,15 +9,18 @@ setup(
     author_email='mail@arnebrodowski.de',
     url='https://github.com/arneb/django-messages',
     install_requires=[
-        'Django'
+        'Django>=1.6'
     ],
     packages=(
         'django_messages',
+        'django_messages.management',
+        'django_messages.management.commands',
         'django_messages.templatetags',
     ),
     package_data={
         'django_messages': [
             'templates/django_messages/*',
+            'templates/admin/django_messages/*',
             'templates/notification/*/*',
             'locale/*/LC_MESSAGES/*',
         ]
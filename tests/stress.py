@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+"""
+Concurrency stress test for django-messages.
+
+Runs workers in several threads and processes against a file-backed SQLite
+database. Every worker acts as the sender or the recipient of a shared set of
+messages and reads, deletes and replies to them through the views, so the
+same rows are updated concurrently. Afterwards every completed operation is
+checked against the database; a column which was set by a request but is
+empty at the end is a lost update.
+
+    python tests/stress.py --processes=2 --threads=4 --messages=50 --rounds=3
+
+Prints throughput, latencies, lock waits and lost updates, and exits with
+status 1 if any update was lost, so it can be used as a regression gate.
+"""
+import multiprocessing
+import optparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.path.pardir))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "settings")
+
+# column which is set by each operation
+EXPECTED = {
+    'read': 'read_at',
+    'delete_recipient': 'recipient_deleted_at',
+    'delete_sender': 'sender_deleted_at',
+    'reply': 'replied_at',
+}
+PASSWORD = 'stress'
+
+
+def setup(path, lock_timeout):
+    """configures Django to use the database file at ``path``"""
+    from django.conf import settings
+    settings.DEBUG = False
+    settings.ALLOWED_HOSTS = ['testserver']
+    settings.DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': path,
+            'OPTIONS': {'timeout': lock_timeout},
+        },
+    }
+    settings.PASSWORD_HASHERS = ('django.contrib.auth.hashers.MD5PasswordHasher',)
+    settings.DJANGO_MESSAGES_NOTIFY = False
+    import django
+    if hasattr(django, 'setup'):
+        django.setup()
+
+
+def close_connections():
+    from django.db import connections
+    for connection in connections.all():
+        connection.close()
+
+
+def create_data(messages):
+    from django import VERSION
+    from django.core.management import call_command
+    from django_messages.models import Message
+    from django_messages.utils import get_user_model
+    call_command('migrate' if VERSION >= (1, 7) else 'syncdb',
+                 interactive=False, verbosity=0)
+    User = get_user_model()
+    sender = User.objects.create_user('stress_sender', 'sender@example.com', PASSWORD)
+    recipient = User.objects.create_user('stress_recipient', 'recipient@example.com', PASSWORD)
+    Message.objects.bulk_create([
+        Message(sender=sender, recipient=recipient,
+                subject='Message %d' % i, body='Body %d' % i)
+        for i in range(messages)
+    ])
+    return list(Message.objects.order_by('pk').values_list('pk', flat=True))
+
+
+class Worker(object):
+    """
+    Runs ``rounds`` passes over the shared messages in random order as the
+    sender or the recipient and records every completed operation.
+    """
+    def __init__(self, number, message_ids, rounds, retries):
+        from django.test.client import Client
+        self.role = 'recipient' if number % 2 == 0 else 'sender'
+        self.message_ids = list(message_ids)
+        self.rounds = rounds
+        self.retries = retries
+        self.random = random.Random(number)
+        self.client = Client()
+        self.done = []
+        self.latencies = {}
+        self.lock_waits = 0
+        self.errors = 0
+
+    def request(self, method, url, data=None):
+        from django.db import OperationalError
+        for attempt in range(self.retries + 1):
+            try:
+                response = getattr(self.client, method)(url, data or {})
+            except OperationalError as e:
+                if 'locked' not in str(e):
+                    raise
+                self.lock_waits += 1
+                time.sleep(0.01 * (attempt + 1))
+                continue
+            return response.status_code in (200, 302)
+        return False
+
+    def operations(self):
+        if self.role == 'recipient':
+            return ['read', 'delete_recipient', 'reply']
+        return ['delete_sender']
+
+    def run_operation(self, operation, pk):
+        from django.core.urlresolvers import reverse
+        if operation == 'read':
+            return self.request('get', reverse('messages_detail', args=[pk]))
+        if operation == 'reply':
+            return self.request('post', reverse('messages_reply', args=[pk]), {
+                'recipient': 'stress_sender',
+                'subject': 'Re: Message',
+                'body': 'Reply',
+            })
+        return self.request('get', reverse('messages_delete', args=[pk]))
+
+    def run(self):
+        try:
+            while not self.request_login():
+                pass
+            for i in range(self.rounds):
+                self.random.shuffle(self.message_ids)
+                for pk in self.message_ids:
+                    operation = self.random.choice(self.operations())
+                    start = time.time()
+                    if self.run_operation(operation, pk):
+                        self.done.append((operation, pk))
+                        self.latencies.setdefault(operation, []).append(time.time() - start)
+                    else:
+                        self.errors += 1
+        finally:
+            close_connections()
+        return self.result()
+
+    def request_login(self):
+        from django.db import OperationalError
+        try:
+            return self.client.login(username='stress_%s' % self.role, password=PASSWORD)
+        except OperationalError:
+            self.lock_waits += 1
+            return False
+
+    def result(self):
+        return {
+            'done': self.done,
+            'latencies': self.latencies,
+            'lock_waits': self.lock_waits,
+            'errors': self.errors,
+        }
+
+
+def run_threads(first, count, message_ids, options):
+    """runs ``count`` workers in threads and returns their results"""
+    workers = [Worker(first + i, message_ids, options.rounds, options.retries)
+               for i in range(count)]
+    results = [None] * count
+
+    def target(i):
+        results[i] = workers[i].run()
+
+    threads = [threading.Thread(target=target, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return [result for result in results if result is not None]
+
+
+def run_process(number, message_ids, options, queue):
+    try:
+        results = run_threads(number * options.threads, options.threads,
+                              message_ids, options)
+    except Exception as e:
+        results = [{'done': [], 'latencies': {}, 'lock_waits': 0,
+                    'errors': 1, 'exception': repr(e)}]
+    queue.put(results)
+
+
+def run(options):
+    """runs the workers and returns their merged results"""
+    close_connections()
+    if options.processes <= 1:
+        return run_threads(0, options.threads, options.message_ids, options)
+    queue = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=run_process,
+                    args=(i, options.message_ids, options, queue))
+                 for i in range(options.processes)]
+    for process in processes:
+        process.start()
+    results = []
+    for process in processes:
+        results.extend(queue.get())
+    for process in processes:
+        process.join()
+    return results
+
+
+def find_lost_updates(results):
+    """
+    Returns the operations whose column is empty although the request
+    completed.
+    """
+    from django_messages.models import Message
+    fields = sorted(set(EXPECTED.values()))
+    rows = dict((row[0], dict(zip(fields, row[1:]))) for row in
+                Message.objects.values_list('pk', *fields))
+    lost = []
+    for result in results:
+        for operation, pk in result['done']:
+            if rows[pk][EXPECTED[operation]] is None:
+                lost.append((operation, pk))
+    return lost
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def report(results, lost, duration, out=sys.stdout):
+    latencies = {}
+    for result in results:
+        for operation, values in result['latencies'].items():
+            latencies.setdefault(operation, []).extend(values)
+    total = sum(len(values) for values in latencies.values())
+    out.write('operations: %d in %.2fs (%.1f ops/s)\n' % (
+        total, duration, total / max(duration, 0.001)))
+    for operation in sorted(latencies):
+        values = latencies[operation]
+        out.write('  %-17s %6d  p50 %7.1fms  p95 %7.1fms\n' % (
+            operation, len(values), percentile(values, 0.5) * 1000,
+            percentile(values, 0.95) * 1000))
+    out.write('lock waits: %d\n' % sum(r['lock_waits'] for r in results))
+    out.write('failed operations: %d\n' % sum(r['errors'] for r in results))
+    for result in results:
+        if 'exception' in result:
+            out.write('  %s\n' % result['exception'])
+    out.write('lost updates: %d\n' % len(lost))
+    for operation, pk in lost[:10]:
+        out.write('  %s of message %d\n' % (operation, pk))
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--processes', type='int', default=2,
+        help='Number of worker processes.')
+    parser.add_option('--threads', type='int', default=4,
+        help='Number of worker threads per process.')
+    parser.add_option('--messages', type='int', default=50,
+        help='Number of messages all workers operate on.')
+    parser.add_option('--rounds', type='int', default=3,
+        help='Number of passes of every worker over the messages.')
+    parser.add_option('--lock-timeout', type='float', default=1.0,
+        help='Seconds SQLite waits for a lock before giving up.')
+    parser.add_option('--retries', type='int', default=20,
+        help='Number of retries of a request failing with a locked database.')
+    options, args = parser.parse_args(argv)
+
+    directory = tempfile.mkdtemp()
+    try:
+        setup(os.path.join(directory, 'stress.db'), options.lock_timeout)
+        options.message_ids = create_data(options.messages)
+        start = time.time()
+        results = run(options)
+        duration = time.time() - start
+        lost = find_lost_updates(results)
+        report(results, lost, duration)
+    finally:
+        close_connections()
+        shutil.rmtree(directory)
+    return 1 if lost else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,7 +1,9 @@
 from django.conf.urls import include, patterns
+from django.contrib import admin
 
 
 urlpatterns = patterns(
     '',
     (r'^messages/', include('django_messages.urls')),
+    (r'^admin/', include(admin.site.urls)),
 )